@@ -34,6 +34,137 @@ THRESHOLD = 45  # Set your threshold percentage
 global JOB_THRESHOLD
 JOB_THRESHOLD = 7
 
+global SSH_POOL_SIZE
+global SSH_KEEPALIVE_SECONDS
+global SSH_RECONNECT_ATTEMPTS
+SSH_POOL_SIZE = 4  # Number of warm SSH transports kept open to the remote host
+SSH_KEEPALIVE_SECONDS = 30
+SSH_RECONNECT_ATTEMPTS = 3
+
+# Adaptive polling intervals in seconds (min = right after a change, max = fully backed off when idle)
+global STATUS_POLL_MIN_SECONDS
+global STATUS_POLL_MAX_SECONDS
+global STATUS_POLL_RUNNING_MAX_SECONDS
+global EXTRACTION_POLL_MIN_SECONDS
+global EXTRACTION_POLL_MAX_SECONDS
+global OFFLOAD_POLL_MIN_SECONDS
+global OFFLOAD_POLL_MAX_SECONDS
+global POLL_AFTER_SUBMIT_SECONDS
+global SUBMISSION_POLL_MIN_SECONDS
+global SUBMISSION_POLL_MAX_SECONDS
+STATUS_POLL_MIN_SECONDS = 60
+STATUS_POLL_MAX_SECONDS = 1800
+STATUS_POLL_RUNNING_MAX_SECONDS = 600  # Upper bound while jobs are running, so finished jobs are noticed quickly
+EXTRACTION_POLL_MIN_SECONDS = 120
+EXTRACTION_POLL_MAX_SECONDS = 3600
+OFFLOAD_POLL_MIN_SECONDS = 300
+OFFLOAD_POLL_MAX_SECONDS = 3600
+POLL_AFTER_SUBMIT_SECONDS = 30
+SUBMISSION_POLL_MIN_SECONDS = 60
+SUBMISSION_POLL_MAX_SECONDS = 1800
+
+# Waits for a job id, shell prompt or file poll with exponential backoff between these intervals
+global WAIT_INITIAL_INTERVAL_SECONDS
+global WAIT_MAX_INTERVAL_SECONDS
+WAIT_INITIAL_INTERVAL_SECONDS = 0.1
+WAIT_MAX_INTERVAL_SECONDS = 2
+
+global KERBEROS_RENEW_MARGIN_SECONDS
+KERBEROS_RENEW_MARGIN_SECONDS = 1800  # Run kinit once the ticket expires within this time, klist is not run before that
+
+global RUN_PIPELINES_CONCURRENTLY
+RUN_PIPELINES_CONCURRENTLY = True  # Run monitoring, submission, extraction and offload in their own threads
+
+global TRANSFER_WORKERS
+global TRANSFER_BANDWIDTH_LIMIT_KBPS
+global SSH_CONTROL_PATH
+global SSH_CONTROL_PERSIST_SECONDS
+TRANSFER_WORKERS = 3  # Number of directories offloaded at the same time
+TRANSFER_BANDWIDTH_LIMIT_KBPS = 0  # Bandwidth cap for all transfers in KB/s, split evenly between the transfer workers, 0 = unlimited
+SSH_CONTROL_PATH = '~/.ssh/mmseg-script-%r@%h:%p'  # Shared ssh master connection used by rsync
+SSH_CONTROL_PERSIST_SECONDS = 300
+
+global TRANSFER_ENGINE
+global TRANSFER_COMPRESSION
+global TRANSFER_BATCH_SIZE
+TRANSFER_ENGINE = 'tar'  # 'tar' streams over the paramiko connection, 'rsync' uses sshpass+rsync on linux and pscp on windows
+TRANSFER_COMPRESSION = False  # gzip the tar stream, checkpoints barely compress so this mostly helps logs and images
+TRANSFER_BATCH_SIZE = 4  # Max number of queued directories sent in one tar stream
+
+global OFFLOAD_MANIFEST_NAME
+global offload_record_path
+global MANIFEST_SAMPLE_BYTES
+OFFLOAD_MANIFEST_NAME = '.offload_manifest.tsv'  # Written in each remote directory before it is transferred
+offload_record_path = 'completed_offloads.json'  # Directories that were transferred and verified
+MANIFEST_SAMPLE_BYTES = 1048576  # Checksums cover the first and last MB of every file, so huge checkpoints stay cheap
+
+global OFFLOAD_PROFILES
+global OFFLOAD_PROFILE
+# Which files of a work dir are offloaded. Patterns are matched against file names, a profile that
+# does not include '*' only copies files from the top level of the work dir (no --show-dir images).
+# Files that are not selected are NOT copied, but are still removed with the remote directory.
+OFFLOAD_PROFILES = {
+    'full': {'include': ['*'], 'exclude': []},
+    'no_images': {'include': ['*'], 'exclude': ['*.png', '*.jpg']},
+    'best': {'include': ['best_mIoU_iter_*.pth', '*.py', '*.log', '*.log.json', 'eval_single_scale_*.json', '*.txt'],
+             'exclude': []},
+}
+OFFLOAD_PROFILE = 'full'
+
+global quota_history_path
+global QUOTA_CACHE_SECONDS
+global QUOTA_HISTORY_WINDOW_SECONDS
+global QUOTA_LIMIT_PERCENT
+global QUOTA_OFFLOAD_LEAD_SECONDS
+global QUOTA_OFFLOAD_TARGET_PERCENT
+quota_history_path = 'quota_history.jsonl'  # Usage samples used to predict when the quota is full
+QUOTA_CACHE_SECONDS = 900  # Reuse the last quota -vs result for this long, the usage is estimated in between
+QUOTA_HISTORY_WINDOW_SECONDS = 6 * 3600  # Samples used to estimate the growth rate
+QUOTA_LIMIT_PERCENT = 95  # Usage that must never be reached
+QUOTA_OFFLOAD_LEAD_SECONDS = 2 * 3600  # Start offloading when QUOTA_LIMIT_PERCENT is predicted within this time
+QUOTA_OFFLOAD_TARGET_PERCENT = 35  # An offload frees just enough finished work dirs to get the usage down to this
+
+global CHECKPOINT_PRUNING
+global CHECKPOINT_KEEP_LAST
+global CHECKPOINT_KEEP_EVERY
+CHECKPOINT_PRUNING = True  # Delete intermediate iter_*.pth checkpoints once a training is completed and evaluated
+CHECKPOINT_KEEP_LAST = 1  # Number of most recent iter_*.pth checkpoints kept, the best_mIoU checkpoint is always kept
+CHECKPOINT_KEEP_EVERY = 0  # Also keep every iteration that is a multiple of this, 0 = none
+
+global SBATCH_ARRAY_PACKING
+global SBATCH_ARRAY_MIN_SIZE
+global SBATCH_ARRAY_CONCURRENCY
+global REMOTE_ARRAY_BATCH_FILE_LOCATION
+SBATCH_ARRAY_PACKING = False  # Submit queued batch files that only differ in config/job name as one sbatch --array
+SBATCH_ARRAY_MIN_SIZE = 2  # Smallest group of batch files that is packed into an array
+SBATCH_ARRAY_CONCURRENCY = 0  # %N cap on the tasks of one array running at once, 0 = the free job slots
+REMOTE_ARRAY_BATCH_FILE_LOCATION = 'tools/batch_files/arrays'  # Generated array batch files, relative to the working project
+
+global GPU_AWARE_DISPATCH
+global GPU_DISPATCH_CONSTRAINT
+global CLUSTER_CAPACITY_MAX_AGE_SECONDS
+GPU_AWARE_DISPATCH = True  # Narrow the -C of submitted jobs to the GPU types that have free GPUs (sinfo minus pending squeue demand)
+GPU_DISPATCH_CONSTRAINT = ''  # GPU types any training may run on, e.g. 'ada|ampere|a4500|a4000', '' = only the types in the batch file
+CLUSTER_CAPACITY_MAX_AGE_SECONDS = 60  # sinfo/squeue are probed at most once per this many seconds
+
+global EVALUATION_GPU_CONSTRAINT
+global EVALUATION_MAX_ATTEMPTS
+global EVALUATION_SETUP_COMMANDS
+global REMOTE_EVALUATION_BATCH_FILE_LOCATION
+global evaluation_record_path
+global EVALUATION_CONCURRENCY
+global EVALUATION_PRIORITY
+EVALUATION_GPU_CONSTRAINT = 'ada|a4500|a4000'  # GPU types evaluations may run on, narrowed to the ones with free GPUs at submit time
+EVALUATION_CONCURRENCY = 4  # Max evaluation jobs in SLURM at the same time, independent of JOB_THRESHOLD
+EVALUATION_PRIORITY = 'newest'  # 'newest' evaluates the most recently completed trainings first, 'oldest' the earliest completed ones
+EVALUATION_MAX_ATTEMPTS = 3  # Evaluation jobs that end without an eval_single_scale_*.json are submitted again up to this many times
+EVALUATION_SETUP_COMMANDS = []  # Lines run before tools/test.py in an evaluation job, e.g. ['source ~/.bashrc', 'conda activate mmseg']. Empty uses the setup lines of the training batch file
+REMOTE_EVALUATION_BATCH_FILE_LOCATION = 'tools/batch_files/evaluations'  # Generated evaluation batch files, relative to the working project
+evaluation_record_path = 'evaluations.json'  # Evaluation jobs and their status by work dir
+
+global REMOTE_COMMAND_CONCURRENCY
+REMOTE_COMMAND_CONCURRENCY = 8  # Max number of remote commands run at the same time over the pooled channels
+
 global REMOTE_BASE_PATH 
 global REMOTE_WORKING_PROJECT 
 global REMOTE_WORK_DIR  
@@ -49,6 +180,24 @@ REMOTE_BATCH_FILE_PATH = 'mmseg-personal/tools/batch_files/_QUEUED'
 global json_file_path
 json_file_path = 'batch_files.json'
 
+global job_journal_path
+global job_history_path
+global JOURNAL_COMPACTION_THRESHOLD
+job_journal_path = 'batch_files.journal'  # Status changes appended since the last write of batch_files.json
+job_history_path = 'batch_files_history.jsonl'  # Compacted journal records, kept for runtime analytics
+JOURNAL_COMPACTION_THRESHOLD = 500  # Fold the journal into batch_files.json after this many records
+
+global job_store_backend
+global sqlite_db_path
+job_store_backend = 'json'  # 'json' keeps state in batch_files.json, 'sqlite' uses the WAL database below
+sqlite_db_path = 'batch_files.db'
+
+global batch_file_cache_path
+batch_file_cache_path = 'batch_file_cache.json'  # Parsed batch file headers, validated by remote size and mtime
+
+global work_dir_index_path
+work_dir_index_path = 'work_dir_index.json'  # du size and file count of every work_dirs/<run>, validated by mtime
+
 # ----- Getenv variables -----
 
 PLINK_PATH=os.getenv('plink_path')
@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+import config as cfg
+
+# Setup logging
+logging.basicConfig(filename='storage_monitor.log', level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+def print_green(text):
+    print(f"\033[92m{text}\033[0m")
+
+def print_red(text):
+    print(f"\033[91m{text}\033[0m")
+
+# Prints the expiry of the ticket granting ticket and the current time of the remote as epoch seconds.
+# The date is converted on the remote, so the klist date format of its locale does not matter.
+KLIST_EXPIRY_COMMAND = (
+    "expires=$(klist 2>/dev/null | awk '/krbtgt\\//{print $3\" \"$4; exit}'); "
+    "if [ -n \"$expires\" ]; then date -d \"$expires\" +%s; else echo none; fi; date +%s"
+)
+
+def parse_klist_expiry(output):
+    """
+    Parse the output of KLIST_EXPIRY_COMMAND.
+    :return: ticket lifetime left in seconds (negative if expired), None if there is no ticket
+    """
+    lines = output.split()
+    if len(lines) != 2 or not lines[0].lstrip('-').isdigit() or not lines[1].isdigit():
+        return None
+    return int(lines[0]) - int(lines[1])
+
+def read_ticket_lifetime(ssh):
+    """Run klist on the remote. Returns the seconds the Kerberos ticket is still valid, or None without a ticket."""
+    stdin, stdout, stderr = ssh.exec_command(KLIST_EXPIRY_COMMAND)
+    return parse_klist_expiry(stdout.read().decode())
+
+def run_kinit(ssh, password=cfg.PASSWORD):
+    """Run kinit on the remote, the password is written to its stdin so it never shows up in a command line."""
+    logging.info("    Executing: kinit")
+    stdin, stdout, stderr = ssh.exec_command('kinit')
+    stdin.write(password + '\n')
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    output = stdout.read().decode() + stderr.read().decode()
+    if 'error' in output.lower() or 'incorrect' in output.lower():
+        logging.error(f"kinit failed: {output.strip()}")
+        print_red(f"kinit failed: {output.strip()}")
+
+class CredentialManager:
+    """
+    Keeps the Kerberos ticket on the remote valid without opening srun shells on the GPU servers.
+
+    klist is read over the pooled connection and the expiry is cached, so until the ticket is within
+    renew_margin_seconds of expiring, ensure_valid() does not run any remote command. kinit is only run
+    when the ticket is missing or about to expire.
+    """
+    def __init__(self, renew_margin_seconds=cfg.KERBEROS_RENEW_MARGIN_SECONDS):
+        self.renew_margin_seconds = renew_margin_seconds
+        self.expires_at = None  # Local time the ticket expires
+        self._lock = threading.Lock()
+
+    def ticket_lifetime_seconds(self):
+        """Seconds the ticket is still valid according to the last klist, None if unknown or there is no ticket."""
+        with self._lock:
+            return None if self.expires_at is None else self.expires_at - time.time()
+
+    def check(self, ssh):
+        """Read the ticket expiry with klist and cache it. Returns the lifetime left in seconds or None."""
+        lifetime = read_ticket_lifetime(ssh)
+        with self._lock:
+            self.expires_at = None if lifetime is None else time.time() + lifetime
+        if lifetime is None:
+            logging.info("No Kerberos ticket found on the remote")
+        else:
+            logging.info(f"Kerberos ticket lifetime: {lifetime / 3600:.2f}h")
+        return lifetime
+
+    def invalidate(self):
+        """Make the next ensure_valid() run klist again, e.g. after srun reported a permission error."""
+        with self._lock:
+            self.expires_at = None
+
+    def ensure_valid(self, ssh):
+        """
+        Make sure the ticket is valid for at least renew_margin_seconds, running kinit if needed.
+        :return: True if the ticket is valid
+        """
+        lifetime = self.ticket_lifetime_seconds()
+        if lifetime is not None and lifetime > self.renew_margin_seconds:
+            return True
+        lifetime = self.check(ssh)
+        if lifetime is not None and lifetime > self.renew_margin_seconds:
+            return True
+        print("Kerberos ticket is missing or about to expire. Running kinit")
+        logging.info("Kerberos ticket is missing or about to expire. Running kinit")
+        run_kinit(ssh)
+        lifetime = self.check(ssh)
+        # A fresh ticket counts even if its full lifetime is shorter than the margin
+        if lifetime is not None and lifetime > 0:
+            print_green(f"kinit successful, ticket valid for {lifetime / 3600:.2f}h")
+            return True
+        print_red("Kerberos ticket is still not valid after kinit")
+        logging.error("Kerberos ticket is still not valid after kinit")
+        return False
+
+_credential_manager = None
+
+def get_credential_manager():
+    global _credential_manager
+    if _credential_manager is None:
+        _credential_manager = CredentialManager()
+    return _credential_manager
@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+import threading
+import time
+import config as cfg
+import remote_operations as rops
+import slurm_operations as sops
+
+# Setup logging
+logging.basicConfig(filename='storage_monitor.log', level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+def print_green(text):
+    print(f"\033[92m{text}\033[0m")
+
+def print_red(text):
+    print(f"\033[91m{text}\033[0m")
+
+# tools/test.py --eval writes its metrics to this file in the work dir of the config
+EVAL_RESULT_PATTERN = 'eval_single_scale_*.json'
+# WAITING evaluations are in the local evaluation queue, QUEUED and RUNNING ones are in SLURM.
+# The others are EVALUATED or ERROR.
+PENDING_EVALUATION_STATUSES = ('WAITING', 'QUEUED', 'RUNNING')
+SUBMITTED_EVALUATION_STATUSES = ('QUEUED', 'RUNNING')
+
+_evaluation_record_lock = threading.RLock()
+
+def load_evaluations():
+    """
+    Evaluation records by work dir name:
+    {work_dir: {checkpoint, job_id, status, attempts, queued_at, completed_at, submitted_at, constraint, results_before,
+                setup_commands}}
+    """
+    with _evaluation_record_lock:
+        if os.path.exists(cfg.evaluation_record_path):
+            with open(cfg.evaluation_record_path, 'r') as record_file:
+                return json.load(record_file)
+        return {}
+
+def save_evaluations(evaluations):
+    with _evaluation_record_lock:
+        with open(cfg.evaluation_record_path + '.tmp', 'w') as record_file:
+            json.dump(evaluations, record_file, indent=4)
+        os.replace(cfg.evaluation_record_path + '.tmp', cfg.evaluation_record_path)
+
+def get_work_dir_path(work_dir):
+    return f"{cfg.REMOTE_WORKING_PROJECT}/{cfg.REMOTE_WORK_DIR}/{work_dir}"
+
+def pending_evaluations():
+    """Work dirs whose evaluation is waiting, queued or running, they must not be offloaded yet."""
+    return {work_dir for work_dir, evaluation in load_evaluations().items()
+            if evaluation["status"] in PENDING_EVALUATION_STATUSES}
+
+def parse_environment_lines(lines):
+    """
+    Environment setup of a training batch file: the commands between the #SBATCH header and the
+    tools/train.py call, e.g. "source ~/.bashrc" and "conda activate mmseg".
+    :param lines: iterable of the lines of the batch file
+    :return: list of the setup lines
+    """
+    setup = []
+    for line in lines:
+        line = line.strip()
+        if 'tools/train.py' in line:
+            break
+        if line and not line.startswith('#'):
+            setup.append(line)
+    return setup
+
+def read_training_setup_commands(ssh, work_dir):
+    """Environment setup lines of the training batch file of a work dir, empty if the batch file was not found."""
+    base_dir = f"{cfg.REMOTE_WORKING_PROJECT}/{'/'.join(cfg.REMOTE_BATCH_FILE_LOCATION.split('/')[:-1])}"
+    batch_file_path = rops.find_associated_batch_file(ssh, base_dir=base_dir, work_dir=work_dir)
+    if batch_file_path is None:
+        return []
+    stdin, stdout, stderr = ssh.exec_command(f'cat {batch_file_path}')
+    return parse_environment_lines(stdout.read().decode().splitlines())
+
+def build_evaluation_batch_file(work_dir, best_mIoU_file, constraint=cfg.EVALUATION_GPU_CONSTRAINT, setup_commands=None):
+    """
+    Batch file that evaluates the best checkpoint of a work dir with tools/test.py, like the old srun --pty command.
+    :param setup_commands: environment setup lines run before tools/test.py, cfg.EVALUATION_SETUP_COMMANDS takes precedence when set
+    """
+    job_work_dir_path = f"{cfg.REMOTE_WORK_DIR}/{work_dir}"
+    lines = [
+        '#!/bin/bash',
+        f'#SBATCH --job-name=eval_{work_dir}',
+        '#SBATCH -G 1',
+        f'#SBATCH --constraint={constraint}',
+        # sbatch is run from the working project, so the log ends up next to the eval results
+        f'#SBATCH --output={job_work_dir_path}/eval_%j.out',
+        *(cfg.EVALUATION_SETUP_COMMANDS or setup_commands or []),
+        f'cd ~/{cfg.REMOTE_WORKING_PROJECT}',
+        f'python tools/test.py {job_work_dir_path}/{work_dir}.py {job_work_dir_path}/{best_mIoU_file} '
+        f'--show-dir {job_work_dir_path}/{best_mIoU_file[:-4]}_output/ --eval mIoU',
+    ]
+    return '\n'.join(lines) + '\n'
+
+def list_eval_results(ssh, work_dirs):
+    """
+    List the eval result files of many work dirs with one command.
+    :return: dict of {work_dir: [eval result file names]}
+    """
+    results = {work_dir: [] for work_dir in work_dirs}
+    if not work_dirs:
+        return results
+    patterns = ' '.join(f"{get_work_dir_path(work_dir)}/{EVAL_RESULT_PATTERN}" for work_dir in work_dirs)
+    stdin, stdout, stderr = ssh.exec_command(f"ls -1 {patterns} 2>/dev/null")
+    for line in stdout.read().decode().splitlines():
+        parts = line.split('/')
+        if len(parts) >= 2 and parts[-2] in results:
+            results[parts[-2]].append(parts[-1])
+    return results
+
+def find_eval_result_for_checkpoint(ssh, work_dir, best_mIoU_file):
+    """Return an eval result file written after the checkpoint, i.e. an evaluation of this checkpoint, or None."""
+    work_dir_path = get_work_dir_path(work_dir)
+    stdin, stdout, stderr = ssh.exec_command(
+        f"find {work_dir_path} -maxdepth 1 -name '{EVAL_RESULT_PATTERN}' -newer {work_dir_path}/{best_mIoU_file} 2>/dev/null | head -n 1")
+    return stdout.read().decode().strip() or None
+
+def get_training_completed_at(ssh, work_dir, best_mIoU_file):
+    """
+    Time the training of a work dir completed: the mtime of its completion marker, or of the best
+    checkpoint when there is no marker.
+    :return: unix time, None if neither file was found
+    """
+    markers = [marker for marker in (cfg.COMPLETED_MARKER_FILE, best_mIoU_file) if marker]
+    names = ' -o '.join(f"-name '{marker}'" for marker in markers)
+    stdin, stdout, stderr = ssh.exec_command(
+        f"find {get_work_dir_path(work_dir)} -type f \\( {names} \\) -printf '%f\\t%T@\\n' 2>/dev/null")
+    mtimes = {}
+    for line in stdout.read().decode().splitlines():
+        name, _, mtime = line.partition('\t')
+        try:
+            mtimes[name] = max(float(mtime), mtimes.get(name, 0.0))
+        except ValueError:
+            continue
+    for marker in markers:
+        if marker in mtimes:
+            return mtimes[marker]
+    return None
+
+def enqueue_evaluation(ssh, work_dir, best_mIoU_file):
+    """
+    Add the evaluation of a work dir to the evaluation queue, dispatch_evaluations submits it.
+    Nothing is queued if this checkpoint is already evaluated or waiting for its evaluation.
+    :return: True if the checkpoint is evaluated or will be
+    """
+    evaluation = load_evaluations().get(work_dir)
+    if evaluation is not None and evaluation["checkpoint"] == best_mIoU_file and evaluation["status"] != "ERROR":
+        logging.info(f"Evaluation of {work_dir} with {best_mIoU_file} is already {evaluation['status']}")
+        return True
+    eval_result = find_eval_result_for_checkpoint(ssh, work_dir, best_mIoU_file)
+    results_before = list_eval_results(ssh, [work_dir])[work_dir]
+    completed_at = None if eval_result else get_training_completed_at(ssh, work_dir, best_mIoU_file)
+    # The evaluation runs in the environment the model was trained in. Read now, the batch file can move later
+    setup_commands = [] if eval_result or cfg.EVALUATION_SETUP_COMMANDS else read_training_setup_commands(ssh, work_dir)
+    if not eval_result and not cfg.EVALUATION_SETUP_COMMANDS and not setup_commands:
+        print_red(f"No environment setup found for the evaluation of {work_dir}, set EVALUATION_SETUP_COMMANDS in config.py")
+        logging.error(f"No training batch file with environment setup lines found for {work_dir}, "
+                      f"its evaluation job runs without environment setup")
+    with _evaluation_record_lock:
+        evaluations = load_evaluations()
+        evaluations[work_dir] = {
+            "checkpoint": best_mIoU_file,
+            "job_id": None,
+            "status": "EVALUATED" if eval_result else "WAITING",
+            "attempts": 0,
+            "queued_at": time.time(),
+            # dispatch_evaluations orders by when the training completed, not when it was found
+            "completed_at": completed_at,
+            "submitted_at": None,
+            "constraint": None,
+            "results_before": results_before,
+            "setup_commands": setup_commands,
+        }
+        save_evaluations(evaluations)
+    if eval_result:
+        print_green(f"{work_dir} is already evaluated with {best_mIoU_file}: {eval_result}")
+        logging.info(f"Skipping the evaluation of {work_dir}, {eval_result} is newer than {best_mIoU_file}")
+    else:
+        logging.info(f"Queued the evaluation of {work_dir} with {best_mIoU_file}")
+    return True
+
+def submit_evaluation(ssh, work_dir, constraint=cfg.EVALUATION_GPU_CONSTRAINT):
+    """Submit a WAITING evaluation as a batch job and record its job id. Returns the job id or None."""
+    evaluation = load_evaluations()[work_dir]
+    best_mIoU_file = evaluation["checkpoint"]
+    attempts = evaluation["attempts"]
+    batch_file_path = f"{cfg.REMOTE_EVALUATION_BATCH_FILE_LOCATION}/eval_{work_dir}.batch"
+    content = build_evaluation_batch_file(work_dir, best_mIoU_file, constraint, evaluation.get("setup_commands"))
+    job_id, error = None, ''
+    # A failed sbatch counts as an attempt as well
+    while job_id is None and attempts < cfg.EVALUATION_MAX_ATTEMPTS:
+        job_id, error = sops.submit_generated_batch_file(ssh, content, batch_file_path)
+        attempts += 1
+    with _evaluation_record_lock:
+        evaluations = load_evaluations()
+        evaluations[work_dir].update({
+            "job_id": job_id,
+            "status": "QUEUED" if job_id is not None else "ERROR",
+            "attempts": attempts,
+            "submitted_at": time.time(),
+            "constraint": constraint,
+        })
+        save_evaluations(evaluations)
+    if job_id is None:
+        print_red(f"Could not submit the evaluation of {work_dir}: {error}")
+        logging.error(f"Could not submit the evaluation of {work_dir}: {error}")
+    else:
+        print_green(f"Submitted evaluation of {work_dir} with {best_mIoU_file} on {constraint} as job {job_id}")
+        logging.info(f"Submitted evaluation of {work_dir} with {best_mIoU_file} on {constraint} as job {job_id}")
+    return job_id
+
+def dispatch_evaluations(ssh, free_gpus=None):
+    """
+    Submit WAITING evaluations while fewer than cfg.EVALUATION_CONCURRENCY evaluation jobs are in SLURM,
+    in cfg.EVALUATION_PRIORITY order. Each job gets the features of cfg.EVALUATION_GPU_CONSTRAINT that
+    have free GPUs, so evaluations do not wait behind a busy GPU type.
+    :param free_gpus: {feature: free_gpus} (see sops.get_cluster_capacity), queried when needed if None
+    :return: list of work dirs that were submitted
+    """
+    evaluations = load_evaluations()
+    submitted_count = sum(1 for evaluation in evaluations.values() if evaluation["status"] in SUBMITTED_EVALUATION_STATUSES)
+    waiting = [work_dir for work_dir, evaluation in evaluations.items() if evaluation["status"] == "WAITING"]
+    slots = max(0, cfg.EVALUATION_CONCURRENCY - submitted_count)
+    if not waiting or slots == 0:
+        return []
+    # Records from before completed_at was recorded, or without a marker, fall back to the time they were queued
+    waiting.sort(key=lambda work_dir: evaluations[work_dir].get("completed_at") or evaluations[work_dir]["queued_at"],
+                 reverse=cfg.EVALUATION_PRIORITY == 'newest')
+    if free_gpus is None:
+        free_gpus = sops.get_cluster_capacity(ssh)
+    free_gpus = dict(free_gpus)
+    submitted = []
+    for work_dir in waiting[:slots]:
+        constraint = sops.choose_constraint(cfg.EVALUATION_GPU_CONSTRAINT, free_gpus)
+        sops.reserve_gpu(free_gpus, constraint)
+        if submit_evaluation(ssh, work_dir, constraint) is not None:
+            submitted.append(work_dir)
+    print(f"Evaluation queue: {len(submitted)} submitted, {len(waiting) - len(submitted)} waiting, "
+          f"{submitted_count + len(submitted)}/{cfg.EVALUATION_CONCURRENCY} evaluation jobs in SLURM")
+    return submitted
+
+def track_evaluations(ssh):
+    """
+    Update the evaluation jobs from squeue. An evaluation that left the queue succeeded if it wrote a new
+    eval_single_scale_*.json, otherwise it goes back to the evaluation queue until cfg.EVALUATION_MAX_ATTEMPTS is reached.
+    :return: (evaluated, failed) lists of work dirs that reached their final status in this call
+    """
+    evaluations = load_evaluations()
+    pending = {work_dir: evaluation for work_dir, evaluation in evaluations.items()
+               if evaluation["status"] in SUBMITTED_EVALUATION_STATUSES}
+    if not pending:
+        return [], []
+    queue = sops.get_queue(ssh, [evaluation["job_id"] for evaluation in pending.values()])
+    ended = {work_dir: evaluation for work_dir, evaluation in pending.items() if evaluation["job_id"] not in queue}
+    terminal_states = sops.get_terminal_states(ssh, [evaluation["job_id"] for evaluation in ended.values()])
+    results = list_eval_results(ssh, list(ended))
+
+    evaluated = []
+    failed = []
+    with _evaluation_record_lock:
+        evaluations = load_evaluations()
+        for work_dir, evaluation in pending.items():
+            record = evaluations[work_dir]
+            if work_dir not in ended:
+                record["status"] = "QUEUED" if queue[evaluation["job_id"]]["state"] == "PENDING" else "RUNNING"
+                continue
+            accounting = terminal_states.get(evaluation["job_id"])
+            if accounting is not None and accounting["status"] is None:
+                # Requeued, sacct knows the job but it has not ended
+                continue
+            state = accounting["state"] if accounting is not None else "UNKNOWN"
+            if set(results[work_dir]) - set(evaluation["results_before"]):
+                record["status"] = "EVALUATED"
+                evaluated.append(work_dir)
+                print_green(f"{work_dir} evaluated with {evaluation['checkpoint']} successfully!")
+                logging.info(f"{work_dir} evaluated with {evaluation['checkpoint']} successfully (job {evaluation['job_id']} {state})")
+            elif evaluation["attempts"] < cfg.EVALUATION_MAX_ATTEMPTS:
+                logging.error(f"Evaluation job {evaluation['job_id']} of {work_dir} ended as {state} without a result, queueing it again")
+                # Back into the evaluation queue, so the retry counts against the concurrency cap
+                record["status"] = "WAITING"
+            else:
+                record["status"] = "ERROR"
+                failed.append(work_dir)
+                print_red(f"{work_dir} was not evaluated. Double check issue with model.")
+                logging.error(f"{work_dir} was not evaluated after {evaluation['attempts']} attempts, last job "
+                              f"{evaluation['job_id']} ended as {state}. Double check issue with model.")
+        save_evaluations(evaluations)
+    return evaluated, failed
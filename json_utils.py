@@ -2,8 +2,13 @@ import config as cfg
 import logging
 import os
 import json
+import sqlite3
+import threading
+import time
+from argparse import ArgumentParser
 from collections import defaultdict
 import remote_operations as rops
+import slurm_operations as sops
 
 # Setup logging
 logging.basicConfig(filename='storage_monitor.log', level=logging.INFO,
@@ -34,169 +39,713 @@ def load_or_create_json():
         dictionary_list = []
     return dictionary_list # returns dict of jobs with filename, job_name, status, working_directory 
 
-def handle_queued_files(ssh, dictionary_list, folder_directory):
+JOB_STATUSES = ['FINISHED', 'COMPLETED', 'ERROR', 'RUNNING', 'QUEUED']
+
+class JobStore:
+    """
+    In-memory registry of the jobs in batch_files.json.
+
+    Jobs are indexed by filename, job_name, working_directory and status so lookups, status
+    transitions and status counts are O(1). Every add and status change is appended as one line to
+    the journal (cfg.job_journal_path) instead of rewriting the JSON file. load() rebuilds the state
+    from batch_files.json plus the journal, and compact() folds the journal back into batch_files.json
+    and moves its records to the history file (cfg.job_history_path). persist() runs that compaction
+    on a background thread: the journal is moved aside and new records go to a fresh journal while
+    the snapshot of the jobs is written.
+    """
+    def __init__(self, json_file_path=None, journal_path=None, history_path=None):
+        self.json_file_path = json_file_path or cfg.json_file_path
+        self.journal_path = journal_path or cfg.job_journal_path
+        self.history_path = history_path or cfg.job_history_path
+        # Journal records that are being compacted on the background thread
+        self.compacting_journal_path = self.journal_path + '.compacting'
+        self.jobs = []
+        self.dirty = False
+        self.journal_records = 0
+        self._by_filename = {}
+        self._by_job_name = {}
+        self._by_working_directory = {}
+        self._by_job_id = {}
+        self._by_status = defaultdict(dict) # status -> {filename: job}, keeps insertion order
+        self._lock = threading.RLock()
+        self._compaction_thread = None
+
+    def load(self):
+        """(Re)load the jobs from the JSON file, replay the journal and rebuild the indexes."""
+        with self._lock:
+            self.jobs = []
+            self._by_filename.clear()
+            self._by_job_name.clear()
+            self._by_working_directory.clear()
+            self._by_job_id.clear()
+            self._by_status.clear()
+            if os.path.exists(self.json_file_path):
+                with open(self.json_file_path, 'r') as json_file:
+                    for job in json.load(json_file):
+                        self._index(job)
+            self._recover_journal()
+            self.journal_records = self._replay_journal()
+            logging.info(f"Loaded {len(self.jobs)} jobs from {self.json_file_path} and {self.journal_records} journal records")
+            self.dirty = self.journal_records > 0
+        return self
+
+    def _recover_journal(self):
+        """
+        Repair the journal after a crash before anything is appended to it again. A partial last line is cut
+        off, otherwise the next record would be appended to it and both would be unreadable. Records of a
+        compaction that did not finish are put back in front of the journal.
+        """
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb+') as journal_file:
+                content = journal_file.read()
+                if content and not content.endswith(b'\n'):
+                    end = content.rfind(b'\n') + 1
+                    logging.error(f"Removing partial journal record from {self.journal_path}: {content[end:]!r}")
+                    journal_file.truncate(end)
+        if os.path.exists(self.compacting_journal_path):
+            logging.info(f"Restoring the records of an unfinished compaction from {self.compacting_journal_path}")
+            with open(self.journal_path + '.tmp', 'w') as merged_file:
+                for path in [self.compacting_journal_path, self.journal_path]:
+                    if os.path.exists(path):
+                        merged_file.writelines(line for line in open(path, 'r') if line.endswith('\n'))
+            os.replace(self.journal_path + '.tmp', self.journal_path)
+            os.remove(self.compacting_journal_path)
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return 0
+        records = 0
+        with open(self.journal_path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash in the middle of an append leaves a partial last line behind
+                    logging.error(f"Skipping unreadable journal record in {self.journal_path}: {line.strip()}")
+                    continue
+                if record['event'] == 'add':
+                    if record['job']['filename'] not in self._by_filename:
+                        self._index(dict(record['job']))
+                elif record['event'] == 'status':
+                    job = self._by_filename.get(record['filename'])
+                    if job is not None:
+                        self._move_status(job, record['status'])
+                elif record['event'] == 'job_id':
+                    job = self._by_filename.get(record['filename'])
+                    if job is not None:
+                        self._set_job_id(job, record['job_id'])
+                records += 1
+        return records
+
+    def _append_journal(self, record):
+        record['time'] = time.time()
+        with open(self.journal_path, 'a') as journal_file:
+            journal_file.write(json.dumps(record) + '\n')
+        self.journal_records += 1
+
+    def _move_status(self, job, status):
+        self._by_status[job['status']].pop(job['filename'], None)
+        job['status'] = status
+        self._by_status[status][job['filename']] = job
+
+    def _set_job_id(self, job, job_id):
+        if job.get('job_id') is not None:
+            self._by_job_id.pop(job['job_id'], None)
+        job['job_id'] = job_id
+        if job_id is not None:
+            self._by_job_id[job_id] = job
+
+    def _index(self, job):
+        self.jobs.append(job)
+        self._by_filename[job['filename']] = job
+        # Like the linear scans this replaces, the first job with a given name/directory wins
+        if job.get('job_name'):
+            self._by_job_name.setdefault(job['job_name'], job)
+        if job.get('working_directory'):
+            self._by_working_directory.setdefault(job['working_directory'], job)
+        if job.get('job_id'):
+            self._by_job_id[job['job_id']] = job
+        self._by_status[job['status']][job['filename']] = job
+
+    def locked(self):
+        """
+        Hold the store lock, e.g. ``with job_store.locked():``, to make a series of changes
+        atomic with respect to the other worker threads.
+        """
+        return self._lock
+
+    def __iter__(self):
+        return iter(list(self.jobs))
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, filename):
+        return filename in self._by_filename
+
+    def add(self, job):
+        """Add a new job dict with filename, job_name, working_directory and status."""
+        with self._lock:
+            if job['filename'] in self._by_filename:
+                return self._by_filename[job['filename']]
+            self._index(job)
+            self._append_journal({"event": "add", "job": job})
+            self.dirty = True
+            return job
+
+    def get(self, batch_file='', job_name='', working_directory='', job_id=''):
+        """Return the job matching the batch file name, job name, working directory or SLURM job id, or None."""
+        if job_id != '' and job_id in self._by_job_id:
+            return self._by_job_id[job_id]
+        if batch_file != '' and batch_file in self._by_filename:
+            return self._by_filename[batch_file]
+        if job_name != '' and job_name in self._by_job_name:
+            return self._by_job_name[job_name]
+        if working_directory != '' and working_directory in self._by_working_directory:
+            return self._by_working_directory[working_directory]
+        return None
+
+    def set_status(self, job, status):
+        """Move a job to a new status, keeping the status index up to date."""
+        if job is None:
+            return None
+        with self._lock:
+            old_status = job['status']
+            if old_status == status:
+                return job
+            self._move_status(job, status)
+            self._append_journal({"event": "status", "filename": job['filename'], "previous": old_status, "status": status})
+            self.dirty = True
+        return job
+
+    def set_job_id(self, job, job_id):
+        """Remember the SLURM job id a job was submitted as, None once it should no longer be tracked."""
+        if job is None:
+            return None
+        with self._lock:
+            if job.get('job_id') == job_id:
+                return job
+            self._set_job_id(job, job_id)
+            self._append_journal({"event": "job_id", "filename": job['filename'], "job_id": job_id})
+            self.dirty = True
+        return job
+
+    def jobs_with_status(self, status):
+        return list(self._by_status[status].values())
+
+    def count(self, status):
+        return len(self._by_status[status])
+
+    def status_counts(self):
+        """Return the (finished, completed, error, running, queued) counts."""
+        return tuple(self.count(status) for status in JOB_STATUSES)
+
+    def persist(self, force=False):
+        """
+        Compact the journal into the JSON file once it holds cfg.JOURNAL_COMPACTION_THRESHOLD records.
+        Changes are already durable in the journal, so skipping the rewrite loses nothing. The compaction
+        runs on a background thread, only force=True (e.g. on shutdown) compacts on the calling thread.
+        """
+        with self._lock:
+            if force:
+                self.compact()
+                return True
+            if self.dirty and self.journal_records >= cfg.JOURNAL_COMPACTION_THRESHOLD and not self.compacting():
+                jobs, records = self._rotate_journal()
+                self._compaction_thread = threading.Thread(target=self._write_compaction, args=(jobs, records),
+                                                           name="job-store-compaction", daemon=True)
+                self._compaction_thread.start()
+                return True
+        return False
+
+    def compacting(self):
+        return self._compaction_thread is not None and self._compaction_thread.is_alive()
+
+    def compact(self):
+        """Write the current state to the JSON file and move the journal records to the history file."""
+        with self._lock:
+            # The background compaction does not take the store lock, so it can finish while it is held
+            if self._compaction_thread is not None:
+                self._compaction_thread.join()
+            jobs, records = self._rotate_journal()
+            self._write_compaction(jobs, records)
+
+    def _rotate_journal(self):
+        """Copy the jobs and move the journal aside, later records go to a new journal. Needs the store lock."""
+        jobs = [dict(job) for job in self.jobs]
+        records = self.journal_records
+        if os.path.exists(self.compacting_journal_path) and os.path.exists(self.journal_path):
+            # Left behind by a failed compaction, its records are moved to the history together with these
+            with open(self.journal_path, 'r') as journal_file, open(self.compacting_journal_path, 'a') as compacting_file:
+                compacting_file.write(journal_file.read())
+            os.remove(self.journal_path)
+        elif os.path.exists(self.journal_path):
+            os.replace(self.journal_path, self.compacting_journal_path)
+        self.journal_records = 0
+        self.dirty = False
+        return jobs, records
+
+    def _write_compaction(self, jobs, records):
+        """Write a copy of the jobs to the JSON file and move the journal records it contains to the history file."""
+        try:
+            update_json_file(jobs, self.json_file_path)
+            if os.path.exists(self.compacting_journal_path):
+                with open(self.compacting_journal_path, 'r') as journal_file, open(self.history_path, 'a') as history_file:
+                    for line in journal_file:
+                        # A crash in the middle of an append leaves a partial last line, it must not end up
+                        # in the middle of the history file
+                        if line.endswith('\n'):
+                            history_file.write(line)
+                        else:
+                            logging.error(f"Not moving partial journal record to {self.history_path}: {line.strip()}")
+                os.remove(self.compacting_journal_path)
+            logging.info(f"Compacted {records} journal records into {self.json_file_path}")
+        except Exception as e:
+            # The records stay in the compacting journal, load() puts them back into the journal
+            logging.error(f"Compaction of {self.json_file_path} failed: {e}")
+
+class SQLiteJobStore(JobStore):
+    """
+    JobStore backed by a SQLite database in WAL mode.
+
+    Every add and status transition is committed in its own transaction, so a crash can never leave
+    a half written job registry behind, and readers such as process_model_outputs can query the
+    database while the monitor daemon is writing to it. The in-memory indexes are kept for lookups.
+    The journal is not used, the time of the last change is kept in the updated_at column.
+    """
+    def __init__(self, db_path=None, json_file_path=None):
+        super().__init__(json_file_path)
+        self.db_path = db_path or cfg.sqlite_db_path
+        self._connection = connect_job_db(self.db_path)
+
+    def load(self):
+        with self._lock:
+            if self._connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0 and os.path.exists(self.json_file_path):
+                logging.info(f"{self.db_path} is empty, importing jobs from {self.json_file_path}")
+                import_json_to_sqlite(self.json_file_path, self._connection)
+            self.jobs = []
+            self._by_filename.clear()
+            self._by_job_name.clear()
+            self._by_working_directory.clear()
+            self._by_job_id.clear()
+            self._by_status.clear()
+            rows = self._connection.execute(
+                "SELECT filename, job_name, working_directory, status, job_id FROM jobs ORDER BY position")
+            for filename, job_name, working_directory, status, job_id in rows:
+                job = {"filename": filename, "job_name": job_name, "working_directory": working_directory, "status": status}
+                if job_id is not None:
+                    job['job_id'] = job_id
+                self._index(job)
+            logging.info(f"Loaded {len(self.jobs)} jobs from {self.db_path}")
+            self.dirty = False
+        return self
+
+    def add(self, job):
+        with self._lock:
+            if job['filename'] in self._by_filename:
+                return self._by_filename[job['filename']]
+            with self._connection:
+                self._connection.execute(
+                    "INSERT INTO jobs (filename, job_name, working_directory, status, job_id, position, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job['filename'], job['job_name'], job['working_directory'], job['status'], job.get('job_id'),
+                     len(self.jobs), time.time()))
+            self._index(job)
+        return job
+
+    def set_status(self, job, status):
+        if job is None:
+            return None
+        with self._lock:
+            if job['status'] == status:
+                return job
+            with self._connection:
+                self._connection.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE filename = ?",
+                                         (status, time.time(), job['filename']))
+            self._move_status(job, status)
+        return job
+
+    def set_job_id(self, job, job_id):
+        if job is None:
+            return None
+        with self._lock:
+            if job.get('job_id') == job_id:
+                return job
+            with self._connection:
+                self._connection.execute("UPDATE jobs SET job_id = ?, updated_at = ? WHERE filename = ?",
+                                         (job_id, time.time(), job['filename']))
+            self._set_job_id(job, job_id)
+        return job
+
+    def persist(self, force=False):
+        # Every change is already committed, only keep the JSON file in sync when asked to
+        if force:
+            with self._lock:
+                update_json_file(self.jobs, self.json_file_path)
+            return True
+        return False
+
+def connect_job_db(db_path):
+    """Open (and create if needed) the job database in WAL mode."""
+    connection = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    with connection:
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                filename TEXT PRIMARY KEY,
+                job_name TEXT,
+                working_directory TEXT,
+                status TEXT NOT NULL,
+                job_id TEXT,
+                position INTEGER,
+                updated_at REAL
+            )""")
+        # Databases created before SLURM job ids were tracked
+        if 'job_id' not in [column[1] for column in connection.execute("PRAGMA table_info(jobs)")]:
+            connection.execute("ALTER TABLE jobs ADD COLUMN job_id TEXT")
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_job_name ON jobs (job_name)")
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_working_directory ON jobs (working_directory)")
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs (job_id)")
+    return connection
+
+def import_json_to_sqlite(json_file_path, db):
+    """
+    Import the jobs of a batch_files.json file into the job database in a single transaction.
+    :param json_file_path: path of the JSON file to import
+    :param db: path of the database or an open sqlite3 connection
+    :return: number of jobs imported
+    """
+    connection = db if isinstance(db, sqlite3.Connection) else connect_job_db(db)
+    with open(json_file_path, 'r') as json_file:
+        dictionary_list = json.load(json_file)
+    now = time.time()
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO jobs (filename, job_name, working_directory, status, job_id, position, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(job['filename'], job['job_name'], job['working_directory'], job['status'], job.get('job_id'), position, now)
+             for position, job in enumerate(dictionary_list)])
+    logging.info(f"Imported {len(dictionary_list)} jobs from {json_file_path}")
+    return len(dictionary_list)
+
+def export_sqlite_to_json(db, json_file_path):
+    """
+    Write the jobs of the job database to a JSON file in the batch_files.json format.
+    :param db: path of the database or an open sqlite3 connection
+    :param json_file_path: path of the JSON file to write
+    :return: number of jobs exported
+    """
+    connection = db if isinstance(db, sqlite3.Connection) else connect_job_db(db)
+    rows = connection.execute("SELECT filename, job_name, working_directory, status, job_id FROM jobs ORDER BY position").fetchall()
+    dictionary_list = []
+    for filename, job_name, working_directory, status, job_id in rows:
+        job = {"filename": filename, "job_name": job_name, "working_directory": working_directory, "status": status}
+        if job_id is not None:
+            job['job_id'] = job_id
+        dictionary_list.append(job)
+    update_json_file(dictionary_list, json_file_path)
+    return len(dictionary_list)
+
+_job_store = None
+
+def get_job_store():
+    """Return the job store held by the daemon, loading it on first use from the backend set in cfg.job_store_backend."""
+    global _job_store
+    if _job_store is None:
+        if cfg.job_store_backend == 'sqlite':
+            _job_store = SQLiteJobStore(cfg.sqlite_db_path, cfg.json_file_path).load()
+        else:
+            _job_store = JobStore(cfg.json_file_path).load()
+    return _job_store
+
+def handle_queued_files(ssh, job_store, folder_directory, snapshot=None):
     """Handle files in the _QUEUED directory and update the JSON entries."""
     queued_directory = os.path.join(folder_directory, '_QUEUED').replace("\\", "/")
     # find all files within mmseg-personal/tools/batch_files/_QUEUED directory
-    queued_files = rops.list_remote_files(ssh, queued_directory)
+    if snapshot is not None:
+        queued_files = list(snapshot['_QUEUED'])
+    else:
+        queued_files = rops.list_remote_files(ssh, queued_directory)
     print_green(f"Queued Files: {queued_files}")
 
     # For all batchfiles found in the directory, change the status to QUEUED
     for batch_file in queued_files:
-        for job in dictionary_list:
-            if job['filename'] == batch_file:
-                job['status'] = 'QUEUED'
-                break
+        job = job_store.get(batch_file)
+        if job is not None:
+            job_store.set_status(job, 'QUEUED')
+        elif snapshot is not None:
+            entry = snapshot['_QUEUED'][batch_file]
+            job_store.add({
+                "filename": batch_file,
+                "job_name": entry['job_name'],
+                "working_directory": entry['working_directory'],
+                "status": "QUEUED"
+            })
         else:
-            dictionary_list = process_new_queued_file(ssh, batch_file, queued_directory, dictionary_list)
-
-def process_new_queued_file(ssh, batch_file, queued_directory, dictionary_list):
-    """Process a new queued file and add it to the JSON dictionary list."""
-    stdin, stdout, stderr = ssh.exec_command(f"cat {queued_directory}/{batch_file}")
-    job_name = ""
-    working_directory = ""
-    error_out = stderr.read().decode().strip()
-    output = stdout.read().decode()
-    if error_out:
-        print_red("Error in updating JSON:" + str(error_out))
-        logging.error(f"Error in updating JSON:" + str(error_out))
-    for line in output:
-        line = line.strip()
-        if "#SBATCH --job-name=" in line:
-            job_name = line.replace('#SBATCH --job-name=', '').replace(' ', '')
-
-        if "python3 ~/mmseg-personal/tools/train.py" in line:
-            working_directory = line.replace('python3 ~/mmseg-personal/tools/train.py ~', '').replace('.py', '').split("/")[-1]
+            process_new_queued_file(ssh, batch_file, queued_directory, job_store)
+
+def process_new_queued_file(ssh, batch_file, queued_directory, job_store):
+    """Process a new queued file and add it to the job store."""
+    info = rops.get_batch_file_info(ssh, f"{queued_directory}/{batch_file}")
+    if info is None:
+        print_red(f"Error in updating JSON: could not read {queued_directory}/{batch_file}")
+        logging.error(f"Error in updating JSON: could not read {queued_directory}/{batch_file}")
+        info = {}
 
     new_job = {
         "filename": batch_file,
-        "job_name": job_name,
-        "working_directory": working_directory,
+        "job_name": info.get("job_name") or "",
+        "working_directory": info.get("working_directory") or "",
         "status": "QUEUED"
     }
-    dictionary_list.append(new_job)
+    job_store.add(new_job)
 
 
-def handle_running_files(ssh, dictionary_list, folder_directory):
+def handle_running_files(ssh, job_store, folder_directory, snapshot=None):
     """Handle files in the _RUNNING directory and update the JSON entries."""
     running_directory = os.path.join(folder_directory, '_RUNNING').replace("\\", "/")
     # find all files within mmseg-personal/tools/batch_files/_RUNNING directory
-    running_files = rops.list_remote_files(ssh, running_directory)
+    if snapshot is not None:
+        running_files = list(snapshot['_RUNNING'])
+    else:
+        running_files = rops.list_remote_files(ssh, running_directory)
     print(f"Running files: {running_files}")
-    squeue_jobs = rops.get_squeue_jobs(ssh)
+    jobs = [job_store.get(batch_file) for batch_file in running_files]
+    tracked_ids = [job['job_id'] for job in jobs if job is not None and job.get('job_id')]
+    # Only ask for the tracked job ids, unless some jobs were submitted before job ids were recorded
+    if len(tracked_ids) == len(running_files):
+        queue = sops.get_queue(ssh, tracked_ids)
+    else:
+        queue = sops.get_queue(ssh)
+    if snapshot is not None:
+        job_names = [snapshot['_RUNNING'][batch_file]['job_name'] for batch_file in running_files]
+    else:
+        running_paths = [os.path.join(running_directory, batch_file).replace("\\", "/") for batch_file in running_files]
+        batch_file_infos = rops.get_batch_file_infos(ssh, running_paths)
+        job_names = [batch_file_infos[path]["job_name"] if batch_file_infos[path] else None for path in running_paths]
+    squeue_job_names = {squeue_job['name'] for squeue_job in queue.values()}
+    # Tracked jobs that left the queue: sacct tells how they ended
+    terminal_states = sops.get_terminal_states(ssh, [job_id for job_id in tracked_ids if job_id not in queue])
 
-    for batch_file in running_files:
-        process_running_file(ssh, batch_file, dictionary_list, running_directory, squeue_jobs, folder_directory)
-
-def process_running_file(ssh, batch_file, dictionary_list, running_directory, squeue_jobs, folder_directory):
-    """Process a single running file and update its status in the JSON dictionary list."""
-    job_found = False
-    job_name = rops.get_job_name_from_batch_file(ssh, os.path.join(running_directory, batch_file).replace("\\", "/"))
-
-    for squeue_job in squeue_jobs:
-        if squeue_job['name'] == job_name:
-            for json_job in dictionary_list:
-                if json_job['filename'] == batch_file:
-                    json_job['status'] = 'RUNNING'
-                    job_found = True
-                    break
-    if not job_found:
-        update_job_status_on_error_or_completion(ssh, batch_file, dictionary_list, running_directory, folder_directory)
+    for batch_file, job_name in zip(running_files, job_names):
+        process_running_file(ssh, batch_file, job_name, job_store, running_directory, squeue_job_names, folder_directory,
+                             snapshot, queue, terminal_states)
 
-def handle_error_files(ssh, dictionary_list, folder_directory):
+def process_running_file(ssh, batch_file, job_name, job_store, running_directory, squeue_job_names, folder_directory,
+                         snapshot=None, queue=None, terminal_states=None):
+    """
+    Process a single running file and update its status in the job store.
+    Jobs with a SLURM job id are looked up by id in the queue and, once they left it, classified by their
+    sacct state. Jobs without one are matched by name and classified by the marker files in their work dir.
+    """
+    job = job_store.get(batch_file)
+    job_id = job.get('job_id') if job is not None else None
+    if job_id and queue is not None:
+        if job_id in queue:
+            job_store.set_status(job, 'RUNNING')
+            return
+        terminal_state = (terminal_states or {}).get(job_id)
+        if terminal_state is not None and terminal_state['status'] is not None:
+            logging.info(f"Job {job_id} ({batch_file}) ended as {terminal_state['state']} with exit code {terminal_state['exit_code']}")
+            set_terminal_status(ssh, job, terminal_state['status'], job_store, running_directory, folder_directory)
+            return
+        # sacct does not know the job (yet), fall back to the marker files
+    elif job_name in squeue_job_names and job is not None:
+        job_store.set_status(job, 'RUNNING')
+        return
+    update_job_status_on_error_or_completion(ssh, batch_file, job_store, running_directory, folder_directory, snapshot)
+
+# Marker file of a job that ended without finishing its training
+ERROR_MARKER_FILE = 'error_occurred.txt'
+
+def set_terminal_status(ssh, job, status, job_store, current_directory, folder_directory):
+    """
+    Set the status SLURM reported for a job that left the queue and move its batch file.
+    A COMPLETED job only counts as completed if the training wrote its own completion marker. A job that
+    exited 0 with in_progress.txt still in place (or no marker at all) did not finish training and is an ERROR.
+    For an ERROR the in_progress.txt marker is replaced by error_occurred.txt, so the marker based handlers
+    agree with SLURM.
+    """
+    if job['working_directory']:
+        work_dir_path = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, job['working_directory']).replace("\\", "/")
+        mark_error = (f"if [ -f in_progress.txt ]; then mv in_progress.txt {ERROR_MARKER_FILE}; "
+                      f"elif [ ! -f {ERROR_MARKER_FILE} ] && [ ! -f extracted.txt ] && [ ! -f {cfg.FINISHED_MARKER_FILE} ]; then touch {ERROR_MARKER_FILE}; fi; "
+                      f"echo ERROR")
+        if status == 'COMPLETED':
+            command = (f"cd {work_dir_path} && if [ -f {cfg.COMPLETED_MARKER_FILE} ] || [ -f extracted.txt ] || [ -f {cfg.FINISHED_MARKER_FILE} ]; "
+                       f"then echo COMPLETED; else {mark_error}; fi")
+        else:
+            command = f"cd {work_dir_path} && {mark_error}"
+        stdin, stdout, stderr = ssh.exec_command(command)
+        output = stdout.read().decode().strip()
+        error = stderr.read().decode().strip()
+        if error:
+            logging.error(f"Error updating the marker file in {work_dir_path}: {error}")
+        if status == 'COMPLETED' and output == 'ERROR':
+            print_red(f"{job['filename']} exited successfully without writing {cfg.COMPLETED_MARKER_FILE}, marking it as ERROR")
+            logging.error(f"{job['filename']} ended as COMPLETED in SLURM but its training did not write "
+                          f"{cfg.COMPLETED_MARKER_FILE}, marking it as ERROR")
+            status = 'ERROR'
+    else:
+        # Without a work dir the path would be the work_dirs root, the marker would be touched there
+        logging.error(f"No working directory known for {job['filename']}, not updating its marker file")
+    job_store.set_status(job, status)
+    rops.move_batch_file(
+        ssh,
+        os.path.join(current_directory, job['filename']).replace("\\", "/"),
+        os.path.join(folder_directory, '_' + status).replace("\\", "/")
+    )
+
+def handle_error_files(ssh, job_store, folder_directory, snapshot=None):
     """Handle files in the _ERROR directory and update the JSON entries."""
     error_directory = os.path.join(folder_directory, '_ERROR').replace("\\", "/")
-    error_files = rops.list_remote_files(ssh, error_directory)
+    if snapshot is not None:
+        error_files = list(snapshot['_ERROR'])
+    else:
+        error_files = rops.list_remote_files(ssh, error_directory)
     print_red(f"Error files: {error_files}")
 
     for batch_file in error_files:
-        update_job_status_on_error_or_completion(ssh, batch_file, dictionary_list, error_directory, folder_directory)
+        update_job_status_on_error_or_completion(ssh, batch_file, job_store, error_directory, folder_directory, snapshot)
 
-def handle_completed_files(ssh, dictionary_list, folder_directory):
+def handle_completed_files(ssh, job_store, folder_directory, snapshot=None):
     """Handle files in the _COMPLETED directory and update the JSON entries."""
     completed_directory = os.path.join(folder_directory, '_COMPLETED').replace("\\", "/")
-    completed_files = rops.list_remote_files(ssh, completed_directory)
+    if snapshot is not None:
+        completed_files = list(snapshot['_COMPLETED'])
+    else:
+        completed_files = rops.list_remote_files(ssh, completed_directory)
     print_green(f"Completed Files: {completed_files}")
 
     for batch_file in completed_files:
-        update_job_status_on_error_or_completion(ssh, batch_file, dictionary_list, completed_directory, folder_directory)
+        update_job_status_on_error_or_completion(ssh, batch_file, job_store, completed_directory, folder_directory, snapshot)
 
-def update_job_status_on_error_or_completion(ssh, batch_file, dictionary_list, current_directory, folder_directory):
+def update_job_status_on_error_or_completion(ssh, batch_file, job_store, current_directory, folder_directory, snapshot=None):
     """Update job status based on the presence of specific marker files."""
-    for job in dictionary_list:
-        if job['filename'] == batch_file:
-            work_dir_path = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, job['working_directory']).replace("\\", "/")
-            for marker_file, status, destination in [
-                ('error_occurred.txt', 'ERROR', '_ERROR'),
-                ('in_progress.txt', 'RUNNING', '_RUNNING'),
-                (cfg.COMPLETED_MARKER_FILE, 'COMPLETED', '_COMPLETED'),
-                (cfg.FINISHED_MARKER_FILE, 'FINISHED', '_FINISHED'),
-            ]:
-                command = f"find {work_dir_path} -type f -name '{marker_file}'"
-                stdin, stdout, stderr = ssh.exec_command(command)
-                if stdout.read().decode().strip():
-                    job['status'] = status
-                    rops.move_batch_file(
-                        ssh,
-                        os.path.join(current_directory, batch_file).replace("\\", "/"),
-                        os.path.join(folder_directory, destination).replace("\\", "/")
-                    )
-                    break
+    job = job_store.get(batch_file)
+    if job is None:
+        return
+    work_dir_path = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, job['working_directory']).replace("\\", "/")
+    marker_statuses = [
+        ('error_occurred.txt', 'ERROR', '_ERROR'),
+        ('in_progress.txt', 'RUNNING', '_RUNNING'),
+        (cfg.COMPLETED_MARKER_FILE, 'COMPLETED', '_COMPLETED'),
+        (cfg.FINISHED_MARKER_FILE, 'FINISHED', '_FINISHED'),
+    ]
+    if snapshot is not None:
+        markers = snapshot[os.path.basename(current_directory)][batch_file]['markers']
+        markers_found = [marker_file in markers for marker_file, _, _ in marker_statuses]
+    else:
+        # Look for all marker files at once instead of one find after the other
+        results = rops.run_remote_commands(ssh, [f"find {work_dir_path} -type f -name '{marker_file}'" for marker_file, _, _ in marker_statuses])
+        markers_found = [bool(stdout.strip()) for stdout, stderr in results]
+    for (marker_file, status, destination), marker_found in zip(marker_statuses, markers_found):
+        if marker_found:
+            job_store.set_status(job, status)
+            rops.move_batch_file(
+                ssh,
+                os.path.join(current_directory, batch_file).replace("\\", "/"),
+                os.path.join(folder_directory, destination).replace("\\", "/")
+            )
+            break
 
-def handle_finished_files(ssh, dictionary_list, folder_directory):
+def handle_finished_files(ssh, job_store, folder_directory, snapshot=None):
     """Handle files in the _FINISHED directory and update the JSON entries."""
     finished_directory = os.path.join(folder_directory, '_FINISHED').replace("\\", "/")
-    finished_files = rops.list_remote_files(ssh, finished_directory)
+    if snapshot is not None:
+        finished_files = list(snapshot['_FINISHED'])
+    else:
+        finished_files = rops.list_remote_files(ssh, finished_directory)
 
-    for batch_file in finished_files:
-        process_finished_file(ssh, batch_file, dictionary_list, finished_directory)
-
-def process_finished_file(ssh, batch_file, dictionary_list, finished_directory):
-    """Process a single finished file and update its status in the JSON dictionary list."""
-    work_dir_name = rops.get_python_file_name_from_batch_file(ssh, os.path.join(finished_directory, batch_file).replace("\\", "/"))
-    work_dir = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, work_dir_name).replace("\\", "/")
-    command = f"find {work_dir} -maxdepth 1 -name extracted.txt"
-    stdin, stdout, stderr = ssh.exec_command(command)
-    if stdout.read().decode().strip():
-        for job in dictionary_list:
-            if job['filename'] == batch_file:
-                job['status'] = 'FINISHED'
-                break
+    if snapshot is not None:
+        work_dir_names = [snapshot['_FINISHED'][batch_file]['working_directory'] for batch_file in finished_files]
+    else:
+        finished_paths = [os.path.join(finished_directory, batch_file).replace("\\", "/") for batch_file in finished_files]
+        batch_file_infos = rops.get_batch_file_infos(ssh, finished_paths)
+        work_dir_names = [batch_file_infos[path]["working_directory"] if batch_file_infos[path] else None for path in finished_paths]
+    # Only the remote checks run concurrently. The caller holds the store lock, which the worker threads
+    # could not take, so the status changes are made from this thread
+    extracted = rops.run_concurrently(lambda item: is_finished_file_extracted(ssh, item[0], item[1], snapshot),
+                                      zip(finished_files, work_dir_names))
+    for batch_file, is_extracted in zip(finished_files, extracted):
+        if is_extracted:
+            job_store.set_status(job_store.get(batch_file), 'FINISHED')
+
+def is_finished_file_extracted(ssh, batch_file, work_dir_name, snapshot=None):
+    """Return True if the work dir of a finished batch file has extracted.txt."""
+    if snapshot is not None:
+        return 'extracted.txt' in snapshot['_FINISHED'][batch_file]['markers']
+    if work_dir_name:
+        work_dir = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, work_dir_name).replace("\\", "/")
+        command = f"find {work_dir} -type f -name extracted.txt"
+        stdin, stdout, stderr = ssh.exec_command(command)
+        return bool(stdout.read().decode().strip())
+    return False
 
-def update_json_file(dictionary_list):
+def update_json_file(dictionary_list, json_file_path=None):
     """Write back the updated JSON file."""
-    with open(cfg.json_file_path, 'w') as json_file:
+    json_file_path = json_file_path or cfg.json_file_path
+    # Write to a temporary file first so a crash mid-write never corrupts the existing file
+    with open(json_file_path + '.tmp', 'w') as json_file:
         json.dump(dictionary_list, json_file, indent=4)
-    logging.info(f"Updated {cfg.json_file_path}")
+    os.replace(json_file_path + '.tmp', json_file_path)
+    logging.info(f"Updated {json_file_path}")
+
+def load_job_history(history_path=None, journal_path=None):
+    """
+    Read the recorded status changes from the history file and the current journal.
+    :return: dict of {filename: [(time, status), ...]} in the order the changes happened
+    """
+    history = defaultdict(list)
+    journal_path = journal_path or cfg.job_journal_path
+    # Records of a running compaction are in neither the history nor the journal yet
+    for path in [history_path or cfg.job_history_path, journal_path + '.compacting', journal_path]:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as records_file:
+            for line in records_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record['event'] == 'add':
+                    history[record['job']['filename']].append((record['time'], record['job']['status']))
+                elif record['event'] == 'status':
+                    history[record['filename']].append((record['time'], record['status']))
+    return dict(history)
 
-def count_job_statuses(dictionary_list):
+def count_job_statuses(job_store):
     """Count the number of jobs in each status category and print the summary."""
-    status_counter = {}
-    for item in dictionary_list:
-        status = item["status"]
-        if status in status_counter:
-            status_counter[status] += 1
-        else:
-            status_counter[status] = 1
-    print(f"STATUS DICTIONARY:\nFinished = {status_counter.get('FINISHED', 0)} \nCompleted = {status_counter.get('COMPLETED', 0)} "
-          f"\nError = {status_counter.get('ERROR', 0)} \nRunning = {status_counter.get('RUNNING', 0)} \nQueued = {status_counter.get('QUEUED', 0)}")
-    return status_counter.get('FINISHED', 0), status_counter.get('COMPLETED', 0), status_counter.get('ERROR', 0), status_counter.get('RUNNING', 0), status_counter.get('QUEUED', 0)
+    finished, completed, error, running, queued = job_store.status_counts()
+    print(f"STATUS DICTIONARY:\nFinished = {finished} \nCompleted = {completed} "
+          f"\nError = {error} \nRunning = {running} \nQueued = {queued}")
+    return finished, completed, error, running, queued
 
-def update_json_new(ssh):
-    """Main function to update the JSON file based on remote directory contents."""
-    dictionary_list = load_or_create_json()
+def update_json_new(ssh, use_snapshot=True):
+    """
+    Main function to update the JSON file based on remote directory contents.
+
+    :param use_snapshot: collect the remote state with a single command (rops.get_batch_file_snapshot)
+                         and reconcile against it instead of running ls/cat/find for every batch file.
+    """
+    job_store = get_job_store()
     # From ~/mmseg-personal/tools/batch_files
     folder_directory = os.path.join(cfg.REMOTE_WORKING_PROJECT, *cfg.REMOTE_BATCH_FILE_LOCATION.split('/')[:-1]).replace("\\", "/")
     print_blue(f"- Updating JSON file: {cfg.json_file_path} -")
+    snapshot = rops.get_batch_file_snapshot(ssh, folder_directory) if use_snapshot else None
 
-    handle_queued_files(ssh, dictionary_list, folder_directory)
-    handle_running_files(ssh, dictionary_list, folder_directory)
-    handle_error_files(ssh, dictionary_list, folder_directory)
-    handle_completed_files(ssh, dictionary_list, folder_directory)
-    handle_finished_files(ssh, dictionary_list, folder_directory)
+    # Reconcile as one unit so other worker threads never see a half updated store
+    with job_store.locked():
+        handle_queued_files(ssh, job_store, folder_directory, snapshot)
+        handle_running_files(ssh, job_store, folder_directory, snapshot)
+        handle_error_files(ssh, job_store, folder_directory, snapshot)
+        handle_completed_files(ssh, job_store, folder_directory, snapshot)
+        handle_finished_files(ssh, job_store, folder_directory, snapshot)
 
-    update_json_file(dictionary_list)
-    return count_job_statuses(dictionary_list)
+        job_store.persist()
+        return count_job_statuses(job_store)
 
 def create_json(ssh):
     base_dir = '/'.join(os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION).replace("\\", "/").split('/')[:-1])
@@ -210,16 +759,9 @@ def create_json(ssh):
     }
     
     # Open json file to check which files are already accounted for. 
-    dictionary_list = []
     #cfg.json_file_path = 'batch_files.json'
     # logging.info(f"- create_json(): Comparing batch files found in {base_dir} and {cfg.json_file_path}")
-    if os.path.exists(cfg.json_file_path):
-        logging.info(f"Found a premade JSON file for batch_files at {cfg.json_file_path}")
-        with open(cfg.json_file_path, 'r') as json_file:
-            dictionary_list = json.load(json_file)
-    
-    # populate list of files that are found in the json file
-    existing_filenames = {entry['filename'] for entry in dictionary_list}
+    job_store = get_job_store()
     
     # Iterate over each status directory
     for sub_dir, status in status_directories.items():
@@ -232,6 +774,7 @@ def create_json(ssh):
         logging.info(f"    Executing: cd {remote_dir}; ls -l")
         stdin, stdout, stderr = ssh.exec_command(f'cd {remote_dir}; ls -l')
         
+        new_filenames = []
         for counter, line in enumerate(stdout):
             if counter == 0:
                 continue
@@ -244,46 +787,35 @@ def create_json(ssh):
                 filename = parts[8]
                     
             # Determine which files already were found in the json file
-                if filename in existing_filenames:
+                if filename in job_store:
                     print_red(f"File {filename} is already in the JSON file.")
             # Removed logging of existing json files because its a lot of files  
                     #logging.info(f"File {filename} is already in the JSON file.")
                     continue
+                new_filenames.append(filename)
+
+        # Extract the job names from the batch files that are not already found in the JSON file
+        batch_file_infos = rops.get_batch_file_infos(ssh, [f"{remote_dir}/{filename}" for filename in new_filenames])
+        for filename in new_filenames:
+            info = batch_file_infos[f"{remote_dir}/{filename}"]
+            if info is None:
+                print_red(f"Error in creating JSON: could not read {remote_dir}/{filename}")
+                logging.error(f"Error in creating JSON: could not read {remote_dir}/{filename}")
+                info = {}
                 
-                # Extract the job names from the batch files to add into the json file if the fileis not already found in the JSON file
-                logging.info(f"    Executing: cat {remote_dir}/{filename}")
-                print(f'Running Command: cat {remote_dir}/{filename}')
-                stdin, stdout, stderr = ssh.exec_command(f'cat {remote_dir}/{filename}')
-                job_name = ""
-                working_directory = ""
-                if stderr:
-                    print_red("Error in creating JSON:" + str(stderr.read().decode().strip()))
-                    logging.error(f"Error in creating JSON:" + str(stderr.read().decode().strip()))
-                for line in stdout:
-                    line = line.strip()
-                    if "#SBATCH --job-name=" in line:
-                        job_name = line.replace('#SBATCH --job-name=', '').replace(' ', '')
-
-                    if "python3 ~/mmseg-personal/tools/train.py" in line:
-                        working_line = line.replace('python3 ~/mmseg-personal/tools/train.py ~', '').replace('.py', '').split("/")
-                        working_length = len(working_line)
-                        working_directory = working_line[working_length - 1]
-                
-                file_dict = {
-                    'filename': filename,
-                    'job_name': job_name,
-                    'working_directory': working_directory,
-                    'status': status
-                }
-                
-                # Add new files to the json file to keep track of which files are run
-                dictionary_list.append(file_dict)
-                existing_filenames.add(filename)
-                print_green(f"Added file {filename} to the JSON file.")
-                logging.info(f"Added file {filename} to the JSON file.")
+            file_dict = {
+                'filename': filename,
+                'job_name': info.get('job_name') or '',
+                'working_directory': info.get('working_directory') or '',
+                'status': status
+            }
+            
+            # Add new files to the json file to keep track of which files are run
+            job_store.add(file_dict)
+            print_green(f"Added file {filename} to the JSON file.")
+            logging.info(f"Added file {filename} to the JSON file.")
     
-    with open(cfg.json_file_path, 'w') as json_file:
-        json.dump(dictionary_list, json_file, indent=4)
+    job_store.persist(force=True)
 
 def update_json_new_v1(ssh):
     
@@ -526,40 +1058,19 @@ def update_json_new_v1(ssh):
 def set_status_of_batch_file(status, batch_file='', job_name='', working_directory=''):
     """
     Sets the status of a job based on the provided batch_file, job_name, or working_directory.
+    The change is made in the job store and written to the JSON file on the next persist().
 
     :param status: New status to set.
     :param batch_file: (optional) The filename of the batch file to identify the job.
     :param job_name: (optional) The job name to identify the job.
     :param working_directory: (optional) The working directory to identify the job.
     """
-    # Read the JSON file if it exists
-    if os.path.exists(cfg.json_file_path):
-        with open(cfg.json_file_path, 'r') as json_file:
-            dictionary_list = json.load(json_file)
-    else:
-        raise FileNotFoundError(f"JSON file not found at path: {cfg.json_file_path}")
-
-    # Update the status for the first match found based on the provided identifiers
-    job_found = False
-    for job in dictionary_list:
-        if batch_file != '' and job["filename"] == batch_file:
-            job["status"] = status
-            job_found = True
-            break
-        elif job_name != '' and job["job_name"] == job_name:
-            job["status"] = status
-            job_found = True
-            break
-        elif working_directory != '' and job["working_directory"] == working_directory:
-            job["status"] = status
-            job_found = True
-            break
+    job_store = get_job_store()
+    job = job_store.get(batch_file, job_name, working_directory)
 
-    # Write back to the JSON file if a job was found and updated
-    if job_found:
+    if job is not None:
+        job_store.set_status(job, status)
         logging.info(f"Updated {job['filename']} to status {job['status']}")
-        with open(cfg.json_file_path, 'w') as json_file:
-            json.dump(dictionary_list, json_file, indent=4)
     else:
         print_red(f"No job found with the given identifiers: batch_file='{batch_file}', job_name='{job_name}', working_directory='{working_directory}'.")
         logging.error(f"No job found with the given identifiers: batch_file='{batch_file}', job_name='{job_name}', working_directory='{working_directory}'. "\
@@ -579,3 +1090,15 @@ def find_sbatch_files_from_json():
         return existing_filenames
     logging.error("JSON file is not found")
     return None
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Convert the job registry between batch_files.json and the SQLite job database")
+    parser.add_argument('direction', choices=['import', 'export'],
+                        help='import copies the JSON file into the database, export writes the database to the JSON file')
+    parser.add_argument('--json_file', type=str, default=cfg.json_file_path, help='Path of the batch_files JSON file')
+    parser.add_argument('--db_file', type=str, default=cfg.sqlite_db_path, help='Path of the SQLite job database')
+    args_out = parser.parse_args()
+    if args_out.direction == 'import':
+        print_green(f"Imported {import_json_to_sqlite(args_out.json_file, args_out.db_file)} jobs into {args_out.db_file}")
+    else:
+        print_green(f"Exported {export_sqlite_to_json(args_out.db_file, args_out.json_file)} jobs to {args_out.json_file}")
@@ -2,6 +2,7 @@ import os
 import json
 import csv
 import ast
+import sqlite3
 from argparse import ArgumentParser
 
 def find_largest_pth_file(directory):
@@ -121,10 +122,26 @@ def parse_config_file(config_path):
 
 
 
-def create_csv_from_model_outputs(model_outputs_dir, output_csv_path):
+def load_job_statuses(job_db_path):
+    """
+    Reads the status of every job from the monitor's SQLite job database.
+    The database is opened read-only, so this can run while the monitor daemon is writing to it.
+    Returns a dict of {working_directory: status}.
+    """
+    connection = sqlite3.connect(f"file:{job_db_path}?mode=ro", uri=True, timeout=30)
+    try:
+        rows = connection.execute("SELECT working_directory, status FROM jobs").fetchall()
+    finally:
+        connection.close()
+    return {working_directory: status for working_directory, status in rows}
+
+def create_csv_from_model_outputs(model_outputs_dir, output_csv_path, job_db_path=None):
     """
     Creates a CSV file summarizing the model outputs and config details.
+    If job_db_path is given, the job status from the monitor's job database is added as a column.
     """
+    job_statuses = load_job_statuses(job_db_path) if job_db_path else None
+
     # Prepare CSV header
     headers = ['Model Name']
     config_headers = ['pretrained', 'backbone', 'decode_head', 'auxiliary_head', 'optimizer',
@@ -143,6 +160,8 @@ def create_csv_from_model_outputs(model_outputs_dir, output_csv_path):
         if not os.path.isdir(subdir_path):
             continue
         row = [subdir]
+        if job_statuses is not None:
+            row.append(job_statuses.get(subdir, 'N/A'))
 
         # Find and parse the config file
         config_file = os.path.join(subdir_path, f"{subdir}.py")
@@ -175,6 +194,8 @@ def create_csv_from_model_outputs(model_outputs_dir, output_csv_path):
             # Save metrics keys for CSV header
             if first_metrics is None:
                 first_metrics = list(metrics.keys())
+                if job_statuses is not None:
+                    headers.append('Job Status')
                 headers.extend(config_headers)
                 headers.extend(memory_header)
                 headers.extend(first_metrics)
@@ -197,8 +218,11 @@ if __name__ == '__main__':
     parser.add_argument('--output_file_location', type=str, 
                         help='Location to output the csv file. It will place the file in the current directory by default', 
                         default='./model_outputs_summary.csv')
+    parser.add_argument('--job_db', type=str,
+                        help='Path to the SQLite job database of the monitor (batch_files.db) to add the job status of each model',
+                        default=None)
     args_out = parser.parse_args()
-    create_csv_from_model_outputs(args_out.model_out_dir, args_out.output_file_location)
+    create_csv_from_model_outputs(args_out.model_out_dir, args_out.output_file_location, args_out.job_db)
     # Usage
     # model_outputs_dir = '/mnt/e/Corrosion/model_outputs/'  # Change this to your actual model outputs directory
     # output_csv_path = '/mnt/e/Corrosion/model_outputs/model_outputs_summary.csv'  # Change this to your desired output CSV file path
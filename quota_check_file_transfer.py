@@ -5,14 +5,20 @@ import os
 import re
 import subprocess
 from dotenv import load_dotenv
-import schedule
 import json
+import threading
 import traceback
 from collections import defaultdict
 # import utils
 import json_utils
 import config as cfg
 import remote_operations as rops
+import slurm_operations as sops
+import transfer_operations as tops
+import quota_manager
+import credential_manager
+import evaluation_operations as eops
+from scheduler import AdaptiveScheduler
 '''
 To make use of the dotenv() command, create a new file labelled ".env" and fill in the blanks as needed:
 netid=[username]
@@ -51,6 +57,10 @@ logging.basicConfig(filename='storage_monitor.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 last_status_counts = None
+scheduler = None
+# Guards queued_jobs/seen_batch_files, the job status handlers and every remote batch file move of the
+# monitoring, submission and extraction pipelines
+batch_file_lock = threading.RLock()
 
 global queued_jobs
 global seen_batch_files
@@ -68,40 +78,20 @@ def print_blue(text):
     print(f"\033[38;2;50;128;128m{text}\033[0m")
 
 # COMPLETED
-def check_storage_usage(ssh):
+def check_storage_usage(ssh, running_jobs=0):
     # logging.info("check_storage_usage(ssh) ")
-    # Command run to get the storage used by the user
-    stdin, stdout, stderr = ssh.exec_command('quota -vs')
-    output = stdout.read().decode()
-    
-    # Parse the output to get the percentage used
-    lines = output.splitlines()  # Split the output into lines
-
-    for i, line in enumerate(lines):
-        if 'communis.lcsr.rutgers.edu:/common/home' in line:
-            # Move to the next line after the matched line
-            next_line = lines[i + 1]
-
-            # Extract space and quota (assume it's the first and second items in the next line)
-            match = re.search(r'(\d+M)\s+(\d+M)', next_line)
-            if match:
-                used_space_str = match.group(1)
-                total_quota_str = match.group(2)
-
-                # Convert these to integers
-                used_space = int(used_space_str.replace("M", ""))
-                total_quota = int(total_quota_str.replace("M", ""))
-
-                # Calculate the usage percentage
-                usage_percentage = (used_space / total_quota) * 100
-
-                print_green(f"Usage Percentage: {usage_percentage:.2f}%")
-                logging.info(f"Usage Percentage: {usage_percentage:.2f}%")
-                return usage_percentage
-
-    print_red("Could not determine storage usage.")
-    logging.error("Could not determine storage usage.")
-    return None  # If the line wasn't found
+    # Get the storage used by the user. quota -vs is only run when the cached result of the quota manager is too old
+    sample = quota_manager.get_quota_manager().sample(ssh, running_jobs)
+    if sample is None:
+        print_red("Could not determine storage usage.")
+        logging.error("Could not determine storage usage.")
+        return None  # If the line wasn't found
+
+    # Calculate the usage percentage
+    usage_percentage = (sample["used_mb"] / sample["quota_mb"]) * 100
+    print_green(f"Usage Percentage: {usage_percentage:.2f}%")
+    logging.info(f"Usage Percentage: {usage_percentage:.2f}%")
+    return usage_percentage
 # COMPLETED
 def find_directories_to_move(ssh):
     # logging.info("find_directories_to_move()")
@@ -120,85 +110,46 @@ def find_directories_to_move(ssh):
     
     output = stdout.read().decode().strip().split('\n')
     # logging.info(f"Directories to move: {output}")
+    # The evaluation job still reads the checkpoint and writes its results into the directory
+    evaluating = eops.pending_evaluations()
     for line in output:
         if line:  # Make sure it's not an empty line
             directory = os.path.dirname(line)
+            if os.path.basename(directory) in evaluating:
+                logging.info(f"Not moving {directory} yet, its evaluation is still running")
+                continue
             directories_to_move.append(directory)
             print_green(f"Found directory to move: {directory}")
             logging.info(f"Found directory to move: {directory}")
     
     return directories_to_move
+def plan_directories_to_move(ssh, directories, mb_to_free):
+    """
+    Only offload as many finished directories as needed to free mb_to_free, the rest are deferred to a later offload.
+    Transfers that are still running count towards the freed space.
+    """
+    sizes = rops.get_directory_sizes(ssh, directories)
+    if len(sizes) < len(directories):
+        logging.error(f"Could not get the size of {set(directories) - set(sizes)}, moving every finished directory")
+        return directories
+    pending = tops.get_transfer_manager().pending()
+    in_flight_mb = sum(size for directory, size in sizes.items() if directory in pending)
+    candidates = {directory: size for directory, size in sizes.items() if directory not in pending}
+    planned, deferred = quota_manager.plan_offload(candidates, mb_to_free - in_flight_mb)
+    print_blue(f"Offloading {len(planned)} directories ({sum(sizes[d] for d in planned):.0f} MB) to free {mb_to_free:.0f} MB, "
+               f"{in_flight_mb:.0f} MB already in transfer, deferring {len(deferred)}")
+    logging.info(f"Offload plan: free {mb_to_free:.0f} MB, {in_flight_mb:.0f} MB in transfer, planned {planned}, deferred {deferred}")
+    return planned
 # COMPLETED
-def move_directories(ssh, directories):
+def move_directories(ssh, directories, wait=True):
     # logging.info(f" move_directories({directories})")
     # This method is used to sync file contents from remote to local pc. It then removes after files have been synced
-    for directory in directories:
-        try:
-            # Use subprocess to run rsync and capture output
-            # COMMAND FOR LINUX PC
-            if cfg.linux:
-                logging.info(f"    Executing: rsync -avz '{cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory}', {cfg.LOCAL_PATH}")
-                print_red(f"Executing: rsync -avz '{cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory}', {cfg.LOCAL_PATH}")
-                # UNCOMMENT SSHPASS LINE IF RUNNING ON LAB PC                
-                command = [
-                    'sshpass', '-p', cfg.PASSWORD,
-                    'rsync', '-avz',
-                    f'{cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory}', cfg.LOCAL_PATH
-                ]
-                result_rsync = subprocess.run(command, capture_output=True, text=True)
-
-                # Check if rsync was successful                
-                if result_rsync.returncode != 0:
-                    logging.error(f"rsync failed with error: {result_rsync.stderr}")
-                    raise Exception(f"rsync failed with error: {result_rsync.stderr}")
-                
-            if cfg.windows:
-                # # Construct the plink command to move the directory on the remote machine (e.g., using mv or scp)
-                # # If you're moving the directory remotely, you might want to use mv command.
-                # remote_command = f"mv {directory} {LOCAL_PATH}"
-
-                # # Run the plink command to execute the move on the remote server
-                # plink_cmd = [PLINK_PATH, "-pw", PASSWORD, f"{USERNAME}@{REMOTE_HOST}", remote_command]
-                # result_move = subprocess.run(plink_cmd, capture_output=True, text=True)
-
-                # if result_move.returncode != 0:
-                #     logging.error(f"mv command failed with error: {result_move.stderr}")
-                #     raise Exception(f"mv {directory} {LOCAL_PATH}  failed with error: {result_move.stderr}")
-
-                # Use pscp to copy the remote directory to the local machine
-                pscp_cmd = [cfg.PSCP_PATH, "-r", "-pw", cfg.PASSWORD, f"{cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory}", cfg.LOCAL_PATH]
-                result_scp = subprocess.run(pscp_cmd, capture_output=True, text=True)
-
-                if result_scp.returncode != 0:
-                    logging.error(f"scp command failed with error: {result_scp.stderr}")
-                    raise Exception(f"scp failed with error: {result_scp.stderr}")
-
-                # # Optionally, remove the remote directory after copying to ensure it was successfully moved
-                # remove_command = f"rm -rf {directory}"
-                # plink_cmd_remove = [PLINK_PATH, "-pw", PASSWORD, f"{USERNAME}@{REMOTE_HOST}", remove_command]
-                # result_remove = subprocess.run(plink_cmd_remove, capture_output=True, text=True)  
-
-                # if result_remove.returncode != 0:
-                #     logging.error(f"mv command failed with error: {result_remove.stderr}")
-                #     raise Exception(f"rsync failed with error: {result_remove.stderr}")
-
-            print_green(f"Moved directory {directory} to local machine: {cfg.LOCAL_PATH}")
-            logging.info(f"Moved directory {directory} to local machine: {cfg.LOCAL_PATH}")
-            
-            # Remove the directory on the remote machine after successful transfer
-            logging.info(f"    Executing: rm -rf {directory}")
-            print_red(f"Executing: rm -rf {directory}")
-            stdin, stdout, stderr = ssh.exec_command(f'rm -rf {directory}')
-            error = stderr.read().decode().strip()
-            if error:
-                raise Exception(f"Failed to remove directory {directory} on remote machine: {error}")
-
-            print_green(f"Removed directory {directory} from remote machine.")
-            logging.info(f"Removed directory {directory} from remote machine.")
-        
-        except Exception as e:
-            print_red(f"Error processing directory {directory}: {e}")
-            logging.error(f"Error processing directory {directory}: {e}")
+    # The directories are copied by the concurrent, bandwidth capped workers of the transfer manager
+    transfer_manager = tops.get_transfer_manager()
+    queued = [directory for directory in directories if transfer_manager.submit(directory)]
+    if wait:
+        transfer_manager.wait()
+    return queued
 # COMPLETED  
 def check_batch_files(ssh, jobs):
     base_dir = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION).replace("\\", "/")
@@ -206,24 +157,46 @@ def check_batch_files(ssh, jobs):
     
     dirs_to_check = [d for d in rops.list_remote_directories(ssh, base_dir) if d.startswith('_')]
     # logging.info(f"Checking batch_files in {base_dir} in these directories: {dirs_to_check}")
+    batch_files = []
     for dir_name in dirs_to_check:
         full_dir_path = os.path.join(base_dir, dir_name).replace("\\", "/")
         for filename in rops.list_remote_files(ssh, full_dir_path):
-            batch_file_path = os.path.join(full_dir_path, filename).replace("\\", "/")
-            job_name = rops.get_job_name_from_batch_file(ssh, batch_file_path)
-            # print(job_name)
-            matching_job = next((job for job in jobs if job["name"] == job_name), None)
-            # Determine if any running job from the batch file directory that isn't already in _RUNNING is moved to _RUNNING 
-            if matching_job:
-                if dir_name != "_RUNNING":
-                    rops.move_batch_file(ssh, batch_file_path, os.path.join(base_dir, "_RUNNING").replace("\\", "/"))
-                    json_utils.set_status_of_batch_file("RUNNING", os.path.basename(batch_file_path))
-                    remove_job(os.path.basename(batch_file_path))
-            else:
-                check_and_handle_non_running_job(ssh, job_name, batch_file_path, base_dir)
+            batch_files.append((dir_name, os.path.join(full_dir_path, filename).replace("\\", "/")))
+    # Read the job names of all batch files at once, only files not seen before are downloaded
+    batch_file_infos = rops.get_batch_file_infos(ssh, [batch_file_path for dir_name, batch_file_path in batch_files])
+
+    for dir_name, batch_file_path in batch_files:
+        info = batch_file_infos[batch_file_path]
+        job_name = info["job_name"] if info else None
+        # print(job_name)
+        matching_job = find_squeue_job(jobs, os.path.basename(batch_file_path), job_name)
+        # Determine if any running job from the batch file directory that isn't already in _RUNNING is moved to _RUNNING 
+        if matching_job:
+            if dir_name != "_RUNNING":
+                rops.move_batch_file(ssh, batch_file_path, os.path.join(base_dir, "_RUNNING").replace("\\", "/"))
+                json_utils.set_status_of_batch_file("RUNNING", os.path.basename(batch_file_path))
+                remove_job(os.path.basename(batch_file_path))
+        elif not is_tracked_job(os.path.basename(batch_file_path)):
+            # Only untracked jobs, tracked jobs that left the queue are classified by sacct in json_utils.handle_running_files
+            check_and_handle_non_running_job(ssh, job_name, batch_file_path, base_dir)
 
     # Additional step: Handle jobs that are no longer in squeue
     handle_cancelled_jobs(ssh, jobs, base_dir)
+
+def is_tracked_job(batch_file):
+    """True if the SLURM job id of the batch file is recorded, its job is then followed by id and sacct."""
+    job = json_utils.get_job_store().get(batch_file)
+    return job is not None and bool(job.get('job_id'))
+
+def find_squeue_job(jobs, batch_file, job_name):
+    """
+    squeue entry of a batch file, None if its job is not in the queue. Jobs with a recorded job id are matched
+    by it, array tasks ("<array_id>_<task_id>") share one job name. Other jobs are matched by their job name.
+    """
+    job = json_utils.get_job_store().get(batch_file)
+    if job is not None and job.get('job_id'):
+        return next((queued_job for queued_job in jobs if queued_job["job_id"] == job['job_id']), None)
+    return next((queued_job for queued_job in jobs if queued_job["name"] == job_name), None)
 # COMPLETED
 def check_and_handle_non_running_job(ssh, job_name, batch_file_path, base_dir):
     logging.info(f"Check and handle non running jobs: job-name : {job_name}, batch_file_path : {batch_file_path} in directory {base_dir})")
@@ -246,19 +219,23 @@ def handle_cancelled_jobs(ssh, jobs, base_dir):
     # logging.info(f"Handle cancelled jobs: Jobs: {jobs}, in directory: {base_dir}) ---")
     # Check all work_dirs for in_progress.txt files and handle those that are no longer running
     work_dirs = rops.list_remote_directories(ssh, os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR).replace("\\", "/"))
-    for work_dir in work_dirs:
-        work_dir_path = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, work_dir).replace("\\", "/")
+    work_dir_paths = [os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, work_dir).replace("\\", "/") for work_dir in work_dirs]
+    # Check every work dir for in_progress.txt over several channels at once
+    in_progress_found = rops.run_concurrently(
+        lambda work_dir_path: rops.check_remote_file_exists(ssh, os.path.join(work_dir_path, "in_progress.txt").replace("\\", "/")),
+        work_dir_paths)
+    for work_dir, work_dir_path, in_progress in zip(work_dirs, work_dir_paths, in_progress_found):
         in_progress_file = os.path.join(work_dir_path, "in_progress.txt").replace("\\", "/")
         error_file = os.path.join(work_dir_path, "error_occurred.txt").replace("\\", "/")
-# DOUBLE CHECK THIS METHOD and COMPARE WITH LINE 341 FOR STORAGE_MONITOR.LOG
-        if rops.check_remote_file_exists(ssh, in_progress_file) == 'exists':
+        if in_progress:
             # Extract the job name from the batch file associated with this work_dir
             batch_file_name = rops.find_associated_batch_file(ssh, base_dir, work_dir)
             logging.info(f"Handling cancelled job: {batch_file_name}")
             print(f"Handling cancelled job: {batch_file_name}")
-            if batch_file_name:
+            # Tracked jobs are classified by their sacct state in json_utils.handle_running_files
+            if batch_file_name and not is_tracked_job(os.path.basename(batch_file_name)):
                 job_name = rops.get_job_name_from_batch_file(ssh, batch_file_name)
-                matching_job = next((job for job in jobs if job["name"] == job_name), None)
+                matching_job = find_squeue_job(jobs, os.path.basename(batch_file_name), job_name)
                 if matching_job == None:
                     # Job is no longer running, so mark as error and move batch file to _ERROR
                     rops.rename_remote_file(ssh, in_progress_file, error_file)
@@ -266,124 +243,219 @@ def handle_cancelled_jobs(ssh, jobs, base_dir):
                     json_utils.set_status_of_batch_file("ERROR", os.path.basename(batch_file_name))
 
 def remove_job(filename):
-    # Use list comprehension to remove the job from queued_jobs if it matches the filename
+    # Remove the job from queued_jobs and seen_batch_files
     global queued_jobs
     global seen_batch_files
-    queued_jobs = [job for job in queued_jobs if job[0][0] != filename]
-    
-    # Remove from the set if it exists
-    logging.info(f"Removing ({queued_jobs[0][0]}, {queued_jobs[0][1]} from queued_jobs list. ")
+    logging.info(f"Removing {filename} from queued_jobs list. ")
+    queued_jobs = [job for job in queued_jobs if job[0] != filename]
     seen_batch_files.discard(filename)  # Use remove(filename) if you want an error to be raised if not found
-    queued_jobs.remove((queued_jobs[0][0], queued_jobs[0][1]))
 
 # COMPLETED
+def choose_constraints(ssh, batch_files):
+    """
+    Pick the -C of every batch file from one snapshot of the cluster capacity: the GPU types of the batch file
+    (or cfg.GPU_DISPATCH_CONSTRAINT) narrowed to the ones with free GPUs, so jobs do not pend behind busy ones.
+    :return: dict of {batch_file: constraint} for the batch files that get a constraint
+    """
+    if not cfg.GPU_AWARE_DISPATCH or not batch_files:
+        return {}
+    capacity = dict(sops.get_cluster_capacity(ssh))
+    batch_file_paths = {batch_file: os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION, batch_file).replace('\\', '/')
+                        for batch_file in batch_files}
+    batch_file_infos = rops.get_batch_file_infos(ssh, list(batch_file_paths.values()))
+    constraints = {}
+    for batch_file, path in batch_file_paths.items():
+        info = batch_file_infos[path]
+        candidates = cfg.GPU_DISPATCH_CONSTRAINT or (info["gpu_constraint"] if info else None)
+        constraint = sops.choose_constraint(candidates, capacity)
+        if constraint:
+            constraints[batch_file] = constraint
+            sops.reserve_gpu(capacity, constraint)
+            if constraint != candidates:
+                logging.info(f"Submitting {batch_file} on {constraint} instead of {candidates}")
+    return constraints
+
+def submit_and_track(ssh, batch_files, constraints=None):
+    """
+    Submit queued batch files with one sbatch command, keep their SLURM job ids on the job records and
+    confirm all of them with one squeue query.
+    :param constraints: optional dict of {batch_file: constraint} that overrides the -C of the batch files
+    :return: dict of {batch_file: (job_id, squeue entry)}, job_id is None if sbatch failed and the entry is None
+             if squeue (or sacct) did not confirm the job in time
+    """
+    batch_file_paths = {batch_file: f"{cfg.REMOTE_BATCH_FILE_LOCATION}/{batch_file}" for batch_file in batch_files}
+    constraints = constraints or {}
+    submissions = sops.submit_batch_files(ssh, list(batch_file_paths.values()), constraints={
+        path: constraints[batch_file] for batch_file, path in batch_file_paths.items() if batch_file in constraints})
+    job_store = json_utils.get_job_store()
+    job_ids = {}
+    for batch_file, path in batch_file_paths.items():
+        job_id, error = submissions[path]
+        if job_id is not None:
+            job_store.set_job_id(job_store.get(batch_file), job_id)
+            job_ids[batch_file] = job_id
+    if not job_ids:
+        return {batch_file: (None, None) for batch_file in batch_files}
+    # Poll until squeue lists every submitted job instead of sleeping a fixed time
+    queue = {}
+    def all_queued():
+        queue.update(sops.get_queue(ssh, [job_id for job_id in job_ids.values() if job_id not in queue]))
+        return all(job_id in queue for job_id in job_ids.values())
+    rops.wait_for(all_queued, 5, description="the submitted jobs to show up in squeue")
+    missing = [job_id for job_id in job_ids.values() if job_id not in queue]
+    # squeue can lag behind right after a submission, sacct knows every job that was accepted
+    for job_id, accounting in sops.get_terminal_states(ssh, missing).items():
+        if accounting['status'] is None:
+            queue[job_id] = {"job_id": job_id, "name": "", "state": accounting['state'], "reason": ""}
+    return {batch_file: (job_ids.get(batch_file), queue.get(job_ids.get(batch_file))) for batch_file in batch_files}
+
+def submit_arrays(ssh, batch_files, constraints=None):
+    """
+    Pack batch files that share a template (same script, only the config and job name differ) into one
+    sbatch --array per template. Task i of an array is tracked as job "<array_job_id>_<i>" on the record
+    of the i-th batch file.
+    :param constraints: optional dict of {batch_file: constraint}, an array runs on the constraint of its first batch file
+    :return: (submitted, remaining), remaining are the batch files that were not packed or whose array failed
+    """
+    constraints = constraints or {}
+    job_store = json_utils.get_job_store()
+    jobs = {batch_file: job_store.get(batch_file) for batch_file in batch_files}
+    jobs = {batch_file: job for batch_file, job in jobs.items() if job is not None and job.get('working_directory')}
+    paths = [os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION, batch_file).replace('\\', '/') for batch_file in jobs]
+    contents = rops.run_remote_commands(ssh, [f"cat {path}" for path in paths])
+    templates = {batch_file: (content, job['working_directory'], job['job_name'])
+                 for (batch_file, job), (content, error) in zip(jobs.items(), contents) if content}
+
+    submitted = []
+    for template, members in sops.group_by_template(templates, cfg.SBATCH_ARRAY_MIN_SIZE):
+        working_directories = [jobs[batch_file]['working_directory'] for batch_file in members]
+        job_names = [jobs[batch_file]['job_name'] for batch_file in members]
+        concurrency = min(cfg.SBATCH_ARRAY_CONCURRENCY or len(members), len(members))
+        content = sops.build_array_batch_file(template, working_directories, job_names, concurrency)
+        array_file = f"{cfg.REMOTE_ARRAY_BATCH_FILE_LOCATION}/array_{time.strftime('%Y%m%d_%H%M%S')}_{members[0]}"
+        array_id, error = sops.submit_generated_batch_file(ssh, content, array_file, constraint=constraints.get(members[0]))
+        if array_id is None:
+            logging.error(f"Could not submit {members} as an array, submitting them one by one: {error}")
+            continue
+        print_green(f"Submitted {len(members)} batch files as array job {array_id} (%{concurrency}): {members}")
+        logging.info(f"Submitted {len(members)} batch files as array job {array_id} (%{concurrency}): {members}")
+        for task_id, batch_file in enumerate(members):
+            job_store.set_job_id(jobs[batch_file], f"{array_id}_{task_id}")
+        submitted += members
+    return submitted, [batch_file for batch_file in batch_files if batch_file not in submitted]
+
+def mark_submission_failed(ssh, batch_file):
+    """Set a batch file that could not be submitted to ERROR and move it to _ERROR."""
+    json_utils.set_status_of_batch_file("ERROR", batch_file=batch_file)
+    working_directory = rops.get_python_file_name_from_batch_file(ssh, os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION, batch_file).replace('\\','/'))
+    # ssh.exec_command(f"touch {os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, working_directory, "error_occurred.txt").replace("\\", "/")}")
+    if working_directory != None:
+        project_directory = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, working_directory).replace('\\','/')
+        stdin, stdout, stderr = ssh.exec_command(f"find {project_directory} -name *.txt")
+        
+        if stdout:
+            # Rename a textfile if there is one already in the working directory 
+            source_directory = stdout.read().decode().strip()
+            dest_directory = os.path.join(project_directory, "error_occurred.txt").replace('\\','/')
+            logging.info(f"    Executing command: mv {source_directory} {dest_directory}")
+            rops.rename_remote_file(ssh, source_directory, dest_directory)
+        else:
+            # Add a new error_occurred text file in the working directory if there isn't a textfile found. 
+            error_textfile_path = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, working_directory, 'error_occurred.txt').replace("\\", '/')
+            logging.info(f"    Executing command: touch {error_textfile_path}")
+            stdin, stdout, stderr = ssh.exec_command(f"touch {error_textfile_path}")
+            if stderr:
+                logging.error(stderr.read().decode())
+        # Add logic to move batch file VVV
+        batch_file_source = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION, batch_file).replace('\\', '/')
+        batch_file_dest = os.path.join(cfg.REMOTE_WORKING_PROJECT, *cfg.REMOTE_BATCH_FILE_LOCATION.split('/')[:-1],"_ERROR").replace('\\', '/')
+        print_green(f"Moving {batch_file_source} to {batch_file_dest}") 
+        rops.move_batch_file(ssh, batch_file_source, batch_file_dest)
+        if rops.check_remote_file_exists(ssh, os.path.join(batch_file_dest, batch_file).replace('\\','/')):
+            print_green(f"File {batch_file} successfully moved to {batch_file_dest}.")
+        else:
+            print_red(f"File {batch_file} was not moved successfully to {batch_file_dest}.")
+        logging.error(f"{batch_file} is not running. Double check issue with model.")
+    remove_job(batch_file)
+
+def free_job_slots():
+    """Number of jobs that can be submitted before the tracked running count reaches cfg.JOB_THRESHOLD."""
+    return max(0, cfg.JOB_THRESHOLD - json_utils.get_job_store().count('RUNNING'))
+
 def run_sbatch(ssh):
     global queued_jobs
     global seen_batch_files
-    dictionary_list = []
-    json_file_path = 'batch_files.json'
     print()
-    if os.path.exists(json_file_path):
-        with open(json_file_path, 'r') as json_file:
-            dictionary_list = json.load(json_file)
-
-    
-    for item in dictionary_list:
-        if item['status'] == 'QUEUED' :
-            filename = item['filename']
-            job_name = item['job_name']
-            
-             # Check if the filename is already in the set
-            if filename not in seen_batch_files:
-                # If not, add it to the queued_jobs list and mark it as seen
-                job_tuple = (filename, job_name)
-                queued_jobs.append(job_tuple)
-                seen_batch_files.add(filename)
-    running_item = ""
+    job_store = json_utils.get_job_store()
+    for item in job_store.jobs_with_status('QUEUED'):
+        filename = item['filename']
+        job_name = item['job_name']
+        
+         # Check if the filename is already in the set
+        if filename not in seen_batch_files:
+            # If not, add it to the queued_jobs list and mark it as seen
+            job_tuple = (filename, job_name)
+            queued_jobs.append(job_tuple)
+            seen_batch_files.add(filename)
+    # Jobs that left QUEUED in the meantime (moved by hand, picked up by the monitor) are not submitted again
+    for filename, job_name in list(queued_jobs):
+        job = job_store.get(filename)
+        if job is None or job['status'] != 'QUEUED':
+            remove_job(filename)
+    submitted = []
     if len(queued_jobs) > 0:
-        gpu_initialized = rops.ssh_kinit_loop(1)
+        slots = free_job_slots()
+        if slots == 0:
+            print("No free job slots")
+            logging.info(f"No free job slots, {job_store.count('RUNNING')} jobs are running")
+            return False
+        # klist on the pooled connection (cached until shortly before expiry) instead of srun shells on every GPU type
+        gpu_initialized = credential_manager.get_credential_manager().ensure_valid(ssh)
         if gpu_initialized:
-            running_item = queued_jobs[0][0]
+            # Fill every free slot at once instead of one job per cycle
+            selected = [filename for filename, job_name in queued_jobs[:slots]]
             print(f'QUEUED LIST: {queued_jobs}')
             logging.info(f'QUEUED LIST: {queued_jobs}')
-            print(f'SELECTED JOB: {running_item}')
-            logging.info(f'SELECTED JOB: {running_item}')
-            
-            logging.info(f"    Executing command: cd {cfg.REMOTE_WORKING_PROJECT} ; sbatch {cfg.REMOTE_BATCH_FILE_LOCATION}/{queued_jobs[0][0]}")
-            stdin, stdout, stderr = ssh.exec_command(f'cd {cfg.REMOTE_WORKING_PROJECT} ; sbatch {cfg.REMOTE_BATCH_FILE_LOCATION}/{queued_jobs[0][0]}')
-            # Location of batch file within the QUEUED directory
-            source_dir = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION, queued_jobs[0][0]).replace('\\','/')
+            print(f'SELECTED JOBS ({len(selected)} free slots): {selected}')
+            logging.info(f'SELECTED JOBS ({len(selected)} free slots): {selected}')
+
+            # One capacity snapshot for the whole cycle, jobs go to the GPU types that are free right now
+            constraints = choose_constraints(ssh, selected)
+            packed = []
+            if cfg.SBATCH_ARRAY_PACKING:
+                # Arrays are packed from the selected jobs only, so JOB_THRESHOLD still bounds the tracked jobs
+                packed, selected = submit_arrays(ssh, selected, constraints)
+            queued_entries = submit_and_track(ssh, selected, constraints) if selected else {}
+            # Only sbatch failures are submitted again. A job with an id exists even if squeue or sacct lag
+            # behind, submitting it again would start a second training in the same work dir
+            retry = [batch_file for batch_file, (job_id, queued_job) in queued_entries.items() if job_id is None]
+            if retry:
+                logging.info(f"Rerunning sbatch for {retry}")
+                queued_entries.update(submit_and_track(ssh, retry, constraints))
+
+            # Location of batch files within the QUEUED directory
             dest_dir_running = os.path.join(cfg.REMOTE_WORKING_PROJECT, *cfg.REMOTE_BATCH_FILE_LOCATION.split('/')[:-1],"_RUNNING").replace('\\', '/')
-            # if stderr.read().decode() == '':
-            #     print_red(f"{stderr.read().decode()}")
-            #     print_red("You may have to manually run kinit again. Please do this ASAP!")
-            #     logging.error("You may have to manually run 'kinit' again. Please do this ASAP!")
-            for counter, line in enumerate(stdout):
-                print_green(f"{line.strip()}")
-                logging.info(f"SBATCH successful: {line.strip()}")
-            time.sleep(5)
-            jobs = rops.get_squeue_jobs(ssh)
-            matching_job = next((job for job in jobs if job['name']==queued_jobs[0][1]), None)
-
-            #print(f"from run_sbatch() - Matching Job: {matching_job}")
-            if matching_job != None:
-                if matching_job['state'] == "RUNNING":
-                    json_utils.set_status_of_batch_file("RUNNING", batch_file=queued_jobs[0][0])
-                    rops.move_batch_file(ssh, source_dir, dest_dir_running)
-                    logging.info(f"{queued_jobs[0][0]} is running!")
-                    remove_job(queued_jobs[0][0]) 
-            else:
-                logging.info(f"Rerunning command: cd {cfg.REMOTE_WORKING_PROJECT} ; sbatch {cfg.REMOTE_BATCH_FILE_LOCATION}/{queued_jobs[0][0]}")
-                stdin, stdout, stderr = ssh.exec_command(f'cd {cfg.REMOTE_WORKING_PROJECT} ; sbatch {cfg.REMOTE_BATCH_FILE_LOCATION}/{queued_jobs[0][0]}')
-                # for counter, line in enumerate(stderr):
-                #     print_red(f"{line.strip()}")
-                # if stderr == '':
-                #     print_red("You may have to manually run kinit again. Please do this ASAP!")
-                #     logging.error("You may have to manually run 'kinit' again. Please do this ASAP!")
-                for counter, line in enumerate(stdout):
-                    print_green(f"{line.strip()}")
-                time.sleep(5)
-                jobs = rops.get_squeue_jobs(ssh)
-                matching_job = next((job for job in jobs if job['name']==queued_jobs[0][1]), None)
-                if matching_job != None:
-                    if matching_job['status'] == "RUNNING":
-                        json_utils.set_status_of_batch_file("RUNNING", batch_file=queued_jobs[0][0])
-                        rops.move_batch_file(ssh, source_dir, dest_dir_running)
-                        logging.info(f"{queued_jobs[0][0]} is running!")
-                        remove_job(queued_jobs[0][0])
-                else:
-                    json_utils.set_status_of_batch_file("ERROR", batch_file=queued_jobs[0][0])
-                    working_directory = rops.get_python_file_name_from_batch_file(ssh, os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION, queued_jobs[0][0]).replace('\\','/'))
-                    # ssh.exec_command(f"touch {os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, working_directory, "error_occurred.txt").replace("\\", "/")}")
-                    if working_directory != None:
-                        project_directory = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, working_directory).replace('\\','/')
-                        stdin, stdout, stderr = ssh.exec_command(f"find {project_directory} -name *.txt")
-                        
-                        if stdout:
-                            # Rename a textfile if there is one already in the working directory 
-                            source_directory = stdout.read().decode().strip()
-                            dest_directory = os.path.join(project_directory, "error_occurred.txt").replace('\\','/')
-                            logging.info(f"    Executing command: mv {source_directory} {dest_directory}")
-                            rops.rename_remote_file(ssh, source_directory, dest_directory)
-                        else:
-                            # Add a new error_occurred text file in the working directory if there isn't a textfile found. 
-                            error_textfile_path = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR, working_directory, 'error_occurred.txt').replace("\\", '/')
-                            logging.info(f"    Executing command: touch {error_textfile_path}")
-                            stdin, stdout, stderr = ssh.exec_command(f"touch {error_textfile_path}")
-                            if stderr:
-                                logging.error(stderr.read().decode())
-                        # Add logic to move batch file VVV
-                        batch_file_source = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION, queued_jobs[0][0]).replace('\\', '/')
-                        batch_file_dest = os.path.join(cfg.REMOTE_WORKING_PROJECT, *cfg.REMOTE_BATCH_FILE_LOCATION.split('/')[:-1],"_ERROR").replace('\\', '/')
-                        print_green(f"Moving {batch_file_source} to {batch_file_dest}") 
-                        rops.move_batch_file(ssh, batch_file_source, batch_file_dest)
-                        if rops.check_remote_file_exists(ssh, os.path.join(batch_file_dest, queued_jobs[0][0]).replace('\\','/')):
-                            print_green(f"File {queued_jobs[0][0]} successfully moved to {batch_file_dest}.")
-                        else:
-                            print_red(f"File {queued_jobs[0][0]} was not moved successfully to {batch_file_dest}.")
-                        #queued_jobs.remove((running_item, queued_jobs[0][1]))
-                        logging.error(f"{queued_jobs[0][0]} is not running. Double check issue with model.")
-                    remove_job(queued_jobs[0][0])
+            # A pending job is in the queue as well, it must not be submitted a second time
+            for batch_file, (job_id, queued_job) in queued_entries.items():
+                if job_id is not None:
+                    json_utils.set_status_of_batch_file("RUNNING", batch_file=batch_file)
+                    if queued_job is not None:
+                        logging.info(f"{batch_file} is {queued_job['state']} as job {job_id}!")
+                    else:
+                        # The monitor classifies the job through its id once squeue or sacct know it
+                        logging.info(f"{batch_file} was submitted as job {job_id}, not confirmed by squeue yet")
+                    remove_job(batch_file)
+                    submitted.append(batch_file)
+            # Array tasks are picked up by the monitor like any other job through their "<array_id>_<task>" id
+            for batch_file in packed:
+                json_utils.set_status_of_batch_file("RUNNING", batch_file=batch_file)
+                remove_job(batch_file)
+                submitted.append(batch_file)
+            rops.move_batch_files(ssh, [os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION, batch_file).replace('\\','/')
+                                        for batch_file in submitted], dest_dir_running)
+            for batch_file, (job_id, queued_job) in queued_entries.items():
+                if job_id is None:
+                    mark_submission_failed(ssh, batch_file)
             json_utils.update_json_new(ssh)
         else:
             print_red("May need to run kinit again to start running jobs")
@@ -391,12 +463,11 @@ def run_sbatch(ssh):
     else:
         print("No jobs with status QUEUED")
         logging.info("No jobs with status QUEUED")
+    return len(submitted) > 0
 # COMPLETED
 def move_batch_files_based_on_status(ssh):
     # logging.info("Move batch files to their folders based off status in json file")
-    # Load JSON data
-    with open(cfg.json_file_path, 'r') as f:
-        batch_files_data = json.load(f)
+    job_store = json_utils.get_job_store()
 
     base_dir = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_BATCH_FILE_LOCATION).replace("\\", "/")
     base_dir = '/'.join(base_dir.split('/')[:-1])
@@ -409,46 +480,69 @@ def move_batch_files_based_on_status(ssh):
         for filename in rops.list_remote_files(ssh, full_dir_path): 
             # Get the name/path of the batch file
             batch_file_source_path = os.path.join(full_dir_path, filename).replace("\\", "/") 
-            # Look through batch_files json_data
-            for batch_file in batch_files_data:            
-                 # Find json data entry that matches the name of the batch file we are looking at
-                if batch_file['filename'] == filename:    
-                    # get the status of the file from json data
-                    status = batch_file['status']          
-                    # If the directory doesn't match the status 
-                    if dirs_to_check != '_'+status:        
-                        # Move the batch file
-                        rops.move_batch_file(ssh, batch_file_source_path, os.path.join(base_dir, f"_{status}").replace('\\','/'))
+            # Find the job store entry that matches the name of the batch file we are looking at
+            batch_file = job_store.get(filename)
+            if batch_file is not None:
+                # get the status of the file from json data
+                status = batch_file['status']          
+                # If the directory doesn't match the status 
+                if dir_name != '_'+status:        
+                    # Move the batch file
+                    rops.move_batch_file(ssh, batch_file_source_path, os.path.join(base_dir, f"_{status}").replace('\\','/'))
 
 def evaluate_complete_directory(ssh, complete_directory):
     """
-    Main method to evaluate a directory containing 'completed.txt' by running the SSH commands.
+    Queue the evaluation of the best mIoU model of a directory containing 'completed.txt'.
+    run_evaluations submits it as a batch job and tracks it, so evaluations run in parallel without blocking the loop.
+    Returns True if the evaluation was queued or the checkpoint is already evaluated.
     """
     try:
         # Find the best_mIoU file and extract iteration number
-        logging.info(f"Evaluating the best mIoU model placed in {complete_directory.split('/')[-1]}.")
-        print(f"Evaluating the best mIoU model placed in {complete_directory.split('/')[-1]}.")
+        work_dir = complete_directory.split('/')[-1]
+        logging.info(f"Evaluating the best mIoU model placed in {work_dir}.")
+        print(f"Evaluating the best mIoU model placed in {work_dir}.")
         best_mIoU_file, iteration_number = find_best_mIoU_file(ssh, complete_directory)
         if not best_mIoU_file:
             print_red(f"No best mIoU model found. Please double check in {complete_directory}")
-            return
-        
-        model_evaluated = False
-        eval_counter = 0
-        # Run the evaluation
-        while not model_evaluated and eval_counter < 3:
-            model_evaluated = run_evaluation(ssh, complete_directory, best_mIoU_file)
-            eval_counter+=1
-        
-        if model_evaluated:
-            complete_directory.split('/')[-1]
-            print_green(f"{complete_directory.split('/')[-1]} evaluated with {best_mIoU_file} successfully!")
-            logging.info(f"{complete_directory.split('/')[-1]} evaluated with {best_mIoU_file} successfully!")
-        else:
-            print_red(f"{complete_directory.split('/')[-1]} was not evaluated. Double check issue with model.")
-            logging.error(f"{complete_directory.split('/')[-1]} was not evaluated. Double check issue with model.")
+            return False
+        return eops.enqueue_evaluation(ssh, work_dir, best_mIoU_file)
     except Exception as e:
         print(f"An error occurred: {e}")
+    return False
+
+def run_evaluations(ssh):
+    """
+    Check the evaluation jobs, prune the checkpoints of the trainings that were evaluated and submit
+    queued evaluations up to cfg.EVALUATION_CONCURRENCY.
+    """
+    evaluated, failed = eops.track_evaluations(ssh)
+    # Only evaluated trainings are pruned, their best checkpoint is known to be usable
+    prune_completed_checkpoints(ssh, [eops.get_work_dir_path(work_dir) for work_dir in evaluated])
+    submitted = []
+    if any(evaluation["status"] == "WAITING" for evaluation in eops.load_evaluations().values()):
+        if credential_manager.get_credential_manager().ensure_valid(ssh):
+            submitted = eops.dispatch_evaluations(ssh)
+        else:
+            print_red("May need to run kinit again to start evaluations")
+            logging.error("May need to run kinit again to start evaluations")
+    return evaluated, failed, submitted
+
+def prune_completed_checkpoints(ssh, directories):
+    """
+    Delete the intermediate checkpoints of evaluated trainings following the retention policy in config,
+    with one remote command for all directories.
+    """
+    if not cfg.CHECKPOINT_PRUNING or not directories:
+        return 0
+    reclaimed = rops.prune_checkpoints(ssh, directories)
+    total_bytes = sum(reclaimed.values())
+    for directory, reclaimed_bytes in reclaimed.items():
+        logging.info(f"Pruned checkpoints in {directory}: {reclaimed_bytes / (1024 * 1024):.1f} MB reclaimed")
+    print_green(f"Pruned checkpoints in {len(directories)} directories, reclaimed {total_bytes / (1024 * 1024 * 1024):.2f} GB")
+    if total_bytes:
+        # The freed space is not in the cached quota sample
+        quota_manager.get_quota_manager().invalidate()
+    return total_bytes
                 
 def find_best_mIoU_file(ssh, complete_directory):
     """
@@ -484,83 +578,6 @@ def find_best_mIoU_file(ssh, complete_directory):
     print_green(f"Best mIoU File Found: {best_mIoU_file}")
     return best_mIoU_file, iteration_number
 
-def run_evaluation(ssh, complete_directory, best_mIoU_file):
-    """
-    Runs the evaluation command using the found .pth file and checks if it is successful.
-    If not, retries once. If it fails again, creates 'not_evaluated.txt' in the directory.
-    """
-    # Construct the evaluation command
-    if rops.ssh_kinit_loop(1):
-        job_work_dir_path = os.path.join(*complete_directory.split('/')[1:]).replace('\\','/')
-        eval_command = (
-            f"srun -G 1 -C 'ada|a4500|a4000' --pty python tools/test.py {job_work_dir_path}/{complete_directory.split('/')[-1]}.py "
-            f"{job_work_dir_path}/{best_mIoU_file} --show-dir work_dirs/{complete_directory.split('/')[-1]}/{best_mIoU_file[:-4]}_output/ --eval mIoU"
-        )
-        print(f"Command to run: cd {cfg.REMOTE_WORKING_PROJECT} ; {eval_command}")
-        # print_blue(f"TODO: Check kinit before running evaluation script")
-        
-        # # Run the command and check if it's successful
-        #ssh = paramiko.SSHClient()
-        #ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        # # Connect to the remote host
-        #ssh.connect(cfg.REMOTE_HOST, username=cfg.USERNAME, password=cfg.PASSWORD)
-        
-        # Open an SSH session
-        # logging.info("Started a shell to evaluate a model")
-        session = ssh.invoke_shell()
-        time.sleep(5)
-        session.send(f"cd {cfg.REMOTE_WORKING_PROJECT}\n")
-        time.sleep(1)
-        session.send(eval_command+'\n')
-        time.sleep(5)
-        output = session.recv(4096).decode('utf-8')
-
-        logging.info(f"srun evaluation output: \n{output}")
-        print(output)
-
-        if 'Permission denied' in output or 'error' in output.lower():
-            print_red("Error running srun command.")
-            logging.info("Error running srun command.")
-            session.close()
-            return False
-        else:
-            time.sleep(120)
-            session.close()
-            return True
-    
-
-    # logging.info(f"Executing command: cd {cfg.REMOTE_WORKING_PROJECT} ; {eval_command}")
-    # stdin, stdout, stderr = ssh.exec_command(f'cd {cfg.REMOTE_WORKING_PROJECT} ; {eval_command}')
-    # output = stdout.read().decode('utf-8')
-    # error = stderr.read().decode('utf-8')
-    # print(f"Evaluation output: {output}")
-    # print(f"Error output: {error}")
-    # if "Error" not in error:  # Adjust this condition based on actual success criteria
-    #     print(f"Evaluation successful: {output}")
-    #     return True
-
-    # # Retry the command
-    # print(f"First attempt failed: {error}. Retrying...")
-    # stdin, stdout, stderr = ssh.exec_command(eval_command)
-    # output = stdout.read().decode('utf-8')
-    # error = stderr.read().decode('utf-8')
-    # if error:
-    #     print(error)
-    # if output: 
-    #     print(output)
-    # if "Error" not in error:
-    #     print(f"Evaluation successful on second attempt: {output}")
-    #     return True
-
-    # # If it fails again, create 'not_evaluated.txt'
-    # print(f"Second attempt failed: {error}. Creating 'not_evaluated.txt'...")
-    # create_file_command = f"echo 'Evaluation failed' > {complete_directory}/not_evaluated.txt"
-    # stdin, stdout, stderr = ssh.exec_command(create_file_command)
-    # output = stdout.read().decode('utf-8')
-    # error = stderr.read().decode('utf-8')
-    # return False
-
 def log_extraction(ssh):
     logging.info("Extracting logs for models that have completed training")
     try:
@@ -627,93 +644,143 @@ def log_extraction(ssh):
                         print_green(f"Successfully renamed {completed_job} to {extracted_job}")
                         base_dir = os.path.join(cfg.REMOTE_WORKING_PROJECT, *cfg.REMOTE_BATCH_FILE_LOCATION.split('/')[:-1]).replace("\\", "/")
                         # for batch_file_directory in [d for d in rops.list_remote_directories(ssh, base_dir) if d.startswith('_')]:
-                        found_batch_file = rops.find_associated_batch_file(ssh, base_dir=base_dir, work_dir=directory.split('/')[-1])
-                        print(f"Batch file found!: {found_batch_file}")
-                        if found_batch_file != None:
-                            print_green(f"Setting status of job in {directory.split('/')[-1]} to FINISHED")
-                            json_utils.set_status_of_batch_file("FINISHED", batch_file=os.path.basename(found_batch_file))
-                            rops.move_batch_file(ssh,found_batch_file, os.path.join(*found_batch_file.split('/')[:-2],'_FINISHED').replace('\\','/'))
+                        with batch_file_lock:
+                            found_batch_file = rops.find_associated_batch_file(ssh, base_dir=base_dir, work_dir=directory.split('/')[-1])
+                            print(f"Batch file found!: {found_batch_file}")
+                            if found_batch_file != None:
+                                print_green(f"Setting status of job in {directory.split('/')[-1]} to FINISHED")
+                                json_utils.set_status_of_batch_file("FINISHED", batch_file=os.path.basename(found_batch_file))
+                                rops.move_batch_file(ssh,found_batch_file, os.path.join(*found_batch_file.split('/')[:-2],'_FINISHED').replace('\\','/'))
                         
                 else:
                     logging.error(f'No JSON files were found in this directory: {directory}')
                     print_red(f'No JSON files were found in this directory: {directory}')
+            return len(output_complete)
         else:
             logging.error(f"{cfg.COMPLETED_MARKER_FILE} not found in directory {project_work_dir}")
             print_red(f"{cfg.COMPLETED_MARKER_FILE} not found in directory {project_work_dir}")
     except Exception as e:
         logging.error(f"An error occured: {str(e)}")
         print(f"An error occured: {str(e)}")
+    return 0
 
 def check_and_move_files(ssh):
     # logging.info("Running storage check and moving files if they're finished")
     # Check how much storage is being used
     # login to remote pc, run quote -vs, and extract the used storage and storage limit    
-    # Move files using rsync to local pc
-    usage_percentage = check_storage_usage(ssh)
-    if usage_percentage:
+    # Move files to the local pc early enough that the running jobs never fill the quota
+    running_jobs = json_utils.get_job_store().count('RUNNING')
+    usage_percentage = check_storage_usage(ssh, running_jobs)
+    if usage_percentage is None:
+        return False
+    quotas = quota_manager.get_quota_manager()
+    time_to_full = quotas.seconds_until(cfg.QUOTA_LIMIT_PERCENT, running_jobs)
+    if time_to_full is not None:
+        print_green(f"Storage usage is at {usage_percentage:.2f}%, {cfg.QUOTA_LIMIT_PERCENT}% predicted in {time_to_full / 3600:.1f} hours with {running_jobs} running jobs.")
+        logging.info(f"Storage usage is at {usage_percentage:.2f}%, {cfg.QUOTA_LIMIT_PERCENT}% predicted in {time_to_full / 3600:.1f} hours with {running_jobs} running jobs.")
+    else:
         print_green(f"Storage usage is at {usage_percentage:.2f}%.")
         logging.info(f"Storage usage is at {usage_percentage:.2f}%.")
-    else:
-        print_red("Could not determine storage usage.")
-        logging.info("Could not determine storage usage.")
-    # If storage is above a level, move the completed trained models over to the local pc
-    if usage_percentage > cfg.THRESHOLD:
+    # If storage is above a level, or will be before an offload could free it, move the completed trained models over to the local pc
+    if quotas.should_offload(running_jobs):
         directories = find_directories_to_move(ssh)
         if directories:
-            move_directories(ssh, directories)
-            print(f"Would move these directories {directories}")
+            directories = plan_directories_to_move(ssh, directories, quotas.mb_to_free(running_jobs))
+            # Only queue the transfers, the transfer workers copy and remove them in the background
+            queued = move_directories(ssh, directories, wait=False)
+            print(f"Queued these directories for transfer {queued}")
+            return bool(queued)
         else:
             print_red("No directories found to move")
             logging.info("No directories found to move.")
-    else:
-        print_green("Storage usage is within limits.")
-        logging.info("Storage usage is within limits.")
-
-def run_every_hour(ssh):
-
-    json_utils.update_json_new(ssh)
-      
-    jobs=rops.get_squeue_jobs(ssh)
-    check_batch_files(ssh, jobs)
-
-    last_status_counts = json_utils.update_json_new(ssh)
+        return False
+    print_green("Storage usage is within limits.")
+    logging.info("Storage usage is within limits.")
+    # Check again around the time an offload is predicted to be needed
+    seconds_until_offload = quotas.seconds_until_offload(running_jobs)
+    return seconds_until_offload if seconds_until_offload is not None else False
+
+def sync_job_states(ssh):
+    """
+    Monitoring pipeline: sync the job states with squeue and the remote batch file folders.
+    Returns what the scheduler should do next (see AdaptiveScheduler).
+    """
+    global last_status_counts
+    previous_counts = last_status_counts
+    # The status handlers move remote batch files, so they run under the same lock as run_sbatch
+    with batch_file_lock:
+        json_utils.update_json_new(ssh)
+        jobs = rops.get_squeue_jobs(ssh)
+        check_batch_files(ssh, jobs)
+        last_status_counts = json_utils.update_json_new(ssh)
     print(f"Number of jobs running on Remote Server: {len(jobs)}")
-    if len(jobs) < cfg.JOB_THRESHOLD or last_status_counts[3] < cfg.JOB_THRESHOLD:
-        print_blue("Fewer jobs than threshold detected. Run this line 3")
-        run_sbatch(ssh)
-        # move_batch_files_based_on_status(ssh)    
-    # Look and extract logs for jobs that are completed. 
-    json_utils.update_json_new(ssh)
 
-    log_extraction(ssh)
-    move_batch_files_based_on_status(ssh)
-    check_and_move_files(ssh)
+    if last_status_counts[4] > 0 and free_job_slots() > 0:
+        # Free GPU slots, let the submission pipeline refill them right away
+        scheduler.trigger('submission')
+    if previous_counts is not None and last_status_counts[1] > previous_counts[1]:
+        # New completed jobs, extract their logs now instead of waiting for the next extraction poll
+        scheduler.trigger('extraction')
+    # Running jobs can finish at any time, so do not back off as far while there are any
+    scheduler.set_max_interval('monitor', cfg.STATUS_POLL_RUNNING_MAX_SECONDS if last_status_counts[3] > 0 else cfg.STATUS_POLL_MAX_SECONDS)
+    return last_status_counts != previous_counts
+
+def submit_queued_jobs(ssh):
+    """Submission pipeline: refill free GPU slots with queued jobs."""
+    if free_job_slots() == 0:
+        return False
+    print_blue(f"{free_job_slots()} free job slots detected. Run this line 3")
+    with batch_file_lock:
+        submitted = run_sbatch(ssh)
+    if submitted:
+        # Confirm the submission and keep refilling free slots quickly
+        scheduler.trigger('monitor', delay=cfg.POLL_AFTER_SUBMIT_SECONDS)
+        return cfg.POLL_AFTER_SUBMIT_SECONDS
+    return False
+
+def extract_completed(ssh):
+    """Extraction pipeline: extract logs of completed jobs, queue their evaluations and run the evaluation queue."""
+    extracted = log_extraction(ssh)
+    evaluated, failed, submitted = run_evaluations(ssh)
+    with batch_file_lock:
+        move_batch_files_based_on_status(ssh)
+    if extracted:
+        # GPU slots of the completed trainings are free
+        scheduler.trigger('monitor')
+    if extracted or evaluated or failed:
+        # Finished directories whose evaluation is done can now be offloaded
+        scheduler.trigger('offload')
+    # Evaluation jobs end after minutes, so do not back off as far while there are any
+    scheduler.set_max_interval('extraction', cfg.STATUS_POLL_RUNNING_MAX_SECONDS if eops.pending_evaluations() else cfg.EXTRACTION_POLL_MAX_SECONDS)
+    return extracted > 0 or bool(evaluated or failed or submitted)
 
 def main():
     # TODO FIX STATUS UPDATES FOR RUNNING MODELS... We might not be clearing lists to queue and sbatch models properly
-    run_counter = 0
-    sleep_counter_seconds = 600
+    global scheduler
     ssh = rops.connect_ssh(remote_host=cfg.REMOTE_HOST, username=cfg.USERNAME, password=cfg.PASSWORD)
     json_utils.create_json(ssh)
-    schedule.every(10).minutes.do(run_every_hour, ssh)
-    # schedule.every(2).minute.do(run_every_six_hours)
-    run_every_hour(ssh)
-    # run_every_six_hours()
+
+    # Each pipeline picks its own next poll time from what it observed, instead of a fixed 10 minute cycle
+    scheduler = AdaptiveScheduler()
+    scheduler.add_task('monitor', lambda: sync_job_states(ssh), cfg.STATUS_POLL_MIN_SECONDS, cfg.STATUS_POLL_MAX_SECONDS)
+    scheduler.add_task('submission', lambda: submit_queued_jobs(ssh), cfg.SUBMISSION_POLL_MIN_SECONDS, cfg.SUBMISSION_POLL_MAX_SECONDS,
+                       run_immediately=False)
+    scheduler.add_task('extraction', lambda: extract_completed(ssh), cfg.EXTRACTION_POLL_MIN_SECONDS, cfg.EXTRACTION_POLL_MAX_SECONDS)
+    scheduler.add_task('offload', lambda: check_and_move_files(ssh), cfg.OFFLOAD_POLL_MIN_SECONDS, cfg.OFFLOAD_POLL_MAX_SECONDS)
 
     try:
-        while True:
-            run_counter+=1
-            # Run all pending scheduled tasks
-            schedule.run_pending()
-            print(f"Run counter: {run_counter}. Sleeping for {sleep_counter_seconds} seconds.")
-            time.sleep(sleep_counter_seconds)
-            
-            
+        if cfg.RUN_PIPELINES_CONCURRENTLY:
+            # GPU slots keep being refilled while offloads and evaluations are still running
+            scheduler.run_workers()
+        else:
+            scheduler.run_forever()
     except Exception as e:
         print(e)
         logging.error(f"An error occurred: {str(e)}")
         traceback.print_exc()
     finally:
+        scheduler.stop()
+        json_utils.get_job_store().persist()
         ssh.close()
     
 
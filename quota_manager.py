@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import config as cfg
+
+# Setup logging
+logging.basicConfig(filename='storage_monitor.log', level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+def print_green(text):
+    print(f"\033[92m{text}\033[0m")
+
+def print_red(text):
+    print(f"\033[91m{text}\033[0m")
+
+QUOTA_FILESYSTEM = 'communis.lcsr.rutgers.edu:/common/home'
+# quota -vs prints sizes like "812M", "4.5G" or "1024M*" (the star marks a user over quota)
+QUOTA_SIZE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)([KMGT])\*?\s+(\d+(?:\.\d+)?)([KMGT])')
+UNIT_TO_MB = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+
+def parse_quota_output(output):
+    """
+    Parse the output of quota -vs.
+    :return: (used_mb, quota_mb), or None if the home filesystem is not in the output
+    """
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        if QUOTA_FILESYSTEM in line:
+            # The sizes are either on the same line or, for long filesystem names, on the next one
+            for candidate in lines[i:i + 2]:
+                match = QUOTA_SIZE_PATTERN.search(candidate.replace(QUOTA_FILESYSTEM, ''))
+                if match:
+                    used_mb = float(match.group(1)) * UNIT_TO_MB[match.group(2)]
+                    quota_mb = float(match.group(3)) * UNIT_TO_MB[match.group(4)]
+                    return used_mb, quota_mb
+    return None
+
+def read_quota(ssh):
+    """Run quota -vs on the remote. Returns (used_mb, quota_mb) or None."""
+    logging.info("    Executing: quota -vs")
+    stdin, stdout, stderr = ssh.exec_command('quota -vs')
+    return parse_quota_output(stdout.read().decode())
+
+class QuotaManager:
+    """
+    Keeps a history of quota samples and predicts when the quota will be full.
+
+    quota -vs is only run when the last sample is older than cache_seconds (or the cache was
+    invalidated, e.g. after an offload freed space). In between, the usage is estimated from the
+    last sample and the growth rate. The growth rate is measured per running job over the history
+    window, so it follows the number of jobs that are currently writing checkpoints. Drops in usage
+    (offloads, deleted files) are not counted as negative growth.
+    """
+    def __init__(self, history_path=cfg.quota_history_path, cache_seconds=cfg.QUOTA_CACHE_SECONDS,
+                 window_seconds=cfg.QUOTA_HISTORY_WINDOW_SECONDS):
+        self.history_path = history_path
+        self.cache_seconds = cache_seconds
+        self.window_seconds = window_seconds
+        self.samples = []
+        self._lock = threading.Lock()
+        self._load_history()
+
+    def _load_history(self):
+        if not os.path.exists(self.history_path):
+            return
+        with open(self.history_path, 'r') as history_file:
+            for line in history_file:
+                try:
+                    self.samples.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.error(f"Skipping unreadable line in {self.history_path}: {line.strip()}")
+        self._trim()
+
+    def _trim(self):
+        cutoff = time.time() - self.window_seconds
+        self.samples = [sample for sample in self.samples if sample["time"] >= cutoff]
+
+    def invalidate(self):
+        """Make the next sample() run quota -vs again."""
+        with self._lock:
+            if self.samples:
+                self.samples[-1]["stale"] = True
+
+    def sample(self, ssh, running_jobs=0):
+        """
+        Return the latest usage sample {time, used_mb, quota_mb, running_jobs}, running quota -vs
+        only if the cached one is too old. Returns None if the quota could not be read.
+        """
+        with self._lock:
+            last = self.samples[-1] if self.samples else None
+            if last is not None and not last.get("stale") and time.time() - last["time"] < self.cache_seconds:
+                return last
+        quota = read_quota(ssh)
+        if quota is None:
+            return None
+        sample = {"time": time.time(), "used_mb": quota[0], "quota_mb": quota[1], "running_jobs": running_jobs}
+        with self._lock:
+            self.samples.append(sample)
+            self._trim()
+            with open(self.history_path, 'a') as history_file:
+                history_file.write(json.dumps(sample) + '\n')
+        return sample
+
+    def growth_rate_per_job(self):
+        """Average growth in MB per second per running job over the history window, None without enough samples."""
+        with self._lock:
+            samples = list(self.samples)
+        growth_mb = 0
+        job_seconds = 0
+        for previous, current in zip(samples, samples[1:]):
+            seconds = current["time"] - previous["time"]
+            jobs = (previous["running_jobs"] + current["running_jobs"]) / 2
+            if seconds <= 0 or jobs <= 0:
+                continue
+            growth_mb += max(0, current["used_mb"] - previous["used_mb"])
+            job_seconds += jobs * seconds
+        if job_seconds == 0:
+            return None
+        return growth_mb / job_seconds
+
+    def estimated_used_mb(self, running_jobs):
+        """Usage right now, extrapolated from the last sample."""
+        with self._lock:
+            last = self.samples[-1] if self.samples else None
+        if last is None:
+            return None
+        rate = self.growth_rate_per_job() or 0
+        return last["used_mb"] + rate * running_jobs * (time.time() - last["time"])
+
+    def seconds_until(self, percent, running_jobs):
+        """
+        Predicted seconds until the usage reaches percent of the quota with running_jobs jobs.
+        Returns 0 if it is already there and None if the usage is not growing.
+        """
+        with self._lock:
+            last = self.samples[-1] if self.samples else None
+        if last is None:
+            return None
+        remaining_mb = last["quota_mb"] * percent / 100 - self.estimated_used_mb(running_jobs)
+        if remaining_mb <= 0:
+            return 0
+        rate = self.growth_rate_per_job()
+        if not rate or running_jobs <= 0:
+            return None
+        return remaining_mb / (rate * running_jobs)
+
+    def should_offload(self, running_jobs):
+        """
+        Offload when the usage is above cfg.THRESHOLD, or when it is predicted to reach
+        cfg.QUOTA_LIMIT_PERCENT before an offload started now would have freed the space.
+        """
+        with self._lock:
+            last = self.samples[-1] if self.samples else None
+        if last is None:
+            return False
+        if self.estimated_used_mb(running_jobs) / last["quota_mb"] * 100 > cfg.THRESHOLD:
+            return True
+        time_to_full = self.seconds_until(cfg.QUOTA_LIMIT_PERCENT, running_jobs)
+        return time_to_full is not None and time_to_full < cfg.QUOTA_OFFLOAD_LEAD_SECONDS
+
+    def seconds_until_offload(self, running_jobs):
+        """Time until should_offload() is expected to become True, None if the usage is not growing."""
+        time_to_threshold = self.seconds_until(cfg.THRESHOLD, running_jobs)
+        time_to_full = self.seconds_until(cfg.QUOTA_LIMIT_PERCENT, running_jobs)
+        if time_to_full is None:
+            return time_to_threshold
+        time_to_lead = max(0, time_to_full - cfg.QUOTA_OFFLOAD_LEAD_SECONDS)
+        return time_to_lead if time_to_threshold is None else min(time_to_threshold, time_to_lead)
+
+    def mb_to_free(self, running_jobs, target_percent=None):
+        """
+        Space an offload has to free, so the usage drops to target_percent (cfg.QUOTA_OFFLOAD_TARGET_PERCENT)
+        and stays below cfg.QUOTA_LIMIT_PERCENT for twice the offload lead time. The margin keeps a
+        predictive offload from being triggered again right after the previous one.
+        """
+        target_percent = cfg.QUOTA_OFFLOAD_TARGET_PERCENT if target_percent is None else target_percent
+        with self._lock:
+            last = self.samples[-1] if self.samples else None
+        if last is None:
+            return 0
+        used_mb = self.estimated_used_mb(running_jobs)
+        growth_mb = (self.growth_rate_per_job() or 0) * running_jobs * 2 * cfg.QUOTA_OFFLOAD_LEAD_SECONDS
+        return max(0, used_mb - last["quota_mb"] * target_percent / 100,
+                   used_mb + growth_mb - last["quota_mb"] * cfg.QUOTA_LIMIT_PERCENT / 100)
+
+def plan_offload(directory_sizes, mb_to_free):
+    """
+    Pick the directories to offload so that at least mb_to_free is freed with as few transfers as possible.
+    Large directories go first, but once a single directory covers what is left, the smallest such
+    directory is taken instead of the largest, so no more is transferred than needed.
+    :param directory_sizes: dict of {directory: size_mb} of the finished directories
+    :return: (planned, deferred) lists of directories
+    """
+    remaining = sorted(directory_sizes, key=directory_sizes.get, reverse=True)
+    planned = []
+    freed_mb = 0
+    while remaining and freed_mb < mb_to_free:
+        needed_mb = mb_to_free - freed_mb
+        covering = [directory for directory in remaining if directory_sizes[directory] >= needed_mb]
+        directory = covering[-1] if covering else remaining[0]
+        remaining.remove(directory)
+        planned.append(directory)
+        freed_mb += directory_sizes[directory]
+    return planned, remaining
+
+_quota_manager = None
+
+def get_quota_manager():
+    global _quota_manager
+    if _quota_manager is None:
+        _quota_manager = QuotaManager()
+    return _quota_manager
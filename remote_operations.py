@@ -1,7 +1,11 @@
 import paramiko
 import logging
+import json
 import os
 import config as cfg
+import slurm_operations as sops
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 # Setup logging
@@ -17,93 +21,163 @@ def print_red(text):
 def print_blue(text):
     print(f"\033[38;2;50;128;128m{text}\033[0m")
 
-def ssh_kinit_loop(num_of_loop_iterations):
-    gpu_list = ['ampere', 'pascal', 'ada']
-    for i in range(0,num_of_loop_iterations):
-        logging.info(f"Kinit Loop iteration number: {i+1}")
-        print(f"Kinit loop iteration number: {i+1}")
-        for card in gpu_list:
-            gpus_initialized = False
-            while not gpus_initialized:
-                print(f"Running kinit for {card} GPU servers")
-                logging.info(f" -- Running kinit for {card} GPU servers")
-                gpus_initialized = ssh_kinit(card)
-                print(f"{card} GPU initialized: {gpus_initialized}")
-                logging.info(f" -- {card} GPU initialized: {gpus_initialized}")
-    else:
-        return True
+def wait_for(condition, timeout, initial_interval=cfg.WAIT_INITIAL_INTERVAL_SECONDS,
+             max_interval=cfg.WAIT_MAX_INTERVAL_SECONDS, description=None):
+    """
+    Poll condition() with exponential backoff until it returns a truthy value or timeout seconds passed.
+    Replaces fixed sleeps, so callers continue as soon as the job id or file they wait for is there.
+    :param condition: callable without arguments, called at least once
+    :param timeout: deadline in seconds
+    :return: the last value returned by condition (falsy if the deadline passed)
+    """
+    deadline = time.monotonic() + timeout
+    interval = initial_interval
+    while True:
+        result = condition()
+        remaining = deadline - time.monotonic()
+        if result or remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+    if not result and description:
+        logging.info(f"    Gave up waiting for {description} after {timeout}s")
+    return result
 
-def ssh_kinit(gpu, remote_host=cfg.REMOTE_HOST, username=cfg.USERNAME, password=cfg.PASSWORD):
-    try:
-        # Create an SSH client instance
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        # Connect to the remote host
-        ssh.connect(remote_host, username=username, password=password)
-
-        # Open an SSH session
-        # logging.info("Started a shell to check GPU availability")
-        session = ssh.invoke_shell()
-        time.sleep(5)
-        logging.info(f'    Executing Command: srun -G 1 -C {gpu} --pty bash')
-        session.send(f'srun -G 1 -C {gpu} --pty bash\n')
-        time.sleep(3)
-        output = session.recv(4096).decode('utf-8')
-        # logging.info(f"Shell output: {output}")
-
-        # Check for any errors in the output
-        if 'Permission denied' in output or 'error' in output.lower():
-            print("Error running srun command. Running kinit")
-            logging.error("Error running srun command. Running kinit")
-            # Run the kinit command
-            session.send('kinit\n')
-            output = session.recv(4096).decode('utf-8')
-            logging.error(output)
-            # Wait for the prompt to enter the password
-            time.sleep(2)
-            # Provide the kinit password
-            
-            session.send(password + '\n')
-            # Read the output
-            output = session.recv(4096).decode('utf-8')
-
-            time.sleep(2)  # Wait for the command to execute
-
-            session.send('cd')
-            output = session.recv(4096).decode('utf-8')
-            # logging.info(f"Shell output for cd command: {output}")
-            time.sleep(1)
-            if 'Permission denied' in output or 'error' in output.lower():
-                session.close()
-                ssh.close()
-                return False
-
-        # Close the session and SSH connection
-        session.close()
-        ssh.close()
-        return True
+class SSHConnectionPool:
+    """
+    Keeps a number of authenticated paramiko transports open to the remote host and hands out
+    channels on them. It exposes exec_command, invoke_shell and close like a paramiko SSHClient,
+    so it can be passed around as the ``ssh`` object. Dropped transports are reconnected
+    transparently the next time a channel is requested.
+    """
+    def __init__(self, remote_host, username, password, size=cfg.SSH_POOL_SIZE,
+                 keepalive_seconds=cfg.SSH_KEEPALIVE_SECONDS, reconnect_attempts=cfg.SSH_RECONNECT_ATTEMPTS):
+        self.remote_host = remote_host
+        self.username = username
+        self.password = password
+        self.size = max(1, size)
+        self.keepalive_seconds = keepalive_seconds
+        self.reconnect_attempts = reconnect_attempts
+        self._clients = [None] * self.size
+        self._next_client = 0
+        self._lock = threading.Lock()
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        logging.error(f"An error occurred: {e}")
-    finally: 
-        session.close()
-        ssh.close()
+    def _connect(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname=self.remote_host, username=self.username, password=self.password)
+        client.get_transport().set_keepalive(self.keepalive_seconds)
+        return client
+
+    @staticmethod
+    def _is_alive(client):
+        if client is None:
+            return False
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _get_client(self, index):
+        client = self._clients[index]
+        if self._is_alive(client):
+            return client
+        if client is not None:
+            logging.error(f"SSH transport {index} to {self.remote_host} dropped. Reconnecting.")
+            print_red(f"SSH transport {index} to {self.remote_host} dropped. Reconnecting.")
+            client.close()
+        for attempt in range(self.reconnect_attempts):
+            try:
+                self._clients[index] = self._connect()
+                return self._clients[index]
+            except paramiko.AuthenticationException:
+                # Retrying a rejected password only risks locking the account
+                raise
+            except (paramiko.SSHException, OSError) as e:
+                logging.error(f"SSH connection attempt {attempt + 1} to {self.remote_host} failed: {e}")
+                time.sleep(2 ** attempt)
+        self._clients[index] = None
+        raise paramiko.SSHException(f"Could not connect to {self.remote_host} after {self.reconnect_attempts} attempts")
+
+    def get_client(self):
+        """Return the next live SSHClient in round robin order, reconnecting it if needed."""
+        with self._lock:
+            index = self._next_client
+            self._next_client = (self._next_client + 1) % self.size
+            return self._get_client(index)
+
+    def get_transport(self):
+        return self.get_client().get_transport()
+
+    def exec_command(self, command, **kwargs):
+        client = self.get_client()
+        try:
+            return client.exec_command(command, **kwargs)
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            # The transport died between the liveness check and opening the channel, retry once
+            logging.error(f"exec_command failed on pooled connection: {e}. Retrying.")
+            client.close()
+            return self.get_client().exec_command(command, **kwargs)
+
+    def invoke_shell(self, **kwargs):
+        return self.get_client().invoke_shell(**kwargs)
+
+    def close(self):
+        with self._lock:
+            for client in self._clients:
+                if client is not None:
+                    client.close()
+            self._clients = [None] * self.size
+
+_ssh_pool = None
+
+def get_ssh_pool(remote_host=cfg.REMOTE_HOST, username=cfg.USERNAME, password=cfg.PASSWORD):
+    """Return the process wide connection pool, creating it on first use."""
+    global _ssh_pool
+    if _ssh_pool is None:
+        _ssh_pool = SSHConnectionPool(remote_host, username, password)
+    return _ssh_pool
 
 def connect_ssh(remote_host, username, password):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    global _ssh_pool
     try:
-        ssh.connect(hostname=remote_host, username=username, password=password)
+        _ssh_pool = SSHConnectionPool(remote_host, username, password)
+        # Open the first transport right away so authentication problems show up at startup
+        _ssh_pool.get_client()
         print_green("Successfully connected to SSH.")
         logging.info("Successfully connected to SSH.")
-        return ssh
+        return _ssh_pool
     except Exception as e:
         print_red(f"Failed to connect to SSH: {e}")
         logging.error(f"Failed to connect to SSH: {e}")
+        _ssh_pool = None
         return None
     
+def run_concurrently(function, items, max_workers=cfg.REMOTE_COMMAND_CONCURRENCY):
+    """
+    Call function(item) for every item with at most max_workers calls in flight.
+    :param function: callable that takes a single item, usually a lambda wrapping an ssh call
+    :param items: iterable of arguments
+    :param max_workers: bounded concurrency limit
+    :return: list of results in the same order as items
+    """
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(function, items))
+
+def run_remote_commands(ssh, commands, max_workers=cfg.REMOTE_COMMAND_CONCURRENCY):
+    """
+    Fan out independent commands over several channels and collect their output.
+    :param ssh: ssh object (or SSHConnectionPool) used to connect to the remote pc
+    :param commands: list of shell commands
+    :param max_workers: bounded concurrency limit
+    :return: list of (stdout, stderr) strings in the same order as commands
+    """
+    def run(command):
+        stdin, stdout, stderr = ssh.exec_command(command)
+        return stdout.read().decode(), stderr.read().decode()
+    return run_concurrently(run, commands, max_workers)
+
 def check_remote_file_exists(ssh, path):
     # logging.info(f"Check if remote file exists in: {path})")
     # logging.info(f"Executing: 'if [ -f {path} ]; then echo 'exists'; fi'")
@@ -147,14 +221,17 @@ def check_and_update_status(ssh, job, status_file, new_status, source_directory,
 def find_associated_batch_file(ssh, base_dir, work_dir):
     logging.info(f"Find associated batch file: {base_dir}, {work_dir})")
     # Find the batch file associated with the work_dir
+    batch_file_paths = []
     for dir_name in [d for d in list_remote_directories(ssh, base_dir) if d.startswith('_')]:
         full_dir_path = os.path.join(base_dir, dir_name).replace("\\", "/")
         for filename in list_remote_files(ssh, full_dir_path):
-            batch_file_path = os.path.join(full_dir_path, filename).replace("\\", "/")
-            python_file_name = get_python_file_name_from_batch_file(ssh, batch_file_path)
-            if python_file_name == work_dir:
-                logging.info(f"Found batch file: {batch_file_path}")
-                return batch_file_path
+            batch_file_paths.append(os.path.join(full_dir_path, filename).replace("\\", "/"))
+    batch_file_infos = get_batch_file_infos(ssh, batch_file_paths)
+    for batch_file_path in batch_file_paths:
+        info = batch_file_infos[batch_file_path]
+        if info and info["working_directory"] == work_dir:
+            logging.info(f"Found batch file: {batch_file_path}")
+            return batch_file_path
     return None
 
 def find_sbatch_files_from_directory(ssh):
@@ -192,41 +269,345 @@ def list_remote_directories(ssh, path):
     return [os.path.basename(d.rstrip('/')) for d in dirs] # returns object of directories to check 
     # [d for d in rops.list_remote_directories(ssh, base_dir) if d.startswith('_')] returns directories names only starting with '_'
 
+# Latest mtime of every run directory and its direct sub directories, files written deeper do not change it
+WORK_DIR_MTIME_COMMAND = "find {root} -mindepth 1 -maxdepth 2 -type d -printf '%P\\t%T@\\n'"
+WORK_DIR_USAGE_COMMAND = """cd {root} && for d in {runs}; do
+  printf '%s\\t%s\\t%s\\n' "$d" "$(du -sk "$d" | cut -f1)" "$(find "$d" -type f | wc -l)"
+done"""
+
+_work_dir_index = None
+_work_dir_index_lock = threading.Lock()
+
+def load_work_dir_index():
+    global _work_dir_index
+    if _work_dir_index is None:
+        _work_dir_index = {}
+        if os.path.exists(cfg.work_dir_index_path):
+            try:
+                with open(cfg.work_dir_index_path, 'r') as index_file:
+                    _work_dir_index = json.load(index_file)
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not read {cfg.work_dir_index_path}, starting with an empty index: {e}")
+    return _work_dir_index
+
+def save_work_dir_index():
+    with open(cfg.work_dir_index_path + '.tmp', 'w') as index_file:
+        json.dump(load_work_dir_index(), index_file, indent=4)
+    os.replace(cfg.work_dir_index_path + '.tmp', cfg.work_dir_index_path)
+
+def get_work_dir_root():
+    return os.path.join(cfg.REMOTE_BASE_PATH, cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR).replace("\\", "/")
+
+def get_work_dir_index(ssh, work_dir_root=None):
+    """
+    Return the disk usage of every work_dirs/<run> directory. du only runs for runs whose directory
+    (or one of its direct sub directories) changed since the last call, all other sizes come from
+    the index on disk. Files that only grow in place (e.g. a log being appended to) do not change
+    the mtime, so their growth shows up the next time a checkpoint is written.
+    :return: dict of {run: {"mtime", "size_mb", "files"}}
+    """
+    work_dir_root = work_dir_root or get_work_dir_root()
+    stdin, stdout, stderr = ssh.exec_command(WORK_DIR_MTIME_COMMAND.format(root=work_dir_root))
+    mtimes = {}
+    for line in stdout.read().decode().splitlines():
+        parts = line.split('\t')
+        if len(parts) == 2:
+            run = parts[0].split('/')[0]
+            mtimes[run] = max(mtimes.get(run, 0), float(parts[1]))
+
+    with _work_dir_index_lock:
+        index = load_work_dir_index()
+        stale = [run for run, mtime in mtimes.items() if index.get(run, {}).get("mtime") != mtime]
+        removed = [run for run in index if run not in mtimes]
+        for run in removed:
+            del index[run]
+        if stale:
+            logging.info(f"    Executing: du -sk on {len(stale)} changed work dirs, {len(mtimes) - len(stale)} served from the index")
+            stdin, stdout, stderr = ssh.exec_command(WORK_DIR_USAGE_COMMAND.format(
+                root=work_dir_root, runs=' '.join(f"'{run}'" for run in stale)))
+            for line in stdout.read().decode().splitlines():
+                parts = line.split('\t')
+                if len(parts) == 3 and parts[1].isdigit() and parts[0] in mtimes:
+                    index[parts[0]] = {"mtime": mtimes[parts[0]], "size_mb": int(parts[1]) / 1024, "files": int(parts[2] or 0)}
+        if stale or removed:
+            save_work_dir_index()
+        return {run: dict(entry) for run, entry in index.items()}
+
+def get_directory_sizes(ssh, directories):
+    """
+    Get the disk usage of many remote directories. Runs in work_dirs are read from the work dir
+    index, other directories are measured with one du command.
+    :return: dict of {directory: size_mb} for the directories that exist
+    """
+    if not directories:
+        return {}
+    work_dir_root = get_work_dir_root()
+    sizes = {}
+    others = []
+    index = None
+    for directory in directories:
+        if os.path.dirname(directory.rstrip('/')) != work_dir_root:
+            others.append(directory)
+            continue
+        index = index if index is not None else get_work_dir_index(ssh, work_dir_root)
+        entry = index.get(os.path.basename(directory.rstrip('/')))
+        if entry is not None:
+            sizes[directory] = entry["size_mb"]
+    if others:
+        logging.info(f"    Executing: du -sk on {len(others)} directories")
+        stdin, stdout, stderr = ssh.exec_command("du -sk " + ' '.join(others))
+        for line in stdout.read().decode().splitlines():
+            parts = line.split('\t', 1)
+            if len(parts) == 2 and parts[0].isdigit():
+                sizes[parts[1]] = int(parts[0]) / 1024
+    return sizes
+
+# Deletes the iter_<N>.pth checkpoints outside the retention policy in every directory and prints
+# "directory<TAB>file<TAB>bytes" for each deleted file. best_mIoU_iter_*.pth never matches iter_*.pth.
+PRUNE_CHECKPOINTS_COMMAND = '''for d in {directories}; do
+  (cd "$d" && ls iter_*.pth 2>/dev/null | sed -n 's/^iter_\\([0-9]*\\)\\.pth$/\\1/p' | sort -n |
+   awk -v last={keep_last} -v every={keep_every} '{{ it[NR] = $1 }} END {{ for (i = 1; i <= NR - last; i++) if (!(every > 0 && it[i] % every == 0)) print "iter_" it[i] ".pth" }}' |
+   while IFS= read -r f; do
+     size=$(stat -c %s "$f") && rm -f "$f" && printf '%s\\t%s\\t%s\\n' "$d" "$f" "$size"
+   done
+   find . -maxdepth 1 -name latest.pth -xtype l -delete)
+done'''
+
+def prune_checkpoints(ssh, directories, keep_last=cfg.CHECKPOINT_KEEP_LAST, keep_every=cfg.CHECKPOINT_KEEP_EVERY):
+    """
+    Delete intermediate checkpoints of finished trainings with one remote command.
+    The best_mIoU checkpoint is always kept, of the iter_<N>.pth checkpoints the last keep_last
+    and every iteration that is a multiple of keep_every (0 = none) are kept.
+    :return: dict of {directory: bytes reclaimed}
+    """
+    if not directories:
+        return {}
+    command = PRUNE_CHECKPOINTS_COMMAND.format(directories=' '.join(f"'{directory}'" for directory in directories),
+                                               keep_last=keep_last, keep_every=keep_every)
+    logging.info(f"    Executing: prune checkpoints in {directories} (keep last {keep_last}, keep every {keep_every})")
+    stdin, stdout, stderr = ssh.exec_command(command)
+    reclaimed = {directory: 0 for directory in directories}
+    for line in stdout.read().decode().splitlines():
+        parts = line.split('\t')
+        if len(parts) == 3 and parts[2].isdigit():
+            reclaimed[parts[0]] = reclaimed.get(parts[0], 0) + int(parts[2])
+            logging.info(f"Pruned checkpoint {parts[0]}/{parts[1]} ({int(parts[2]) / (1024 * 1024):.1f} MB)")
+    error = stderr.read().decode().strip()
+    if error:
+        logging.error(f"Error pruning checkpoints: {error}")
+    return reclaimed
+
+def parse_batch_file(lines, working_project=cfg.REMOTE_WORKING_PROJECT):
+    """
+    Parse the header of a batch file.
+    :param lines: iterable of the lines of the batch file
+    :param working_project: name of the project the train.py script lives in
+    :return: dict with job_name, working_directory, gpu_constraint and config_path (None when not found)
+    """
+    info = {"job_name": None, "working_directory": None, "gpu_constraint": None, "config_path": None}
+    for line in lines:
+        line = line.strip()
+        if line.startswith("#SBATCH --job-name") and info["job_name"] is None:
+            # Job name that will be found when running get_squeue_job, sbatch accepts "--job-name=x" and "--job-name x"
+            info["job_name"] = line[len("#SBATCH --job-name"):].lstrip("= ").strip().strip("'\"")
+        elif line.startswith("#SBATCH -J") and info["job_name"] is None:
+            info["job_name"] = line[len("#SBATCH -J"):].strip().strip("'\"")
+        elif line.startswith("#SBATCH --constraint=") and info["gpu_constraint"] is None:
+            info["gpu_constraint"] = line.split("=", 1)[-1].strip().strip("'\"")
+        elif line.startswith("#SBATCH -C ") and info["gpu_constraint"] is None:
+            info["gpu_constraint"] = line[len("#SBATCH -C "):].strip().strip("'\"")
+        elif f"python3 ~/{working_project}/tools/train.py" in line and info["config_path"] is None:
+            arguments = line.split(f"python3 ~/{working_project}/tools/train.py", 1)[-1].split()
+            if arguments:
+                info["config_path"] = arguments[0]
+                # Name of the python config file, which is also the name of the folder in work_dirs
+                info["working_directory"] = arguments[0].split("/")[-1].replace('.py', '')
+    return info
+
+_batch_file_cache = None
+_batch_file_cache_lock = threading.Lock()
+
+def load_batch_file_cache():
+    global _batch_file_cache
+    if _batch_file_cache is None:
+        _batch_file_cache = {}
+        if os.path.exists(cfg.batch_file_cache_path):
+            try:
+                with open(cfg.batch_file_cache_path, 'r') as cache_file:
+                    _batch_file_cache = json.load(cache_file)
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not read {cfg.batch_file_cache_path}, starting with an empty cache: {e}")
+    return _batch_file_cache
+
+def save_batch_file_cache():
+    with _batch_file_cache_lock:
+        # Write to a temporary file first so a crash mid-write never truncates the cache
+        with open(cfg.batch_file_cache_path + '.tmp', 'w') as cache_file:
+            json.dump(load_batch_file_cache(), cache_file, indent=4)
+        os.replace(cfg.batch_file_cache_path + '.tmp', cfg.batch_file_cache_path)
+
+def stat_remote_files(ssh, paths):
+    """
+    Get the size and modification time of many remote files with one command.
+    :return: dict of {path: (size, mtime)} for the files that exist
+    """
+    if not paths:
+        return {}
+    stdin, stdout, stderr = ssh.exec_command("stat -c '%n\t%s\t%Y' " + ' '.join(paths))
+    stats = {}
+    for line in stdout.read().decode().splitlines():
+        parts = line.split('\t')
+        if len(parts) == 3:
+            stats[parts[0]] = (int(parts[1]), int(parts[2]))
+    return stats
+
+def get_batch_file_infos(ssh, batch_file_paths):
+    """
+    Return the parsed header of every batch file, downloading only files that are not in the
+    on-disk cache yet. The cache is keyed by the batch file name (batch files keep their name when
+    moved between the status folders) and validated by the remote size and mtime.
+    :param ssh: ssh object used to connect to the remote pc
+    :param batch_file_paths: list of batch file paths from the home location
+    :return: dict of {batch_file_path: info} (see parse_batch_file), info is None for missing files
+    """
+    cache = load_batch_file_cache()
+    stats = stat_remote_files(ssh, batch_file_paths)
+    infos = {}
+    misses = []
+    for path in batch_file_paths:
+        if path not in stats:
+            infos[path] = None
+            continue
+        size, mtime = stats[path]
+        entry = cache.get(os.path.basename(path))
+        if entry is not None and entry["size"] == size and entry["mtime"] == mtime:
+            infos[path] = entry["info"]
+        else:
+            misses.append(path)
+
+    def download(path):
+        stdin, stdout, stderr = ssh.exec_command(f'cat {path}')
+        return parse_batch_file(stdout.read().decode().splitlines())
+    for path, info in zip(misses, run_concurrently(download, misses)):
+        size, mtime = stats[path]
+        with _batch_file_cache_lock:
+            cache[os.path.basename(path)] = {"size": size, "mtime": mtime, "info": info}
+        infos[path] = info
+    if misses:
+        logging.info(f"Parsed {len(misses)} new batch files, {len(batch_file_paths) - len(misses)} served from cache")
+        save_batch_file_cache()
+    return infos
+
+def get_batch_file_info(ssh, batch_file_path):
+    return get_batch_file_infos(ssh, [batch_file_path])[batch_file_path]
+
 def get_job_name_from_batch_file(ssh, batch_file_path):
-    # logging.info(f"Executing: cat {batch_file_path}")
-    stdin, stdout, stderr = ssh.exec_command(f'cat {batch_file_path}')
-    for line in stdout:
-        if line.startswith("#SBATCH --job-name="):
-            # logging.info(f"Found job-name: ({line.split('=')[-1].strip()}) from {batch_file_path}")
-            return line.split("=")[-1].strip() # Return the job name that will be found when running get_squeue_job
-    return None
+    info = get_batch_file_info(ssh, batch_file_path)
+    return info["job_name"] if info else None # Return the job name that will be found when running get_squeue_job
 
 def get_python_file_name_from_batch_file(ssh, batch_file_path, working_project=cfg.REMOTE_WORKING_PROJECT):
     # logging.info(f"Get folder name from batch file: {batch_file_path})")
-    stdin, stdout, stderr = ssh.exec_command(f'cat {batch_file_path}')
-    
-    for line in stdout:
-        line = line.strip()
-        if f"python3 ~/{working_project}/tools/train.py" in line:
-            working_line = line.replace(f'python3 ~/{working_project}/tools/train.py ~', '').replace('.py', '').split("/")
-            working_length = len(working_line)
-            working_directory = working_line[working_length - 1]
-            # logging.info(f"Found name of folder in batch file: {working_directory}")
-            return working_directory # Returns string of the name of the python file of the job
+    info = get_batch_file_info(ssh, batch_file_path)
+    return info["working_directory"] if info else None # Returns string of the name of the python file of the job
 
-    return None
+BATCH_STATUS_DIRECTORIES = ['_QUEUED', '_RUNNING', '_ERROR', '_COMPLETED', '_FINISHED']
+
+# Prints every batch file as a "\x1e<status_dir>\t<filename>" line followed by its contents. The files are
+# parsed with parse_batch_file, like the files read by get_batch_file_infos
+SNAPSHOT_COMMAND_TEMPLATE = '''
+for d in {status_dirs}; do
+  for f in {batch_root}/$d/*; do
+    [ -f "$f" ] || continue
+    printf '\\036%s\\t%s\\n' "$d" "${{f##*/}}"
+    cat "$f"
+    echo
+  done
+done
+'''
+SNAPSHOT_FILE_SEPARATOR = '\x1e'
+
+def work_dir_marker_files():
+    """Marker files the status handlers look for in a work dir."""
+    return [marker for marker in ['error_occurred.txt', 'in_progress.txt', cfg.COMPLETED_MARKER_FILE,
+                                  cfg.FINISHED_MARKER_FILE, 'extracted.txt'] if marker]
+
+def parse_snapshot_output(output):
+    """
+    Split the output of SNAPSHOT_COMMAND_TEMPLATE into the batch files.
+    :return: dict of {(status_dir, filename): [lines of the batch file]}
+    """
+    batch_files = {}
+    lines = None
+    for line in output.split('\n'):
+        if line.startswith(SNAPSHOT_FILE_SEPARATOR):
+            status_dir, filename = line[1:].split('\t', 1)
+            lines = batch_files[(status_dir, filename)] = []
+        elif lines is not None:
+            lines.append(line)
+    return batch_files
+
+def find_work_dir_markers(ssh, work_dir_root, work_dirs):
+    """
+    Find the marker files of many work dirs with one command. Sub directories are searched as well,
+    the same as the find of the status handlers without a snapshot.
+    :return: dict of {work_dir: [marker file names]}
+    """
+    markers = {work_dir: [] for work_dir in work_dirs}
+    if not work_dirs:
+        return markers
+    names = ' -o '.join(f"-name '{marker}'" for marker in work_dir_marker_files())
+    paths = ' '.join(f"{work_dir_root}/{work_dir}" for work_dir in work_dirs)
+    stdin, stdout, stderr = ssh.exec_command(f"find {paths} -type f \\( {names} \\) 2>/dev/null")
+    for line in stdout.read().decode().splitlines():
+        relative_path = line[len(work_dir_root) + 1:] if line.startswith(work_dir_root + '/') else ''
+        work_dir = relative_path.split('/')[0]
+        if work_dir in markers and os.path.basename(line) not in markers[work_dir]:
+            markers[work_dir].append(os.path.basename(line))
+    return markers
+
+def get_batch_file_snapshot(ssh, folder_directory, work_dir_root=None):
+    """
+    Collect every batch file with one remote command and the marker files of their work dirs with a
+    second one, instead of one ls/cat/find per file.
+    :param ssh: ssh object used to connect to the remote pc
+    :param folder_directory: path of the batch_files directory from the home location
+    :param work_dir_root: path of the work_dirs directory from the home location
+    :return: dict of {status_directory: {filename: entry}} where each entry has the keys
+             filename, job_name, config_path, working_directory and markers
+    """
+    if work_dir_root is None:
+        work_dir_root = os.path.join(cfg.REMOTE_WORKING_PROJECT, cfg.REMOTE_WORK_DIR).replace('\\', '/')
+    command = SNAPSHOT_COMMAND_TEMPLATE.format(status_dirs=' '.join(BATCH_STATUS_DIRECTORIES), batch_root=folder_directory)
+    logging.info(f"    Executing batch file snapshot of {folder_directory}")
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read().decode()
+    error = stderr.read().decode().strip()
+    if error:
+        logging.error(f"Error while taking batch file snapshot: {error}")
+        print_red(f"Error while taking batch file snapshot: {error}")
+
+    infos = {key: parse_batch_file(lines) for key, lines in parse_snapshot_output(output).items()}
+    work_dirs = sorted({info["working_directory"] for info in infos.values() if info["working_directory"]})
+    markers = find_work_dir_markers(ssh, work_dir_root, work_dirs)
+    snapshot = {status_dir: {} for status_dir in BATCH_STATUS_DIRECTORIES}
+    for (status_dir, filename), info in infos.items():
+        if status_dir not in snapshot:
+            continue
+        snapshot[status_dir][filename] = {
+            "filename": filename,
+            "job_name": info["job_name"] or '',
+            "config_path": info["config_path"] or '',
+            "working_directory": info["working_directory"] or '',
+            "markers": markers.get(info["working_directory"], [])
+        }
+    logging.info(f"Snapshot found {sum(len(files) for files in snapshot.values())} batch files")
+    return snapshot
 
 def get_squeue_jobs(ssh):
     # Takes in ssh object from paramiko
     logging.info("Running Squeue to see which jobs are running")
-    command = 'squeue --format="%.18i %.9P %.30j %.8u %.8T %.10M %.9l %.6D %R" --me'
-    stdin, stdout, stderr = ssh.exec_command(command)
-    squeue_output = stdout.read().decode().strip().splitlines()
-    jobs = []
-    for line in squeue_output[1:]:  # Skip header line
-        parts = line.split()
-        job_id, name, state = parts[0], parts[2], parts[4]
-        jobs.append({"job_id": job_id, "name": name, "state": state})
+    # Delimited output keeps full job names, the old fixed width columns cut them at 30 characters
+    jobs = list(sops.get_queue(ssh).values())
     logging.info(f"Jobs found to be running: {jobs}")
     if __name__ == "__main__":
         if jobs != []:
@@ -251,6 +632,20 @@ def move_batch_file(ssh, src, dest_dir):
             logging.info(f"Moved {src} to {dest_dir}")
             print(f"Moved {src} to {dest_dir}")
 
+def move_batch_files(ssh, sources, dest_dir):
+    """Move many batch files into dest_dir with one mv command."""
+    sources = [src for src in sources if os.path.join(*src.split('/')[:-1]) != dest_dir]
+    if not sources:
+        return
+    logging.info(f"    Executing: mv {sources} {dest_dir}")
+    stdin, stdout, stderr = ssh.exec_command(f"mv {' '.join(sources)} {dest_dir}/")
+    error = stderr.read().decode().strip()
+    if error:
+        logging.error(f"Error moving batch files to {dest_dir}: {error}")
+        print_red(f"Error moving batch files to {dest_dir}: {error}")
+    else:
+        logging.info(f"Moved {sources} to {dest_dir}")
+        print(f"Moved {len(sources)} batch files to {dest_dir}")
 
 def rename_remote_file(ssh, src, dest):
     # logging.info(f"Rename remote file from:{src} to:{dest})")
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+
+# Setup logging
+logging.basicConfig(filename='storage_monitor.log', level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+class AdaptiveScheduler:
+    """
+    Polls a set of named tasks, each on its own adaptive interval.
+
+    A task function returns what it observed:
+        - a number: poll again after that many seconds
+        - True: something changed, poll again after min_interval
+        - False/None: nothing changed, back off exponentially up to max_interval
+    trigger() makes a task due right away (or after a short delay) and wakes the scheduler loop,
+    so explicit events do not have to wait for the current interval to run out.
+    Tasks either run one after another (run_forever) or each in its own thread (run_workers).
+    """
+    def __init__(self):
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+    def add_task(self, name, function, min_interval, max_interval, backoff=2.0, run_immediately=True):
+        with self._lock:
+            self._tasks[name] = {
+                "function": function,
+                "min_interval": min_interval,
+                "max_interval": max_interval,
+                "backoff": backoff,
+                "interval": min_interval,
+                "next_run": time.time() if run_immediately else time.time() + min_interval,
+                "wake": threading.Event(),
+            }
+
+    def set_max_interval(self, name, max_interval):
+        """Change how far a task may back off, e.g. poll more often while jobs are running."""
+        with self._lock:
+            task = self._tasks[name]
+            task["max_interval"] = max(task["min_interval"], max_interval)
+            task["interval"] = min(task["interval"], task["max_interval"])
+
+    def trigger(self, name=None, delay=0):
+        """Make a task (or every task if name is None) due after delay seconds and wake the loop."""
+        with self._lock:
+            names = [name] if name is not None else list(self._tasks)
+            for task_name in names:
+                task = self._tasks[task_name]
+                task["next_run"] = min(task["next_run"], time.time() + delay)
+                task["interval"] = task["min_interval"]
+                task["wake"].set()
+        logging.info(f"Scheduler triggered: {names} in {delay} seconds")
+        self._wake.set()
+
+    def seconds_until_next_run(self):
+        with self._lock:
+            if not self._tasks:
+                return None
+            return max(0, min(task["next_run"] for task in self._tasks.values()) - time.time())
+
+    def _schedule_next(self, name, result):
+        with self._lock:
+            task = self._tasks[name]
+            if isinstance(result, (int, float)) and not isinstance(result, bool):
+                delay = max(task["min_interval"], min(result, task["max_interval"]))
+            elif result:
+                delay = task["min_interval"]
+            else:
+                delay = min(task["interval"] * task["backoff"], task["max_interval"])
+            task["interval"] = delay
+            # A trigger() that came in while the task was running keeps its earlier time
+            task["next_run"] = min(task["next_run"], time.time() + delay)
+        logging.info(f"Next poll of {name} in {delay:.0f} seconds")
+        return delay
+
+    def run_task(self, name):
+        with self._lock:
+            task = self._tasks[name]
+            # Push the next run out while the task is running, trigger() can pull it back in
+            task["next_run"] = float('inf')
+        try:
+            result = task["function"]()
+        except Exception as e:
+            logging.error(f"Scheduled task {name} failed: {e}")
+            print(f"\033[91mScheduled task {name} failed: {e}\033[0m")
+            result = False
+        return self._schedule_next(name, result)
+
+    def run_pending(self):
+        """Run every task that is due."""
+        now = time.time()
+        with self._lock:
+            due = [name for name, task in self._tasks.items() if task["next_run"] <= now]
+        for name in due:
+            self.run_task(name)
+        return due
+
+    def run_forever(self):
+        while not self._stopped:
+            self.run_pending()
+            wait_seconds = self.seconds_until_next_run()
+            if wait_seconds:
+                print(f"Sleeping for {wait_seconds:.0f} seconds until the next poll.")
+            self._wake.wait(wait_seconds)
+            self._wake.clear()
+
+    def _worker(self, name):
+        task = self._tasks[name]
+        while not self._stopped:
+            wait_seconds = task["next_run"] - time.time()
+            if wait_seconds > 0:
+                task["wake"].wait(wait_seconds)
+                task["wake"].clear()
+                continue
+            self.run_task(name)
+
+    def run_workers(self):
+        """
+        Run every task in its own worker thread, so a long running task (e.g. a multi gigabyte
+        offload) never delays the others. Blocks until stop() is called.
+        """
+        threads = [threading.Thread(target=self._worker, args=(name,), name=f"{name}-worker", daemon=True)
+                   for name in self._tasks]
+        for thread in threads:
+            thread.start()
+        logging.info(f"Started worker threads: {[thread.name for thread in threads]}")
+        # Join with a timeout so KeyboardInterrupt still reaches the main thread
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        with self._lock:
+            for task in self._tasks.values():
+                task["wake"].set()
@@ -0,0 +1,340 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+import config as cfg
+
+# Setup logging
+logging.basicConfig(filename='storage_monitor.log', level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+def print_green(text):
+    print(f"\033[92m{text}\033[0m")
+
+def print_red(text):
+    print(f"\033[91m{text}\033[0m")
+
+# The job name is the last field and split off with maxsplit, so names containing the delimiter
+# (and names longer than the old 30 character column) are read back exactly
+SQUEUE_FORMAT = '%i|%T|%r|%j'
+SQUEUE_FIELDS = 4
+
+# sacct states of jobs that left the queue, mapped to the job status they end in
+TERMINAL_STATE_STATUS = {
+    'COMPLETED': 'COMPLETED',
+    'FAILED': 'ERROR',
+    'CANCELLED': 'ERROR',
+    'TIMEOUT': 'ERROR',
+    'OUT_OF_MEMORY': 'ERROR',
+    'NODE_FAIL': 'ERROR',
+    'BOOT_FAIL': 'ERROR',
+    'DEADLINE': 'ERROR',
+    'PREEMPTED': 'ERROR',
+}
+
+def submit_batch_files(ssh, batch_file_paths, working_project=cfg.REMOTE_WORKING_PROJECT, constraints=None):
+    """
+    Submit many batch files with sbatch --parsable in one remote command.
+    :param batch_file_paths: paths of the batch files relative to working_project
+    :param constraints: optional dict of {batch_file_path: constraint}, passed as --constraint which overrides
+                        the #SBATCH -C line of the batch file
+    :return: dict of {batch_file_path: (job_id, error)}, job_id is None if that submission failed
+    """
+    if not batch_file_paths:
+        return {}
+    constraints = constraints or {}
+    submissions = []
+    for path in batch_file_paths:
+        option = f" --constraint='{constraints[path]}'" if constraints.get(path) else ''
+        submissions.append(f"printf '%s\\t%s\\n' '{path}' \"$(sbatch --parsable{option} '{path}' 2>&1 | tail -n 1)\"")
+    command = f"cd {working_project} ; " + ' ; '.join(submissions)
+    logging.info(f"    Executing command: cd {working_project} ; sbatch --parsable on {len(batch_file_paths)} batch files")
+    stdin, stdout, stderr = ssh.exec_command(command)
+    results = {path: (None, 'no output from sbatch') for path in batch_file_paths}
+    for line in stdout.read().decode().splitlines():
+        parts = line.split('\t', 1)
+        if len(parts) != 2 or parts[0] not in results:
+            continue
+        job_id = parts[1].split(';')[0].strip()
+        if job_id.isdigit():
+            on = f" on {constraints[parts[0]]}" if constraints.get(parts[0]) else ''
+            logging.info(f"SBATCH successful: {parts[0]} is job {job_id}{on}")
+            print_green(f"SBATCH successful: {parts[0]} is job {job_id}{on}")
+            results[parts[0]] = (job_id, '')
+        else:
+            logging.error(f"sbatch {parts[0]} did not return a job id: {parts[1]}")
+            print_red(f"sbatch {parts[0]} did not return a job id: {parts[1]}")
+            results[parts[0]] = (None, parts[1])
+    return results
+
+def submit_batch_file(ssh, batch_file_path, working_project=cfg.REMOTE_WORKING_PROJECT, constraint=None):
+    """Submit one batch file, see submit_batch_files. Returns (job_id, error)."""
+    return submit_batch_files(ssh, [batch_file_path], working_project, {batch_file_path: constraint})[batch_file_path]
+
+def parse_squeue_output(output):
+    """Parse squeue --noheader --format=SQUEUE_FORMAT output into {job_id: {job_id, name, state, reason}}."""
+    jobs = {}
+    for line in output.splitlines():
+        parts = line.split('|', SQUEUE_FIELDS - 1)
+        if len(parts) == SQUEUE_FIELDS:
+            job_id, state, reason, name = parts
+            jobs[job_id] = {"job_id": job_id, "name": name, "state": state, "reason": reason}
+    return jobs
+
+def get_queue(ssh, job_ids=None):
+    """
+    Query squeue for the given job ids, or for all jobs of the user if job_ids is None.
+    :return: dict of {job_id: {job_id, name, state, reason}} of the jobs still in the queue
+    """
+    if job_ids is not None:
+        job_ids = sorted(set(job_ids))
+        if not job_ids:
+            return {}
+        selection = f"--jobs={','.join(job_ids)}"
+    else:
+        selection = '--me'
+    # --array lists every array task on its own line ("123_4") instead of one compressed line
+    command = f"squeue --noheader --array --format='{SQUEUE_FORMAT}' {selection}"
+    logging.info(f"    Executing: {command}")
+    stdin, stdout, stderr = ssh.exec_command(command)
+    jobs = parse_squeue_output(stdout.read().decode())
+    error = stderr.read().decode().strip()
+    # squeue rejects ids that already left the queue, those simply are not in the result
+    if error and 'Invalid job id' not in error:
+        logging.error(f"squeue failed: {error}")
+        print_red(f"squeue failed: {error}")
+    return jobs
+
+def get_terminal_states(ssh, job_ids):
+    """
+    Ask sacct how jobs that left the queue ended.
+    :return: dict of {job_id: {"state", "exit_code", "status"}}, status is the job status it maps to
+             (None for states that are not terminal, e.g. a job that is requeued)
+    """
+    job_ids = sorted(set(job_ids))
+    if not job_ids:
+        return {}
+    command = f"sacct --noheader --parsable2 --allocations --format=JobID,State,ExitCode --jobs={','.join(job_ids)}"
+    logging.info(f"    Executing: {command}")
+    stdin, stdout, stderr = ssh.exec_command(command)
+    states = {}
+    for line in stdout.read().decode().splitlines():
+        parts = line.split('|')
+        if len(parts) != 3:
+            continue
+        job_id, state, exit_code = parts
+        # "CANCELLED by 1234" -> CANCELLED
+        state = state.split()[0] if state else ''
+        states[job_id] = {"state": state, "exit_code": exit_code, "status": TERMINAL_STATE_STATUS.get(state)}
+    error = stderr.read().decode().strip()
+    if error:
+        logging.error(f"sacct failed: {error}")
+    return states
+
+# Placeholders for the values that differ between the batch files of a sweep
+NAME_PLACEHOLDER = '@@WORKING_DIRECTORY@@'
+JOB_PLACEHOLDER = '@@JOB_NAME@@'
+# "#SBATCH --job-name=x", "#SBATCH --job-name x" and "#SBATCH -J x"
+JOB_NAME_OPTION_PATTERN = re.compile(r'#SBATCH\s+(--job-name(=|\s+)|-J\s*)')
+
+def batch_file_template(content, working_directory, job_name):
+    """
+    Replace the working directory (config name) and job name in a batch file with placeholders.
+    Batch files of one sweep differ only in those values, so they end up with the same template.
+    """
+    for value, placeholder in sorted([(working_directory, NAME_PLACEHOLDER), (job_name, JOB_PLACEHOLDER)],
+                                     key=lambda item: len(item[0] or ''), reverse=True):
+        if value:
+            content = content.replace(value, placeholder)
+    return content
+
+def group_by_template(batch_files, min_size=2):
+    """
+    Group batch files that share a template.
+    :param batch_files: dict of {batch_file: (content, working_directory, job_name)}
+    :return: list of (template, [batch_file, ...]) with at least min_size batch files, in input order
+    """
+    groups = defaultdict(list)
+    for batch_file, (content, working_directory, job_name) in batch_files.items():
+        # The task id is mapped to its values with a bash array, other shells are submitted on their own
+        if not content.startswith('#!') or 'bash' not in content.splitlines()[0]:
+            continue
+        groups[batch_file_template(content, working_directory, job_name)].append(batch_file)
+    return [(template, members) for template, members in groups.items() if len(members) >= min_size]
+
+def build_array_batch_file(template, working_directories, job_names, concurrency):
+    """
+    Build one sbatch --array script from a sweep template. Task i runs with working_directories[i] and
+    job_names[i], at most concurrency tasks run at the same time.
+    """
+    lines = template.splitlines()
+    last_sbatch_line = max((i for i, line in enumerate(lines) if line.startswith('#SBATCH')), default=0)
+    array_name = os.path.commonprefix(job_names).rstrip('_-') or 'sweep'
+    built = []
+    for i, line in enumerate(lines):
+        if line.startswith('#SBATCH'):
+            if JOB_NAME_OPTION_PATTERN.match(line):
+                line = f'#SBATCH --job-name={array_name}'
+            else:
+                # e.g. --output: one file per array task
+                line = line.replace(NAME_PLACEHOLDER, '%A_%a').replace(JOB_PLACEHOLDER, '%A_%a')
+        else:
+            line = line.replace(NAME_PLACEHOLDER, '${SWEEP_WORKING_DIRECTORY}').replace(JOB_PLACEHOLDER, '${SWEEP_JOB_NAME}')
+        built.append(line)
+        if i == last_sbatch_line:
+            built += [
+                f'#SBATCH --array=0-{len(working_directories) - 1}%{concurrency}',
+                f"SWEEP_WORKING_DIRECTORIES=({' '.join(working_directories)})",
+                f"SWEEP_JOB_NAMES=({' '.join(job_names)})",
+                'SWEEP_WORKING_DIRECTORY=${SWEEP_WORKING_DIRECTORIES[$SLURM_ARRAY_TASK_ID]}',
+                'SWEEP_JOB_NAME=${SWEEP_JOB_NAMES[$SLURM_ARRAY_TASK_ID]}',
+            ]
+    return '\n'.join(built) + '\n'
+
+def submit_generated_batch_file(ssh, content, batch_file_path, working_project=cfg.REMOTE_WORKING_PROJECT, constraint=None):
+    """
+    Write a batch file generated by this script (array or evaluation job) to the remote and submit it.
+    sbatch keeps its own copy of the script, so the file is removed once the job has an id.
+    :param batch_file_path: path of the batch file relative to working_project
+    :return: (job_id, error), task i of an array job is tracked as "<job_id>_<i>"
+    """
+    full_path = f"{working_project}/{batch_file_path}"
+    logging.info(f"    Writing batch file {full_path}")
+    stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {os.path.dirname(full_path)} && cat > {full_path}")
+    stdin.write(content)
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    error = stderr.read().decode().strip()
+    if error:
+        logging.error(f"Could not write {full_path}: {error}")
+        print_red(f"Could not write {full_path}: {error}")
+        return None, error
+    job_id, error = submit_batch_file(ssh, batch_file_path, working_project, constraint)
+    if job_id is not None:
+        stdin, stdout, stderr = ssh.exec_command(f"rm -f {full_path}")
+        error = stderr.read().decode().strip()
+        if error:
+            logging.error(f"Could not remove {full_path}: {error}")
+    return job_id, error
+
+# One line per node, the fields are padded to fixed widths and contain no spaces
+SINFO_COMMAND = "sinfo --noheader --Node --Format='NodeHost:100,Features:200,Gres:200,GresUsed:200,StateCompact:20'"
+# Nodes in other states (alloc, drain, down, ...) cannot start a job right now
+AVAILABLE_NODE_STATES = ('idle', 'mix')
+
+def count_gpus(gres):
+    """Number of GPUs in a Gres or GresUsed field, e.g. "gpu:a4000:4(S:0-1),shard:8" -> 4."""
+    count = 0
+    for item in gres.split(','):
+        item = item.split('(')[0]
+        if item.startswith('gpu:') and item.split(':')[-1].isdigit():
+            count += int(item.split(':')[-1])
+    return count
+
+def parse_sinfo_output(output):
+    """
+    Parse SINFO_COMMAND output into free GPUs per node feature. A node counts for every feature it has.
+    sinfo --Node prints a node once per partition it is in, its GPUs are only counted once.
+    :return: dict of {feature: free_gpus}
+    """
+    free_gpus = {}
+    seen_nodes = set()
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) != 5:
+            continue
+        node, features, gres, gres_used, state = parts
+        if node in seen_nodes:
+            continue
+        seen_nodes.add(node)
+        # A trailing * means the node is not responding, other flags (~, #, ...) are stripped
+        available = state.rstrip('*~#!%$@^-+') in AVAILABLE_NODE_STATES and not state.endswith('*')
+        free = max(0, count_gpus(gres) - count_gpus(gres_used)) if available else 0
+        for feature in features.split(','):
+            if feature and feature != '(null)':
+                free_gpus[feature] = free_gpus.get(feature, 0) + free
+    return free_gpus
+
+# GPUs requested by the pending jobs of all users, with the features they are constrained to
+SQUEUE_PENDING_COMMAND = "squeue --noheader --states=PENDING --format='%f|%b|%D'"
+
+def get_free_gpus(ssh):
+    """Query sinfo once. Returns {feature: free_gpus}, empty if sinfo failed."""
+    logging.info(f"    Executing: {SINFO_COMMAND}")
+    stdin, stdout, stderr = ssh.exec_command(SINFO_COMMAND)
+    free_gpus = parse_sinfo_output(stdout.read().decode())
+    error = stderr.read().decode().strip()
+    if error:
+        logging.error(f"sinfo failed: {error}")
+    return free_gpus
+
+def choose_constraint(constraint, free_gpus):
+    """
+    Narrow a constraint like "ada|a4500|a4000" to the features that have free GPUs, most free first.
+    The constraint is kept as it is when none of its features has a free GPU (the job waits for any of them)
+    or when it is not a plain list of alternatives.
+    """
+    if not constraint:
+        return constraint
+    features = constraint.split('|')
+    if not free_gpus or any(not re.fullmatch(r'[\w.-]+', feature) for feature in features):
+        return constraint
+    free = [feature for feature in features if free_gpus.get(feature, 0) > 0]
+    if not free:
+        return constraint
+    return '|'.join(sorted(free, key=lambda feature: free_gpus[feature], reverse=True))
+
+def parse_pending_gpu_demand(output):
+    """
+    Parse SQUEUE_PENDING_COMMAND output into the GPUs pending jobs wait for per feature. A job that accepts
+    several features ("ada|a4000") counts for each of them in equal parts.
+    :return: dict of {feature: gpus}
+    """
+    demand = {}
+    for line in output.splitlines():
+        parts = line.strip().split('|')
+        if len(parts) < 3:
+            continue
+        # The feature list itself can contain |, the last two fields are the gres and the node count
+        features, gres, nodes = parts[:-2], parts[-2], parts[-1]
+        gres = ','.join(item.split('/')[-1].replace('gres:', '') for item in gres.split(','))
+        gpus = count_gpus(gres) * (int(nodes) if nodes.isdigit() else 1)
+        features = [feature.strip('()[]') for feature in features if feature and feature != '(null)']
+        if not gpus or not features:
+            continue
+        for feature in features:
+            demand[feature] = demand.get(feature, 0) + gpus / len(features)
+    return demand
+
+_cluster_capacity = None
+_cluster_capacity_time = 0
+_cluster_capacity_lock = threading.Lock()
+
+def get_cluster_capacity(ssh, max_age=cfg.CLUSTER_CAPACITY_MAX_AGE_SECONDS):
+    """
+    Free GPUs per feature (sinfo) minus the GPUs pending jobs wait for on that feature (squeue). The cluster is
+    probed at most once per max_age seconds, so one submission cycle works from a single snapshot.
+    :return: dict of {feature: free_gpus}, negative when more GPUs are requested than free
+    """
+    global _cluster_capacity, _cluster_capacity_time
+    with _cluster_capacity_lock:
+        if _cluster_capacity is not None and time.time() - _cluster_capacity_time < max_age:
+            return _cluster_capacity
+        free_gpus = get_free_gpus(ssh)
+        logging.info(f"    Executing: {SQUEUE_PENDING_COMMAND}")
+        stdin, stdout, stderr = ssh.exec_command(SQUEUE_PENDING_COMMAND)
+        demand = parse_pending_gpu_demand(stdout.read().decode())
+        _cluster_capacity = {feature: free - demand.get(feature, 0) for feature, free in free_gpus.items()}
+        _cluster_capacity_time = time.time()
+        logging.info(f"Cluster capacity (free GPUs minus pending demand): "
+                     f"{ {feature: round(free, 1) for feature, free in _cluster_capacity.items()} }")
+        return _cluster_capacity
+
+def reserve_gpu(capacity, constraint, gpus=1):
+    """Count GPUs as taken on the first feature of a chosen constraint, so the next jobs spread over the other features."""
+    if constraint:
+        feature = constraint.split('|')[0]
+        if feature in capacity:
+            capacity[feature] -= gpus
@@ -0,0 +1,81 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# config reads the .env settings on import, the evaluation queue does not use them
+os.environ.setdefault('local_path', tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import evaluation_operations as eops
+
+
+class FakeOutput:
+    def __init__(self, text):
+        self.text = text
+
+    def read(self):
+        return self.text.encode()
+
+
+class LocalSSH:
+    """Runs the commands in a local shell from a directory that stands in for the remote home."""
+    def __init__(self, home):
+        self.home = home
+
+    def exec_command(self, command):
+        result = subprocess.run(command, shell=True, cwd=self.home, capture_output=True, text=True)
+        return None, FakeOutput(result.stdout), FakeOutput(result.stderr)
+
+
+class EvaluationPriorityTest(unittest.TestCase):
+    # Found by the monitor in this order, the trainings completed in the opposite one
+    TRAININGS = (('late_found', 1000), ('early_found', 3000), ('no_marker', 2000))
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        # Set from the .env file, the default of its example
+        patches = [mock.patch.object(eops.cfg, 'COMPLETED_MARKER_FILE', 'completed.txt'),
+                   mock.patch.object(eops.cfg, 'EVALUATION_SETUP_COMMANDS', ['conda activate mmseg']),
+                   mock.patch.object(eops.cfg, 'evaluation_record_path', os.path.join(self.home, 'evaluations.json'))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.ssh = LocalSSH(self.home)
+        for work_dir, mtime in self.TRAININGS:
+            work_dir_path = os.path.join(self.home, eops.get_work_dir_path(work_dir))
+            os.makedirs(work_dir_path)
+            files = ['best_mIoU_iter_100.pth'] + (['completed.txt'] if work_dir != 'no_marker' else [])
+            for filename in files:
+                open(os.path.join(work_dir_path, filename), 'w').close()
+                os.utime(os.path.join(work_dir_path, filename), (mtime, mtime))
+            with mock.patch.object(eops.time, 'time', return_value=len(eops.load_evaluations())):
+                eops.enqueue_evaluation(self.ssh, work_dir, 'best_mIoU_iter_100.pth')
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def dispatch(self, priority):
+        with mock.patch.object(eops.cfg, 'EVALUATION_PRIORITY', priority), \
+                mock.patch.object(eops.cfg, 'EVALUATION_CONCURRENCY', 3), \
+                mock.patch.object(eops, 'submit_evaluation', return_value='1') as submit_evaluation:
+            eops.dispatch_evaluations(self.ssh, free_gpus={'ada': 3})
+        return [call[0][1] for call in submit_evaluation.call_args_list]
+
+    def test_completion_time_is_recorded(self):
+        evaluations = eops.load_evaluations()
+        self.assertEqual({work_dir: evaluations[work_dir]["completed_at"] for work_dir, _ in self.TRAININGS},
+                         {'late_found': 1000, 'early_found': 3000, 'no_marker': 2000})
+
+    def test_newest_completed_training_first(self):
+        self.assertEqual(self.dispatch('newest'), ['early_found', 'no_marker', 'late_found'])
+
+    def test_oldest_completed_training_first(self):
+        self.assertEqual(self.dispatch('oldest'), ['late_found', 'no_marker', 'early_found'])
+
+
+if __name__ == '__main__':
+    unittest.main()
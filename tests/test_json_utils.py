@@ -0,0 +1,163 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# config reads the .env settings on import, the job store does not use them
+os.environ.setdefault('local_path', tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_utils
+
+
+class FakeSSH:
+    """Records the commands it is given, moving batch files succeeds without output."""
+    def __init__(self):
+        self.commands = []
+
+    def exec_command(self, command):
+        self.commands.append(command)
+        return None, FakeOutput(''), FakeOutput('')
+
+
+class FakeOutput:
+    def __init__(self, text):
+        self.text = text
+
+    def read(self):
+        return self.text.encode()
+
+
+def snapshot_entry(filename, working_directory, markers):
+    return {"filename": filename, "job_name": working_directory, "config_path": f"configs/{working_directory}.py",
+            "working_directory": working_directory, "markers": markers}
+
+
+class LocalSSH:
+    """Runs the commands in a local shell from a directory that stands in for the remote home."""
+    def __init__(self, home):
+        self.home = home
+
+    def exec_command(self, command):
+        result = subprocess.run(command, shell=True, cwd=self.home, capture_output=True, text=True)
+        return None, FakeOutput(result.stdout), FakeOutput(result.stderr)
+
+
+class JobStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.job_store = json_utils.JobStore(os.path.join(self.directory, 'batch_files.json'),
+                                             os.path.join(self.directory, 'journal.jsonl'),
+                                             os.path.join(self.directory, 'history.jsonl')).load()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add_job(self, filename, status):
+        return self.job_store.add({"filename": filename, "job_name": filename[:-6], "working_directory": filename[:-6],
+                                   "status": status})
+
+
+class JournalTest(JobStoreTestCase):
+    def reload(self):
+        return json_utils.JobStore(self.job_store.json_file_path, self.job_store.journal_path,
+                                   self.job_store.history_path).load()
+
+    def test_record_after_a_partial_line_survives(self):
+        job = self.add_job('run.batch', 'QUEUED')
+        # A crash in the middle of an append
+        with open(self.job_store.journal_path, 'a') as journal_file:
+            journal_file.write('{"event": "status", "filen')
+        job_store = self.reload()
+        job_store.set_status(job_store.get('run.batch'), 'RUNNING')
+
+        self.assertEqual(self.reload().get('run.batch')['status'], 'RUNNING')
+
+    def test_background_compaction(self):
+        with mock.patch.object(json_utils.cfg, 'JOURNAL_COMPACTION_THRESHOLD', 3):
+            for i in range(3):
+                self.add_job(f"run_{i}.batch", 'QUEUED')
+            self.assertTrue(self.job_store.persist())
+            # Records written while the compaction runs go to the new journal
+            self.job_store.set_status(self.job_store.get('run_0.batch'), 'RUNNING')
+            self.job_store._compaction_thread.join()
+
+        with open(self.job_store.history_path, 'r') as history_file:
+            self.assertEqual(len(history_file.readlines()), 3)
+        self.assertFalse(os.path.exists(self.job_store.compacting_journal_path))
+        self.assertEqual(self.job_store.journal_records, 1)
+        self.assertEqual([job['status'] for job in self.reload()], ['RUNNING', 'QUEUED', 'QUEUED'])
+
+    def test_unfinished_compaction_is_replayed(self):
+        self.add_job('run.batch', 'QUEUED')
+        os.replace(self.job_store.journal_path, self.job_store.compacting_journal_path)
+        self.job_store.set_status(self.job_store.get('run.batch'), 'RUNNING')
+
+        job_store = self.reload()
+        self.assertEqual(job_store.get('run.batch')['status'], 'RUNNING')
+        self.assertEqual(job_store.journal_records, 2)
+        self.assertFalse(os.path.exists(job_store.compacting_journal_path))
+
+
+class SetTerminalStatusTest(JobStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        # Set from the .env file, the defaults of its example
+        for name, marker in (('COMPLETED_MARKER_FILE', 'completed.txt'), ('FINISHED_MARKER_FILE', 'finished.txt')):
+            patch = mock.patch.object(json_utils.cfg, name, marker)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def set_terminal_status(self, status, markers):
+        job = self.add_job('run.batch', 'RUNNING')
+        work_dir = os.path.join(self.directory, json_utils.cfg.REMOTE_WORKING_PROJECT, json_utils.cfg.REMOTE_WORK_DIR, 'run')
+        os.makedirs(work_dir)
+        for marker in markers:
+            open(os.path.join(work_dir, marker), 'w').close()
+        with mock.patch.object(json_utils.rops, 'move_batch_file') as move_batch_file:
+            json_utils.set_terminal_status(LocalSSH(self.directory), job, status, self.job_store, 'batch_files/_RUNNING', 'batch_files')
+        self.assertEqual(move_batch_file.call_args[0][2], f"batch_files/_{job['status']}")
+        return job['status'], sorted(os.listdir(work_dir))
+
+    def test_completed_with_completion_marker(self):
+        self.assertEqual(self.set_terminal_status('COMPLETED', ['completed.txt']), ('COMPLETED', ['completed.txt']))
+
+    def test_completed_with_leftover_in_progress_marker_is_an_error(self):
+        self.assertEqual(self.set_terminal_status('COMPLETED', ['in_progress.txt']), ('ERROR', ['error_occurred.txt']))
+
+    def test_completed_without_any_marker_is_an_error(self):
+        self.assertEqual(self.set_terminal_status('COMPLETED', []), ('ERROR', ['error_occurred.txt']))
+
+    def test_failed_job(self):
+        self.assertEqual(self.set_terminal_status('ERROR', ['in_progress.txt']), ('ERROR', ['error_occurred.txt']))
+
+
+class HandleFinishedFilesTest(JobStoreTestCase):
+    def test_several_extracted_files_under_the_store_lock(self):
+        filenames = [f"run_{i}.batch" for i in range(4)]
+        for filename in filenames:
+            self.add_job(filename, 'COMPLETED')
+        snapshot = {status_dir: {} for status_dir in ('_QUEUED', '_RUNNING', '_ERROR', '_COMPLETED', '_FINISHED')}
+        for filename in filenames:
+            snapshot['_FINISHED'][filename] = snapshot_entry(filename, filename[:-6], ['extracted.txt'])
+        snapshot['_FINISHED']['run_3.batch']['markers'] = []
+
+        def update():
+            # update_json_new holds the store lock while the handlers run
+            with self.job_store.locked():
+                json_utils.handle_finished_files(FakeSSH(), self.job_store, 'batch_files', snapshot)
+        thread = threading.Thread(target=update, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+
+        self.assertFalse(thread.is_alive(), "handle_finished_files deadlocked on the store lock")
+        self.assertEqual([self.job_store.get(filename)['status'] for filename in filenames],
+                         ['FINISHED', 'FINISHED', 'FINISHED', 'COMPLETED'])
+
+
+if __name__ == '__main__':
+    unittest.main()
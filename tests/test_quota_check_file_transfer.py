@@ -0,0 +1,114 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# config reads the .env settings on import, the monitor functions below do not use them
+os.environ.setdefault('local_path', tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_utils
+import quota_check_file_transfer as monitor
+
+BASE_DIR = 'mmseg-personal/tools/batch_files'
+
+
+class FakeRemote:
+    """Batch file folders and work dir marker files of the remote, changed by the patched remote operations."""
+    def __init__(self, batch_files, in_progress):
+        self.batch_files = batch_files  # {status_dir: [batch_file]}
+        self.in_progress = set(in_progress)  # work dirs with in_progress.txt
+        self.renamed = []
+
+    def path(self, batch_file):
+        for dir_name, files in self.batch_files.items():
+            if batch_file in files:
+                return f"{BASE_DIR}/{dir_name}/{batch_file}"
+        return None
+
+    def list_remote_directories(self, ssh, path):
+        return list(self.batch_files) if path == BASE_DIR else sorted(self.in_progress)
+
+    def list_remote_files(self, ssh, path):
+        return list(self.batch_files[path.split('/')[-1]])
+
+    def get_batch_file_infos(self, ssh, paths):
+        return {path: {"job_name": os.path.basename(path)[:-6], "working_directory": os.path.basename(path)[:-6]}
+                for path in paths}
+
+    def find_associated_batch_file(self, ssh, base_dir, work_dir):
+        return self.path(f"{work_dir}.batch")
+
+    def check_remote_file_exists(self, ssh, path):
+        return path.endswith('in_progress.txt') and path.split('/')[-2] in self.in_progress
+
+    def rename_remote_file(self, ssh, src, dest):
+        self.renamed.append((src, dest))
+
+    def move_batch_file(self, ssh, src, dest_dir):
+        batch_file = os.path.basename(src)
+        self.batch_files[src.split('/')[-2]].remove(batch_file)
+        self.batch_files[dest_dir.split('/')[-1]].append(batch_file)
+
+    def patch(self):
+        patches = [mock.patch.object(monitor.rops, name, getattr(self, name)) for name in (
+            'list_remote_directories', 'list_remote_files', 'get_batch_file_infos', 'find_associated_batch_file',
+            'check_remote_file_exists', 'rename_remote_file', 'move_batch_file')]
+        patches += [
+            mock.patch.object(monitor.rops, 'get_job_name_from_batch_file', lambda ssh, path: os.path.basename(path)[:-6]),
+            mock.patch.object(monitor.rops, 'get_python_file_name_from_batch_file', lambda ssh, path: os.path.basename(path)[:-6]),
+        ]
+        return patches
+
+
+class CheckBatchFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.job_store = json_utils.JobStore(os.path.join(self.directory, 'batch_files.json'),
+                                             os.path.join(self.directory, 'journal.jsonl'),
+                                             os.path.join(self.directory, 'history.jsonl')).load()
+        for name, job_id in (('sweep_a', '100_0'), ('sweep_b', '100_1')):
+            job = self.job_store.add({"filename": f"{name}.batch", "job_name": name, "working_directory": name,
+                                      "status": "RUNNING"})
+            self.job_store.set_job_id(job, job_id)
+        self.remote = FakeRemote({'_QUEUED': [], '_RUNNING': ['sweep_a.batch', 'sweep_b.batch'], '_ERROR': []},
+                                 in_progress=['sweep_a', 'sweep_b'])
+        patches = self.remote.patch() + [mock.patch.object(json_utils, 'get_job_store', lambda: self.job_store)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_running_array_task_stays_in_place(self):
+        # The array job runs under the common prefix of the job names, not the name of each batch file
+        jobs = [{"job_id": "100_0", "name": "sweep", "state": "RUNNING", "reason": "None"},
+                {"job_id": "100_1", "name": "sweep", "state": "PENDING", "reason": "Resources"}]
+        monitor.check_batch_files(None, jobs)
+
+        self.assertEqual(self.remote.batch_files['_RUNNING'], ['sweep_a.batch', 'sweep_b.batch'])
+        self.assertEqual(self.remote.renamed, [])
+        self.assertEqual(self.job_store.count('RUNNING'), 2)
+
+    def test_tracked_job_that_left_the_queue_is_left_to_sacct(self):
+        jobs = [{"job_id": "100_0", "name": "sweep", "state": "RUNNING", "reason": "None"}]
+        monitor.check_batch_files(None, jobs)
+
+        self.assertEqual(self.remote.batch_files['_ERROR'], [])
+        self.assertEqual(self.remote.renamed, [])
+
+    def test_untracked_job_that_left_the_queue_is_an_error(self):
+        self.job_store.set_job_id(self.job_store.get('sweep_b.batch'), None)
+        jobs = [{"job_id": "100_0", "name": "other", "state": "RUNNING", "reason": "None"}]
+        monitor.check_batch_files(None, jobs)
+
+        self.assertEqual(self.remote.batch_files['_ERROR'], ['sweep_b.batch'])
+        self.assertEqual(self.job_store.get('sweep_b.batch')['status'], 'ERROR')
+        self.assertEqual(self.job_store.get('sweep_a.batch')['status'], 'RUNNING')
+
+
+if __name__ == '__main__':
+    unittest.main()
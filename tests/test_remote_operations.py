@@ -0,0 +1,110 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# config reads the .env settings on import, the batch file parsing does not use them
+os.environ.setdefault('local_path', tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remote_operations as rops
+
+BATCH_ROOT = 'batch_files'
+WORK_DIR_ROOT = 'work_dirs'
+
+
+class FakeOutput:
+    def __init__(self, text):
+        self.text = text
+
+    def read(self):
+        return self.text.encode()
+
+
+class LocalSSH:
+    """Runs the commands in a local shell from a directory that stands in for the remote home."""
+    def __init__(self, home):
+        self.home = home
+
+    def exec_command(self, command):
+        result = subprocess.run(command, shell=True, cwd=self.home, capture_output=True, text=True)
+        return None, FakeOutput(result.stdout), FakeOutput(result.stderr)
+
+
+def batch_file(job_name_option, config):
+    return ("#!/bin/bash\n"
+            f"{job_name_option}\n"
+            "#SBATCH --constraint=ada\n"
+            f"python3 ~/{rops.cfg.REMOTE_WORKING_PROJECT}/tools/train.py configs/{config}.py --seed 0")
+
+
+class BatchFileSnapshotTest(unittest.TestCase):
+    BATCH_FILES = {
+        '_RUNNING': {'quoted.batch': batch_file("#SBATCH -J 'quoted'", 'quoted'),
+                     'long_option.batch': batch_file('#SBATCH --job-name="long_option"', 'long_option')},
+        '_COMPLETED': {'nested.batch': batch_file('#SBATCH --job-name nested', 'nested')},
+        '_QUEUED': {'no_work_dir.batch': batch_file('#SBATCH -J no_work_dir', 'no_work_dir')},
+    }
+    MARKERS = {'quoted': ['in_progress.txt'], 'long_option': [], 'nested': ['iter_100/completed.txt', 'extracted.txt']}
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        for status_dir in rops.BATCH_STATUS_DIRECTORIES:
+            os.makedirs(os.path.join(self.home, BATCH_ROOT, status_dir))
+        for status_dir, files in self.BATCH_FILES.items():
+            for filename, contents in files.items():
+                with open(os.path.join(self.home, BATCH_ROOT, status_dir, filename), 'w') as file:
+                    file.write(contents)
+        for work_dir, markers in self.MARKERS.items():
+            os.makedirs(os.path.join(self.home, WORK_DIR_ROOT, work_dir))
+            for marker in markers:
+                path = os.path.join(self.home, WORK_DIR_ROOT, work_dir, marker)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'w').close()
+        # Set from the .env file, the defaults of its example
+        patches = [mock.patch.object(rops.cfg, 'COMPLETED_MARKER_FILE', 'completed.txt'),
+                   mock.patch.object(rops.cfg, 'FINISHED_MARKER_FILE', 'finished.txt'),
+                   mock.patch.object(rops.cfg, 'batch_file_cache_path', os.path.join(self.home, 'cache.json')),
+                   mock.patch.object(rops, '_batch_file_cache', None)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.ssh = LocalSSH(self.home)
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def test_snapshot_matches_the_per_file_parse(self):
+        snapshot = rops.get_batch_file_snapshot(self.ssh, BATCH_ROOT, WORK_DIR_ROOT)
+        paths = [f"{BATCH_ROOT}/{status_dir}/{filename}"
+                 for status_dir, files in self.BATCH_FILES.items() for filename in files]
+        infos = rops.get_batch_file_infos(self.ssh, paths)
+
+        for path, info in infos.items():
+            status_dir, filename = path.split('/')[-2:]
+            entry = snapshot[status_dir][filename]
+            self.assertEqual((entry["job_name"], entry["config_path"], entry["working_directory"]),
+                             (info["job_name"], info["config_path"], info["working_directory"]))
+        self.assertEqual(snapshot['_RUNNING']['quoted.batch']["job_name"], 'quoted')
+        self.assertEqual(snapshot['_RUNNING']['long_option.batch']["job_name"], 'long_option')
+        self.assertEqual(snapshot['_COMPLETED']['nested.batch']["job_name"], 'nested')
+        self.assertEqual(sum(len(files) for files in snapshot.values()), len(paths))
+
+    def test_snapshot_markers_match_the_recursive_find(self):
+        snapshot = rops.get_batch_file_snapshot(self.ssh, BATCH_ROOT, WORK_DIR_ROOT)
+        for files in snapshot.values():
+            for entry in files.values():
+                for marker in rops.work_dir_marker_files():
+                    command = f"find {WORK_DIR_ROOT}/{entry['working_directory']} -type f -name '{marker}'"
+                    stdin, stdout, stderr = self.ssh.exec_command(command)
+                    self.assertEqual(marker in entry["markers"], bool(stdout.read().decode().strip()),
+                                     f"{marker} of {entry['filename']}")
+        self.assertEqual(sorted(snapshot['_COMPLETED']['nested.batch']["markers"]), ['completed.txt', 'extracted.txt'])
+        self.assertEqual(snapshot['_QUEUED']['no_work_dir.batch']["markers"], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
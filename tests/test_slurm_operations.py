@@ -0,0 +1,110 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# config reads the .env settings on import, the parsers below do not use them
+os.environ.setdefault('local_path', tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import slurm_operations as sops
+
+
+class CountGpusTest(unittest.TestCase):
+    def test_typed_gres_with_socket_binding(self):
+        self.assertEqual(sops.count_gpus("gpu:a4000:4(S:0-1),shard:8"), 4)
+
+    def test_untyped_gres(self):
+        self.assertEqual(sops.count_gpus("gpu:2"), 2)
+
+    def test_no_gpus(self):
+        self.assertEqual(sops.count_gpus("(null)"), 0)
+        self.assertEqual(sops.count_gpus("gpu:a4000:0(IDX:N/A)"), 0)
+
+
+class ParseSinfoOutputTest(unittest.TestCase):
+    def test_free_gpus_per_feature(self):
+        output = (
+            "gpu1 ada,avx gpu:ada:4 gpu:ada:1(IDX:0) mix\n"
+            "gpu2 a4000 gpu:a4000:8 gpu:a4000:8(IDX:0-7) alloc\n"
+            "gpu3 a4000 gpu:a4000:4 gpu:a4000:0(IDX:N/A) idle\n"
+        )
+        self.assertEqual(sops.parse_sinfo_output(output), {"ada": 3, "avx": 3, "a4000": 4})
+
+    def test_node_in_several_partitions_counts_once(self):
+        output = (
+            "gpu1 ada gpu:ada:4 gpu:ada:1(IDX:0) mix\n"
+            "gpu1 ada gpu:ada:4 gpu:ada:1(IDX:0) mix\n"
+        )
+        self.assertEqual(sops.parse_sinfo_output(output), {"ada": 3})
+
+    def test_unavailable_nodes(self):
+        output = (
+            "gpu1 ada gpu:ada:4 gpu:ada:0(IDX:N/A) idle*\n"
+            "gpu2 ada gpu:ada:4 gpu:ada:0(IDX:N/A) drain\n"
+        )
+        self.assertEqual(sops.parse_sinfo_output(output), {"ada": 0})
+
+
+class ParsePendingGpuDemandTest(unittest.TestCase):
+    def test_single_feature(self):
+        self.assertEqual(sops.parse_pending_gpu_demand("ada|gres/gpu:1|1\n"), {"ada": 1})
+
+    def test_alternatives_split_the_demand(self):
+        self.assertEqual(sops.parse_pending_gpu_demand("ada|a4000|gres/gpu:2|1\n"), {"ada": 1, "a4000": 1})
+
+    def test_multiple_nodes(self):
+        self.assertEqual(sops.parse_pending_gpu_demand("a4500|gres:gpu:2|2\n"), {"a4500": 4})
+
+    def test_jobs_without_feature_or_gpu(self):
+        output = (
+            "(null)|gres/gpu:1|1\n"
+            "ada|(null)|1\n"
+            "garbage\n"
+        )
+        self.assertEqual(sops.parse_pending_gpu_demand(output), {})
+
+
+class BuildArrayBatchFileTest(unittest.TestCase):
+    TEMPLATE = (
+        "#!/bin/bash\n"
+        "{job_name_option}\n"
+        "#SBATCH --output=@@JOB_NAME@@.out\n"
+        "python3 ~/mmseg-personal/tools/train.py configs/@@WORKING_DIRECTORY@@.py\n"
+    )
+
+    def build(self, job_name_option):
+        template = self.TEMPLATE.format(job_name_option=job_name_option)
+        return sops.build_array_batch_file(template, ['sweep_a', 'sweep_b'], ['run_a', 'run_b'], 2).splitlines()
+
+    def test_job_name_option_forms(self):
+        for option in ("#SBATCH --job-name=@@JOB_NAME@@", "#SBATCH --job-name @@JOB_NAME@@", "#SBATCH -J @@JOB_NAME@@"):
+            lines = self.build(option)
+            self.assertEqual(lines[1], "#SBATCH --job-name=run")
+            self.assertNotIn("@@", '\n'.join(lines))
+
+    def test_array_options(self):
+        lines = self.build("#SBATCH -J @@JOB_NAME@@")
+        self.assertEqual(lines[2], "#SBATCH --output=%A_%a.out")
+        self.assertEqual(lines[3], "#SBATCH --array=0-1%2")
+        self.assertEqual(lines[-1], "python3 ~/mmseg-personal/tools/train.py configs/${SWEEP_WORKING_DIRECTORY}.py")
+
+
+class ChooseConstraintTest(unittest.TestCase):
+    def test_narrowed_to_free_features_most_free_first(self):
+        free_gpus = {"ada": 1, "a4500": 0, "a4000": 3}
+        self.assertEqual(sops.choose_constraint("ada|a4500|a4000", free_gpus), "a4000|ada")
+
+    def test_kept_when_nothing_is_free(self):
+        self.assertEqual(sops.choose_constraint("ada|a4000", {"ada": 0, "a4000": -1}), "ada|a4000")
+
+    def test_kept_when_not_plain_alternatives(self):
+        self.assertEqual(sops.choose_constraint("[ada|a4000]", {"ada": 2}), "[ada|a4000]")
+        self.assertEqual(sops.choose_constraint("ada&avx", {"ada": 2}), "ada&avx")
+
+    def test_empty_constraint(self):
+        self.assertEqual(sops.choose_constraint("", {"ada": 2}), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
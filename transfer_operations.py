@@ -0,0 +1,509 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import queue
+import re
+import subprocess
+import tarfile
+import threading
+import time
+from collections import defaultdict
+import paramiko
+import config as cfg
+import remote_operations as rops
+import quota_manager
+
+# Setup logging
+logging.basicConfig(filename='storage_monitor.log', level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+def print_green(text):
+    print(f"\033[92m{text}\033[0m")
+
+def print_red(text):
+    print(f"\033[91m{text}\033[0m")
+
+def print_blue(text):
+    print(f"\033[38;2;50;128;128m{text}\033[0m")
+
+# rsync --info=progress2 prints lines like "  1,234,567  45%   10.52MB/s    0:00:12"
+RSYNC_PROGRESS_PATTERN = re.compile(r'([\d,]+)\s+(\d+)%\s+([\d.]+\w+/s)')
+
+def get_offload_profile(name=None):
+    """Return the include/exclude rules of an offload profile, cfg.OFFLOAD_PROFILE by default."""
+    name = name or cfg.OFFLOAD_PROFILE
+    if name not in cfg.OFFLOAD_PROFILES:
+        raise ValueError(f"Unknown offload profile '{name}', expected one of {list(cfg.OFFLOAD_PROFILES)}")
+    return cfg.OFFLOAD_PROFILES[name]
+
+def is_full_profile(profile):
+    return '*' in profile['include']
+
+def is_selected_file(relative_path, profile):
+    """
+    Check a file of a work dir against an offload profile. Excludes match any part of the path,
+    includes only match files in the top level unless the profile includes '*'.
+    Uses the same rules as the rsync filters from rsync_filter_arguments().
+    """
+    parts = relative_path.split('/')
+    if any(fnmatch.fnmatch(part, pattern) for part in parts for pattern in profile['exclude']):
+        return False
+    if is_full_profile(profile):
+        return True
+    return len(parts) == 1 and any(fnmatch.fnmatch(parts[0], pattern) for pattern in profile['include'])
+
+def rsync_filter_arguments(profile):
+    arguments = [f'--exclude={pattern}' for pattern in profile['exclude']]
+    if not is_full_profile(profile):
+        # The trailing --exclude=* also drops every sub directory, so only top level files are copied
+        arguments += [f'--include={pattern}' for pattern in profile['include']] + ['--exclude=*']
+    return arguments
+
+def build_rsync_command(directory, local_directory, bandwidth_limit_kbps=0, profile=None):
+    """
+    Build the sshpass + rsync command that copies the contents of a remote directory into local_directory,
+    keeping only the files selected by the offload profile.
+    All rsync calls share one SSH master connection, so only the first one pays for the handshake.
+    """
+    ssh_command = (f"ssh -o ControlMaster=auto -o ControlPath={cfg.SSH_CONTROL_PATH} "
+                   f"-o ControlPersist={cfg.SSH_CONTROL_PERSIST_SECONDS}")
+    command = [
+        'sshpass', '-p', cfg.PASSWORD,
+        # --partial keeps interrupted files so the next attempt resumes them instead of starting over
+        'rsync', '-az', '--partial', '--info=progress2', '-e', ssh_command,
+    ]
+    if bandwidth_limit_kbps:
+        command.append(f'--bwlimit={bandwidth_limit_kbps}')
+    if profile is not None:
+        command += rsync_filter_arguments(profile)
+    # Copy the contents (trailing slash), so the filters never match the work dir itself
+    command += [f"{cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory.rstrip('/')}/", local_directory]
+    return command
+
+# Prints one line per file: relative path, size and md5 of the first and last MANIFEST_SAMPLE_BYTES
+MANIFEST_COMMAND_TEMPLATE = '''
+cd {directory} && find . -type f ! -name '{manifest_name}' -printf '%P\\n' | while IFS= read -r f; do
+  printf '%s\\t%s\\t%s\\n' "$f" "$(stat -c %s "$f")" "$( (head -c {sample} "$f"; tail -c {sample} "$f") | md5sum | cut -d' ' -f1)"
+done > {manifest_name} && cat {manifest_name}
+'''
+
+def write_remote_manifest(ssh, directory):
+    """
+    Write a manifest of every file in a remote directory (size and a fast sampled checksum) into the
+    directory itself and return it.
+    :return: dict of {relative_path: (size, checksum)}, or None if the manifest could not be written
+    """
+    command = MANIFEST_COMMAND_TEMPLATE.format(directory=directory, manifest_name=cfg.OFFLOAD_MANIFEST_NAME,
+                                               sample=cfg.MANIFEST_SAMPLE_BYTES)
+    logging.info(f"    Writing offload manifest for {directory}")
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read().decode()
+    error = stderr.read().decode().strip()
+    if error:
+        logging.error(f"Error writing offload manifest for {directory}: {error}")
+        print_red(f"Error writing offload manifest for {directory}: {error}")
+        return None
+    manifest = {}
+    for line in output.splitlines():
+        parts = line.split('\t')
+        if len(parts) == 3:
+            manifest[parts[0]] = (int(parts[1]), parts[2])
+    return manifest
+
+def sampled_checksum(path, size, sample=None):
+    """Local equivalent of (head -c sample; tail -c sample) | md5sum."""
+    sample = sample or cfg.MANIFEST_SAMPLE_BYTES
+    digest = hashlib.md5()
+    with open(path, 'rb') as local_file:
+        digest.update(local_file.read(sample))
+        local_file.seek(max(0, size - sample))
+        digest.update(local_file.read(sample))
+    return digest.hexdigest()
+
+def verify_local_copy(local_directory, manifest):
+    """
+    Compare a local copy against the remote manifest.
+    :return: list of relative paths that are missing or differ, empty if the copy is complete
+    """
+    mismatches = []
+    for relative_path, (size, checksum) in manifest.items():
+        local_file = os.path.join(local_directory, relative_path)
+        if not os.path.isfile(local_file) or os.path.getsize(local_file) != size:
+            mismatches.append(relative_path)
+        elif sampled_checksum(local_file, size) != checksum:
+            mismatches.append(relative_path)
+    return mismatches
+
+_offload_record_lock = threading.Lock()
+
+def load_completed_offloads():
+    if os.path.exists(cfg.offload_record_path):
+        with open(cfg.offload_record_path, 'r') as record_file:
+            return json.load(record_file)
+    return {}
+
+def save_completed_offloads(completed_offloads):
+    with open(cfg.offload_record_path + '.tmp', 'w') as record_file:
+        json.dump(completed_offloads, record_file, indent=4)
+    os.replace(cfg.offload_record_path + '.tmp', cfg.offload_record_path)
+
+def record_completed_offload(directory, manifest):
+    """
+    Remember that a directory has been transferred and verified, until it is removed from the remote.
+    The record keeps the file count and size of the manifest, so a new directory with the same path does not match it.
+    """
+    with _offload_record_lock:
+        completed_offloads = load_completed_offloads()
+        completed_offloads[directory] = {
+            "time": time.time(),
+            "files": len(manifest),
+            "bytes": sum(size for size, checksum in manifest.values()),
+        }
+        save_completed_offloads(completed_offloads)
+
+def forget_completed_offload(directory):
+    """Drop the record of a directory once it is removed from the remote, a later directory with the same path is a new one."""
+    with _offload_record_lock:
+        completed_offloads = load_completed_offloads()
+        if completed_offloads.pop(directory, None) is not None:
+            save_completed_offloads(completed_offloads)
+
+def matches_completed_offload(record, manifest):
+    return (record is not None and record["files"] == len(manifest)
+            and record["bytes"] == sum(size for size, checksum in manifest.values()))
+
+def build_pscp_command(directory, local_path):
+    return [cfg.PSCP_PATH, "-r", "-pw", cfg.PASSWORD, f"{cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory}", local_path]
+
+def build_pscp_file_commands(directory, local_directory, files):
+    """pscp has no include/exclude filters, so a selective offload copies the selected files one by one."""
+    commands = []
+    for relative_path in sorted(files):
+        local_file = os.path.join(local_directory, *relative_path.split('/'))
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        commands.append([cfg.PSCP_PATH, "-pw", cfg.PASSWORD,
+                         f"{cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory.rstrip('/')}/{relative_path}", local_file])
+    return commands
+
+def build_tar_command(parent_directory, compress=False):
+    """Remote tar that writes the NUL separated paths it reads from stdin, relative to parent_directory, to stdout."""
+    return f"tar -c{'z' if compress else ''}f - -C {parent_directory} --null -T -"
+
+class ThrottledReader:
+    """File like wrapper around the tar stream of a channel that applies the bandwidth cap while reading."""
+    def __init__(self, stream, bandwidth_limit_kbps=0):
+        self.stream = stream
+        self.bandwidth_limit_kbps = bandwidth_limit_kbps
+        self.bytes = 0
+        self.start_time = time.time()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes += len(data)
+        if self.bandwidth_limit_kbps:
+            ahead = self.bytes / (self.bandwidth_limit_kbps * 1024) - (time.time() - self.start_time)
+            if ahead > 0:
+                time.sleep(ahead)
+        return data
+
+def extract_tar_member(archive, member, local_path):
+    """Extract one member of the stream, refusing paths that would end up outside local_path."""
+    if os.path.isabs(member.name) or '..' in member.name.split('/'):
+        raise tarfile.TarError(f"Refusing to extract unsafe path {member.name}")
+    if hasattr(tarfile, 'data_filter'):
+        archive.extract(member, local_path, filter='data')
+    else:
+        archive.extract(member, local_path)
+
+class TransferManager:
+    """
+    Copies remote directories to the local pc with a pool of concurrent transfer workers.
+
+    submit() only queues a directory and returns, so the offload pipeline never blocks on a
+    transfer. The bandwidth cap is split statically, every worker is limited to an equal share of it
+    whether or not the other workers are busy, so an idle worker's share is not used. With the 'tar' engine
+    a worker sends up to cfg.TRANSFER_BATCH_SIZE queued directories in one tar stream over the
+    pooled paramiko connection and unpacks it on the fly, without temporary files or re-authenticating. Progress and
+    throughput of every transfer are kept in self.progress, and on_success(directory) is called
+    after a directory has been copied successfully. Only the files selected by the offload profile
+    (cfg.OFFLOAD_PROFILE by default) are copied.
+    """
+    def __init__(self, workers=cfg.TRANSFER_WORKERS, bandwidth_limit_kbps=cfg.TRANSFER_BANDWIDTH_LIMIT_KBPS,
+                 local_path=cfg.LOCAL_PATH, on_success=None, profile=None, engine=cfg.TRANSFER_ENGINE,
+                 compress=cfg.TRANSFER_COMPRESSION, batch_size=cfg.TRANSFER_BATCH_SIZE):
+        self.workers = max(1, workers)
+        self.engine = engine
+        self.compress = compress
+        self.batch_size = max(1, batch_size) if engine == 'tar' else 1
+        self.profile = get_offload_profile(profile)
+        self.bandwidth_limit_kbps = bandwidth_limit_kbps
+        self.local_path = local_path
+        self.on_success = on_success
+        self.progress = {}
+        self._queue = queue.Queue()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def worker_bandwidth_limit_kbps(self):
+        """Share of the bandwidth cap of one worker in KB/s, 0 = unlimited. Never rounds a set cap down to unlimited."""
+        if not self.bandwidth_limit_kbps:
+            return 0
+        return max(1, self.bandwidth_limit_kbps // self.workers)
+
+    def _start_workers(self):
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"transfer-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, directory):
+        """Queue a remote directory for transfer. Returns False if it is already queued or running."""
+        with self._lock:
+            if directory in self._in_flight:
+                return False
+            self._in_flight.add(directory)
+            self.progress[directory] = {"status": "QUEUED", "bytes": 0, "percent": 0, "rate": "", "seconds": 0}
+            self._start_workers()
+        self._queue.put(directory)
+        logging.info(f"Queued transfer of {directory}")
+        return True
+
+    def wait(self):
+        """Block until every queued transfer has finished."""
+        self._queue.join()
+
+    def pending(self):
+        with self._lock:
+            return set(self._in_flight)
+
+    def _worker(self):
+        while True:
+            batch = [self._queue.get()]
+            # Pick up directories queued in the meantime, so they share one stream
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for directory in self.offload(batch):
+                    if self.on_success is not None:
+                        self.on_success(directory)
+            except Exception as e:
+                print_red(f"Error processing directories {batch}: {e}")
+                logging.error(f"Error processing directories {batch}: {e}")
+                for directory in batch:
+                    if self.progress[directory]["status"] != "DONE":
+                        self.progress[directory]["status"] = "FAILED"
+            finally:
+                with self._lock:
+                    self._in_flight.difference_update(batch)
+                for directory in batch:
+                    self._queue.task_done()
+
+    def offload(self, directories):
+        """
+        Offload protocol: write a manifest on the remote, transfer (resuming partial files) and verify
+        the local copy against the manifest. A directory is only returned, which allows it to be
+        removed from the remote, once every file has been verified.
+        :return: list of directories that were transferred and verified
+        """
+        completed_offloads = load_completed_offloads()
+        verified = []
+        manifests = {}
+        for directory in directories:
+            # The manifest is always written fresh, a record alone never allows removing the remote directory
+            manifest = write_remote_manifest(rops.get_ssh_pool(), directory)
+            if manifest is None:
+                self.progress[directory]["status"] = "FAILED"
+                continue
+            total_bytes = sum(size for size, checksum in manifest.values())
+            manifest = {path: entry for path, entry in manifest.items() if is_selected_file(path, self.profile)}
+            selected_bytes = sum(size for size, checksum in manifest.values())
+            logging.info(f"Offload profile selected {len(manifest)} files of {directory} "
+                         f"({selected_bytes / (1024 * 1024):.1f} of {total_bytes / (1024 * 1024):.1f} MB)")
+            local_directory = os.path.join(self.local_path, os.path.basename(directory.rstrip('/')))
+            if matches_completed_offload(completed_offloads.get(directory), manifest) and not verify_local_copy(local_directory, manifest):
+                logging.info(f"{directory} was already transferred and verified, skipping the transfer")
+                print_green(f"{directory} was already transferred and verified, skipping the transfer")
+                self.progress[directory]["status"] = "DONE"
+                verified.append(directory)
+                continue
+            manifests[directory] = manifest
+
+        if self.engine == 'tar':
+            transferred = self.stream_transfer(manifests)
+        else:
+            transferred = []
+            for directory, manifest in manifests.items():
+                files = None if is_full_profile(self.profile) and not self.profile['exclude'] else list(manifest)
+                if self.transfer(directory, files):
+                    transferred.append(directory)
+
+        for directory in transferred:
+            manifest = manifests[directory]
+            local_directory = os.path.join(self.local_path, os.path.basename(directory.rstrip('/')))
+            mismatches = verify_local_copy(local_directory, manifest)
+            if mismatches:
+                self.progress[directory]["status"] = "FAILED"
+                logging.error(f"Local copy of {directory} does not match the manifest, keeping the remote copy: {mismatches}")
+                print_red(f"Local copy of {directory} does not match the manifest, keeping the remote copy: {mismatches}")
+                continue
+            record_completed_offload(directory, manifest)
+            logging.info(f"Verified {len(manifest)} files of {directory} against the manifest")
+            verified.append(directory)
+        return verified
+
+    def stream_transfer(self, manifests):
+        """
+        Send the files in the manifests with one tar stream per remote parent directory.
+        :param manifests: dict of {directory: manifest} with the files selected by the offload profile
+        :return: list of directories whose stream finished without errors
+        """
+        by_parent = defaultdict(dict)
+        for directory, manifest in manifests.items():
+            by_parent[posixpath.dirname(directory.rstrip('/'))][directory] = manifest
+        transferred = []
+        for parent_directory, parent_manifests in by_parent.items():
+            if self._stream_tar(parent_directory, parent_manifests):
+                transferred += list(parent_manifests)
+        return transferred
+
+    def _stream_tar(self, parent_directory, manifests):
+        names = {posixpath.basename(directory.rstrip('/')): directory for directory in manifests}
+        paths = []
+        for name, directory in names.items():
+            self.progress[directory]["status"] = "RUNNING"
+            # Files that are already complete from an interrupted stream are not sent again
+            missing = verify_local_copy(os.path.join(self.local_path, name), manifests[directory])
+            paths += [f"{name}/{relative_path}" for relative_path in missing]
+        start_time = time.time()
+        print_blue(f"Streaming {len(paths)} files of {list(manifests)} to {self.local_path}")
+        logging.info(f"    Executing: {build_tar_command(parent_directory, self.compress)} ({len(paths)} files of {list(names)})")
+
+        if paths:
+            try:
+                stdin, stdout, stderr = rops.get_ssh_pool().exec_command(build_tar_command(parent_directory, self.compress))
+                stdin.write('\0'.join(paths) + '\0')
+                stdin.flush()
+                stdin.channel.shutdown_write()
+                reader = ThrottledReader(stdout, self.worker_bandwidth_limit_kbps())
+                with tarfile.open(fileobj=reader, mode='r|gz' if self.compress else 'r|') as archive:
+                    for member in archive:
+                        directory = names.get(member.name.split('/')[0])
+                        if directory is None:
+                            raise tarfile.TarError(f"Unexpected path {member.name} in the stream")
+                        extract_tar_member(archive, member, self.local_path)
+                        self.progress[directory]["bytes"] += member.size
+                exit_status = stdout.channel.recv_exit_status()
+                error = stderr.read().decode().strip()
+                if exit_status != 0:
+                    raise tarfile.TarError(f"remote tar exited with {exit_status}: {error}")
+            except (tarfile.TarError, OSError, EOFError, paramiko.SSHException) as e:
+                for directory in manifests:
+                    self.progress[directory]["status"] = "FAILED"
+                logging.error(f"Tar stream of {list(manifests)} failed with error: {e}")
+                print_red(f"Tar stream of {list(manifests)} failed with error: {e}")
+                return False
+
+        seconds = time.time() - start_time
+        for directory in manifests:
+            self.progress[directory].update(status="DONE", percent=100, seconds=seconds)
+        total_bytes = sum(self.progress[directory]["bytes"] for directory in manifests)
+        throughput = total_bytes / (1024 * 1024) / max(seconds, 1e-6)
+        print_green(f"Moved directories {list(manifests)} to local machine: {self.local_path} "
+                    f"({total_bytes / (1024 * 1024):.1f} MB in {seconds:.0f} s, {throughput:.2f} MB/s)")
+        logging.info(f"Moved directories {list(manifests)} to local machine: {self.local_path} "
+                     f"({total_bytes} bytes in {seconds:.0f} s, {throughput:.2f} MB/s)")
+        return True
+
+    def transfer(self, directory, files=None):
+        """
+        Copy one remote directory to self.local_path. Returns True on success.
+        :param files: relative paths selected by the offload profile, None to copy the whole directory
+        """
+        transfer_progress = self.progress[directory]
+        transfer_progress["status"] = "RUNNING"
+        start_time = time.time()
+        local_directory = os.path.join(self.local_path, os.path.basename(directory.rstrip('/')))
+        if cfg.windows:
+            if files is None:
+                commands = [build_pscp_command(directory, self.local_path)]
+            else:
+                commands = build_pscp_file_commands(directory, local_directory, files)
+            logging.info(f"    Executing: pscp {cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory} {self.local_path} ({len(commands)} commands)")
+        else:
+            commands = [build_rsync_command(directory, local_directory, self.worker_bandwidth_limit_kbps(), self.profile)]
+            logging.info(f"    Executing: rsync -az '{cfg.USERNAME}@{cfg.REMOTE_HOST}:{directory}/', {local_directory}")
+        print_blue(f"Transferring {directory} to {self.local_path}")
+
+        for command in commands:
+            if not self._run_transfer_command(command, transfer_progress):
+                break
+        transfer_progress["seconds"] = time.time() - start_time
+
+        if transfer_progress.get("returncode", 0) != 0:
+            transfer_progress["status"] = "FAILED"
+            logging.error(f"Transfer of {directory} failed with error: {transfer_progress.get('stderr', '')}")
+            print_red(f"Transfer of {directory} failed with error: {transfer_progress.get('stderr', '')}")
+            return False
+
+        transfer_progress["status"] = "DONE"
+        throughput = transfer_progress["bytes"] / (1024 * 1024) / max(transfer_progress["seconds"], 1e-6)
+        print_green(f"Moved directory {directory} to local machine: {self.local_path} "
+                    f"({transfer_progress['bytes'] / (1024 * 1024):.1f} MB in {transfer_progress['seconds']:.0f} s, {throughput:.2f} MB/s)")
+        logging.info(f"Moved directory {directory} to local machine: {self.local_path} "
+                     f"({transfer_progress['bytes']} bytes in {transfer_progress['seconds']:.0f} s, {throughput:.2f} MB/s)")
+        return True
+
+    def _run_transfer_command(self, command, transfer_progress):
+        """Run one rsync/pscp command, following its progress output. Returns True if it succeeded."""
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+        stderr_reader = threading.Thread(target=lambda: transfer_progress.update(stderr=process.stderr.read()), daemon=True)
+        stderr_reader.start()
+        buffer = ''
+        # rsync rewrites its progress line with carriage returns, so read characters instead of lines
+        for character in iter(lambda: process.stdout.read(1), ''):
+            if character not in '\r\n':
+                buffer += character
+                continue
+            match = RSYNC_PROGRESS_PATTERN.search(buffer)
+            if match:
+                transfer_progress["bytes"] = int(match.group(1).replace(',', ''))
+                transfer_progress["percent"] = int(match.group(2))
+                transfer_progress["rate"] = match.group(3)
+            buffer = ''
+        process.wait()
+        stderr_reader.join()
+        transfer_progress["returncode"] = process.returncode
+        return process.returncode == 0
+
+def remove_remote_directory(directory, ssh=None):
+    """Remove a directory on the remote machine after it has been transferred."""
+    ssh = ssh or rops.get_ssh_pool()
+    logging.info(f"    Executing: rm -rf {directory}")
+    print_red(f"Executing: rm -rf {directory}")
+    stdin, stdout, stderr = ssh.exec_command(f'rm -rf {directory}')
+    error = stderr.read().decode().strip()
+    if error:
+        raise Exception(f"Failed to remove directory {directory} on remote machine: {error}")
+    print_green(f"Removed directory {directory} from remote machine.")
+    logging.info(f"Removed directory {directory} from remote machine.")
+    forget_completed_offload(directory)
+    # The freed space is not in the cached quota sample
+    quota_manager.get_quota_manager().invalidate()
+
+_transfer_manager = None
+
+def get_transfer_manager():
+    """Return the process wide transfer manager, which removes each directory from the remote once it is copied."""
+    global _transfer_manager
+    if _transfer_manager is None:
+        _transfer_manager = TransferManager(on_success=remove_remote_directory)
+    return _transfer_manager